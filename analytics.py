@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Аналитика по игрокам и экономике: игроки по стихиям, распределение
+уровней, перцентили XP и золота, сколько золота выдано и потрачено по дням.
+
+Считается только по снимку базы (storage.Snapshot) и заранее: бот
+пересчитывает агрегаты после каждого обновления снимка и отдаёт готовые
+числа в /metrics, рабочая база этих запросов не видит.
+
+Пример (по копии базы, бот может работать):
+    python analytics.py /data/sailor.db.snapshot
+    python analytics.py /data/sailor.db.snapshot --json
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import time
+from urllib.parse import quote
+
+PERCENTILES = (50, 90, 99)
+INFLATION_DAYS = 30
+
+
+class Analytics:
+    def __init__(self, db):
+        self.db = db  # снимок: что угодно с read(fn, *args)
+        self.aggregates: dict = {}
+        self.computed_at = 0.0
+
+    async def refresh(self) -> dict:
+        self.aggregates = await self.db.read(compute_aggregates)
+        self.computed_at = time.time()
+        return self.aggregates
+
+
+def _percentiles(conn, column: str, total: int) -> dict:
+    # один проход по отсортированному столбцу, без выборки всех значений в память
+    if not total:
+        return {}
+    wanted = {min(total - 1, total * q // 100): q for q in PERCENTILES}
+    result = {}
+    for i, (value,) in enumerate(conn.execute(f"SELECT {column} FROM players ORDER BY {column}")):
+        if i in wanted:
+            result[wanted[i]] = value
+            if len(result) == len(wanted):
+                break
+    return result
+
+def _has_table(conn, name: str) -> bool:
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)).fetchone() is not None
+
+def compute_aggregates(conn) -> dict:
+    total, gold_total = conn.execute("SELECT count(*), coalesce(sum(gold), 0) FROM players").fetchone()
+    result = {
+        "players": total,
+        "by_style": dict(conn.execute("SELECT style, count(*) FROM players GROUP BY style")),
+        "by_level": dict(conn.execute("SELECT lvl, count(*) FROM players GROUP BY lvl ORDER BY lvl")),
+        "xp_percentiles": _percentiles(conn, "xp", total),
+        "gold_total": gold_total,
+        "gold_percentiles": _percentiles(conn, "gold", total),
+        "gold_by_day": [],
+    }
+    if _has_table(conn, "game_log"):
+        # выдано (dg > 0) и потрачено (dg < 0) по событиям журнала, по дням UTC
+        since = time.time() - INFLATION_DAYS * 86400
+        result["gold_by_day"] = [
+            {"day": day, "minted": minted, "burned": -burned, "net": minted + burned}
+            for day, minted, burned in conn.execute(
+                """
+                SELECT date(ts, 'unixepoch') AS day,
+                       coalesce(sum(max(dg, 0)), 0), coalesce(sum(min(dg, 0)), 0)
+                FROM (SELECT ts, json_extract(data, '$.dg') AS dg FROM game_log WHERE ts >= ?)
+                WHERE dg IS NOT NULL
+                GROUP BY day ORDER BY day
+                """,
+                (since,),
+            )
+        ]
+    return result
+
+
+def print_report(a: dict):
+    print(f"Игроков: {a['players']}")
+    print("По стихиям: " + ", ".join(f"{k}: {v}" for k, v in a["by_style"].items()))
+    print("По уровням: " + ", ".join(f"{k}: {v}" for k, v in a["by_level"].items()))
+    print("XP: " + ", ".join(f"p{q} {v}" for q, v in a["xp_percentiles"].items()))
+    print(f"Золото: всего {a['gold_total']}, " + ", ".join(f"p{q} {v}" for q, v in a["gold_percentiles"].items()))
+    for d in a["gold_by_day"]:
+        print(f"  {d['day']}: выдано {d['minted']}, потрачено {d['burned']}, итог {d['net']:+d}")
+
+
+def parse_args(argv=None):
+    ap = argparse.ArgumentParser(description="Аналитика по копии базы")
+    ap.add_argument("db", help="файл базы; лучше снимок, а не рабочая база")
+    ap.add_argument("--json", action="store_true")
+    return ap.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    conn = sqlite3.connect(f"file:{quote(os.path.abspath(args.db))}?mode=ro", uri=True)
+    try:
+        a = compute_aggregates(conn)
+    finally:
+        conn.close()
+    if args.json:
+        print(json.dumps(a, ensure_ascii=False, indent=2))
+    else:
+        print_report(a)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
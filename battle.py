@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+"""
+Боевой движок: правила боя отдельно от Telegram.
+
+Обработчики бота (/fight, /battle, /teamfight, /raid) и офлайн-расчёт
+баланса используют одни и те же правила и константы. Случайность
+передаётся снаружи: random.Random для живых боёв, numpy.random.Generator
+для пакетного режима, поэтому при одном seed результат воспроизводим.
+
+Пакетный режим считает миллионы боёв на NumPy: матрицу стихия × уровень ×
+монстр (доля побед, XP и золото на единицу энергии) и кривые «сколько
+энергии до каждого уровня». numpy нужен только ему и импортируется при вызове;
+он в requirements-dev.txt, а не в зависимостях бота.
+
+Пример:
+    pip install -r requirements-dev.txt
+    python battle.py --fights 20000 --players 20000 --seed 1
+    python battle.py --json > balance.json
+"""
+
+import argparse
+import json
+import random
+import sys
+from dataclasses import dataclass
+
+from gamedata import (
+    STYLES, MONSTERS, LEVELS, LEVEL_THRESHOLDS, LEVEL_UP_ATK, ENERGY_REGEN_SECONDS,
+    BOSSES, SUPER_BOSSES, monster_pool_for,
+)
+
+ROLL_SIDES = 10  # каждая сторона бросает d10 и прибавляет атаку
+DAMAGE_SPREAD = 3  # урон при поражении: атака монстра + 0..DAMAGE_SPREAD
+DROP_CHANCE = 0.08  # шанс Лунного кристалла за победу
+SUPERBOSS_CHANCE = 0.10
+
+
+@dataclass
+class FightResult:
+    won: bool
+    player_roll: int
+    monster_roll: int
+    damage: int  # урон игроку, 0 при победе
+    drop: bool
+
+
+@dataclass
+class TeamFightResult:
+    won: bool
+    team_roll: int
+    boss_roll: int
+    xp: int  # каждому участнику
+    gold: int
+    drops: list  # [bool] по участникам, в порядке atks
+
+
+# ------------ Живые бои ------------
+def pick_monster(lvl: int, rng: random.Random) -> dict:
+    return rng.choice(monster_pool_for(lvl))
+
+def fight(atk: int, monster: dict, rng: random.Random) -> FightResult:
+    player_roll = rng.randint(1, ROLL_SIDES) + atk
+    monster_roll = rng.randint(1, ROLL_SIDES) + monster["atk"]
+    if player_roll >= monster_roll:
+        return FightResult(True, player_roll, monster_roll, 0, rng.random() < DROP_CHANCE)
+    damage = max(1, monster["atk"] + rng.randint(0, DAMAGE_SPREAD))
+    return FightResult(False, player_roll, monster_roll, damage, False)
+
+def pick_boss(rng: random.Random) -> tuple[dict, bool]:
+    """(босс, супербосс ли)."""
+    if rng.random() < SUPERBOSS_CHANCE and SUPER_BOSSES:
+        return rng.choice(SUPER_BOSSES), True
+    return rng.choice(BOSSES), False
+
+def team_fight(atks: list, boss: dict, rng: random.Random) -> TeamFightResult:
+    """Команда бросает один раз со средней атакой; награда делится поровну."""
+    n = max(1, len(atks))
+    team_roll = rng.randint(1, ROLL_SIDES) + sum(atks) // n
+    boss_roll = rng.randint(1, ROLL_SIDES) + boss["atk"]
+    if team_roll < boss_roll:
+        return TeamFightResult(False, team_roll, boss_roll, 0, 0, [False] * len(atks))
+    drops = [rng.random() < DROP_CHANCE for _ in atks]
+    return TeamFightResult(True, team_roll, boss_roll, boss["reward_xp"] // n, boss["reward_gold"] // n, drops)
+
+
+# ------------ Пошаговый бой ------------
+ATTACK, ITEM, FLEE = "a", "i", "f"  # действия игрока, они же аргумент в callback_data
+WON, LOST, FLED = "won", "lost", "fled"
+
+_MONSTER_INDEX = {m["id"]: i for i, m in enumerate(MONSTERS)}
+
+
+class Duel:
+    """
+    Пошаговый бой одного игрока с монстром. Таких в памяти тысячи, поэтому
+    только числа в __slots__: монстр — индекс в MONSTERS, HP — текущие.
+    turn — номер хода, который ещё не сделан: кнопки несут его, и нажатие
+    кнопки с прошлого хода не засчитывается второй раз.
+    """
+
+    __slots__ = ("user_id", "monster", "monster_hp", "hp", "turn", "expires_at")
+
+    def __init__(self, user_id: int, monster: int, monster_hp: int, hp: int,
+                 turn: int = 0, expires_at: float = 0.0):
+        self.user_id = user_id
+        self.monster = monster
+        self.monster_hp = monster_hp
+        self.hp = hp
+        self.turn = turn
+        self.expires_at = expires_at  # unix-время
+
+    @property
+    def foe(self) -> dict:
+        return MONSTERS[self.monster]
+
+
+@dataclass
+class TurnResult:
+    action: str
+    player_roll: int
+    monster_roll: int
+    dealt: int  # урон монстру
+    taken: int  # урон игроку
+    healed: int
+    outcome: str | None  # WON, LOST, FLED; None — бой продолжается
+    drop: bool
+
+def start_duel(user_id: int, lvl: int, hp: int, rng: random.Random) -> Duel:
+    monster = pick_monster(lvl, rng)
+    return Duel(user_id, _MONSTER_INDEX[monster["id"]], monster["hp"], hp)
+
+def duel_turn(duel: Duel, action: str, atk: int, rng: random.Random, heal: int = 0, max_hp: int = 0) -> TurnResult:
+    """
+    Один ход; меняет duel и увеличивает duel.turn. Броски те же, что в fight().
+    ATTACK — выигравший бросок бьёт: атака + 0..DAMAGE_SPREAD;
+    ITEM — игрок лечится на heal (не выше max_hp), монстр бьёт, если перебросил;
+    FLEE — удаётся при броске не ниже монстра, иначе монстр бьёт.
+    """
+    monster = duel.foe
+    player_roll = rng.randint(1, ROLL_SIDES) + atk
+    monster_roll = rng.randint(1, ROLL_SIDES) + monster["atk"]
+    dealt = taken = healed = 0
+    fled = False
+    if action == ATTACK and player_roll >= monster_roll:
+        dealt = max(1, atk + rng.randint(0, DAMAGE_SPREAD))
+    elif action == FLEE and player_roll >= monster_roll:
+        fled = True
+    else:
+        if action == ITEM:
+            healed = max(0, min(heal, max_hp - duel.hp))
+            duel.hp += healed
+        if action != ITEM or monster_roll > player_roll:
+            taken = max(1, monster["atk"] + rng.randint(0, DAMAGE_SPREAD))
+    duel.monster_hp -= dealt
+    duel.hp -= taken
+    duel.turn += 1
+    outcome = None
+    if fled:
+        outcome = FLED
+    elif duel.monster_hp <= 0:
+        outcome = WON
+    elif duel.hp <= 0:
+        outcome = LOST
+    drop = outcome == WON and rng.random() < DROP_CHANCE
+    return TurnResult(action, player_roll, monster_roll, dealt, taken, healed, outcome, drop)
+
+
+# ------------ Рейды ------------
+def raid_hit(atk: int, boss: dict, rng: random.Random) -> int:
+    """Удар по рейдовому боссу: броски как в fight(), урон 0 — промах."""
+    if rng.randint(1, ROLL_SIDES) + atk < rng.randint(1, ROLL_SIDES) + boss["atk"]:
+        return 0
+    return max(1, atk + rng.randint(0, DAMAGE_SPREAD))
+
+def raid_rewards(boss: dict, damage: dict, rng: random.Random) -> dict:
+    """
+    Награды за побеждённого босса: {user_id: (xp, gold, drop)}. Как и в
+    командном бою, на всех одна награда босса, но делится она по
+    нанесённому урону; Лунный кристалл — не больше одного на рейд.
+    """
+    xp = _split(boss["reward_xp"], damage)
+    gold = _split(boss["reward_gold"], damage)
+    lucky = None
+    if rng.random() < DROP_CHANCE:
+        ids = list(damage)
+        lucky = rng.choices(ids, weights=[damage[uid] for uid in ids])[0]
+    return {uid: (xp[uid], gold[uid], uid == lucky) for uid in damage}
+
+def _split(total: int, damage: dict) -> dict:
+    # доли по урону целыми числами; остаток — тем, у кого дробная часть больше
+    dealt = sum(damage.values())
+    parts = {uid: divmod(total * d, dealt) for uid, d in damage.items()}
+    left = total - sum(q for q, _ in parts.values())
+    for uid in sorted(parts, key=lambda uid: parts[uid][1], reverse=True)[:left]:
+        parts[uid] = (parts[uid][0] + 1, 0)
+    return {uid: q for uid, (q, _) in parts.items()}
+
+
+# ------------ Пакетный режим (NumPy) ------------
+def player_atk(style: str, lvl: int) -> int:
+    # атака без предметов: база стихии плюс прибавки за уровни
+    return STYLES[style]["atk_base"] + LEVEL_UP_ATK * (lvl - 1)
+
+def fight_batch(atk, monster_atk, rng):
+    """
+    Векторный fight(): atk и monster_atk — массивы, совместимые по форме.
+    Возвращает (won, damage, drop) той же формы.
+    """
+    import numpy as np
+
+    shape = np.broadcast(atk, monster_atk).shape
+    player_roll = rng.integers(1, ROLL_SIDES + 1, size=shape) + atk
+    monster_roll = rng.integers(1, ROLL_SIDES + 1, size=shape) + monster_atk
+    won = player_roll >= monster_roll
+    spread = rng.integers(0, DAMAGE_SPREAD + 1, size=shape)
+    damage = np.where(won, 0, np.maximum(1, monster_atk + spread))
+    drop = won & (rng.random(shape) < DROP_CHANCE)
+    return won, damage, drop
+
+def simulate_matchups(fights: int = 10000, seed: int | None = None, chunk: int = 2_000_000) -> list:
+    """
+    Каждая стихия × каждый уровень LEVELS × каждый монстр, по fights боёв.
+    in_pool — встречается ли монстр игроку этого уровня в /fight.
+    Память ограничена: за раз считается не больше chunk боёв.
+    """
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    cells = [
+        (style, lvl, m)
+        for style in STYLES
+        for lvl in range(1, len(LEVELS) + 1)
+        for m in MONSTERS
+    ]
+    atk = np.array([player_atk(style, lvl) for style, lvl, _ in cells])
+    matk = np.array([m["atk"] for _, _, m in cells])
+    step = max(1, chunk // fights)
+    rows = []
+    for start in range(0, len(cells), step):
+        sl = slice(start, start + step)
+        shape = (len(cells[sl]), fights)
+        won, damage, drop = fight_batch(np.broadcast_to(atk[sl, None], shape), matk[sl, None], rng)
+        for (style, lvl, m), w, d, dr in zip(cells[sl], won.mean(1), damage.mean(1), drop.mean(1)):
+            rows.append({
+                "style": style,
+                "lvl": lvl,
+                "monster": m["id"],
+                "in_pool": m in monster_pool_for(lvl),
+                "win_rate": float(w),
+                "xp_per_energy": float(w) * m["reward_xp"],
+                "gold_per_energy": float(w) * m["reward_gold"],
+                "damage_per_energy": float(d),
+                "drops_per_energy": float(dr),
+            })
+    return rows
+
+def pool_summary(rows: list) -> list:
+    """Средние по пулу /fight (монстр выбирается равновероятно) для стихии и уровня."""
+    groups: dict = {}
+    for r in rows:
+        if r["in_pool"]:
+            groups.setdefault((r["style"], r["lvl"]), []).append(r)
+    keys = ("win_rate", "xp_per_energy", "gold_per_energy", "damage_per_energy")
+    return [
+        {"style": style, "lvl": lvl, **{k: sum(r[k] for r in rs) / len(rs) for k in keys}}
+        for (style, lvl), rs in groups.items()
+    ]
+
+def simulate_progression(players: int = 10000, seed: int | None = None, max_fights: int = 100_000) -> dict:
+    """
+    Кривые прокачки: players новичков каждой стихии бьются в /fight, пока
+    не дойдут до последнего уровня. Для каждого уровня — сколько боёв
+    (= единиц энергии) понадобилось: медиана и 90-й перцентиль.
+    Ежедневная награда и предметы не учитываются.
+    """
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    top = len(LEVELS)
+    thresholds = np.array(LEVEL_THRESHOLDS)
+    # пулы монстров по уровню игрока, дополненные до одной длины
+    pools = [None] + [[MONSTERS.index(m) for m in monster_pool_for(lvl)] for lvl in range(1, top + 1)]
+    width = max(len(p) for p in pools[1:])
+    pool_size = np.array([1] + [len(p) for p in pools[1:]])
+    pool_idx = np.array([[0] * width] + [p + [p[-1]] * (width - len(p)) for p in pools[1:]])
+    matk = np.array([m["atk"] for m in MONSTERS])
+    reward_xp = np.array([m["reward_xp"] for m in MONSTERS])
+
+    curves = {}
+    for style in STYLES:
+        base = STYLES[style]["atk_base"]
+        xp = np.zeros(players, dtype=np.int64)
+        lvl = np.ones(players, dtype=np.int64)
+        reached = np.full((players, top), -1, dtype=np.int64)
+        reached[:, 0] = 0
+        active = np.arange(players)
+        fights = 0
+        while active.size and fights < max_fights:
+            fights += 1
+            cur = lvl[active]
+            pick = (rng.random(active.size) * pool_size[cur]).astype(np.int64)
+            m = pool_idx[cur, pick]
+            won, _, _ = fight_batch(base + LEVEL_UP_ATK * (cur - 1), matk[m], rng)
+            xp[active] += won * reward_xp[m]
+            new = np.maximum(1, np.searchsorted(thresholds, xp[active], side="right"))
+            for level in range(2, top + 1):
+                hit = active[(new >= level) & (cur < level)]
+                reached[hit, level - 1] = fights
+            lvl[active] = new
+            active = active[new < top]
+        curve = []
+        for level in range(1, top + 1):
+            got = reached[:, level - 1]
+            got = got[got >= 0]
+            median = float(np.median(got)) if got.size else None
+            curve.append({
+                "lvl": level,
+                "title": LEVELS[level - 1][1],
+                "reached": got.size / players,
+                "energy_median": median,
+                "energy_p90": float(np.percentile(got, 90)) if got.size else None,
+                "hours_median": median * ENERGY_REGEN_SECONDS / 3600 if got.size else None,
+            })
+        curves[style] = curve
+    return curves
+
+
+# ------------ Отчёт ------------
+def print_report(summary: list, curves: dict):
+    print("Бой с пулом своего уровня: доля побед | XP/энергия | золото/энергия | урон/энергия")
+    for r in summary:
+        print(f"  {r['style']:<8} ур.{r['lvl']}  {r['win_rate']:6.1%}  {r['xp_per_energy']:7.2f}  "
+              f"{r['gold_per_energy']:7.2f}  {r['damage_per_energy']:6.2f}")
+    print("Энергия до уровня (медиана / p90, часы регенерации по медиане):")
+    for style, curve in curves.items():
+        parts = [
+            f"{c['lvl']}: {c['energy_median']:.0f}/{c['energy_p90']:.0f} ({c['hours_median']:.0f} ч)"
+            if c["energy_median"] is not None else f"{c['lvl']}: —"
+            for c in curve[1:]
+        ]
+        print(f"  {style:<8} " + "  ".join(parts))
+
+
+def parse_args(argv=None):
+    ap = argparse.ArgumentParser(description="Офлайн-расчёт баланса боёв")
+    ap.add_argument("--fights", type=int, default=10000, help="боёв на клетку стихия × уровень × монстр")
+    ap.add_argument("--players", type=int, default=10000, help="игроков на стихию в кривых прокачки")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--json", action="store_true", help="вывести всё, включая полную матрицу, в JSON")
+    return ap.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    rows = simulate_matchups(args.fights, seed=args.seed)
+    summary = pool_summary(rows)
+    curves = simulate_progression(args.players, seed=args.seed)
+    if args.json:
+        print(json.dumps({"matchups": rows, "pool": summary, "progression": curves}, ensure_ascii=False, indent=2))
+    else:
+        print_report(summary, curves)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,408 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный прогон бота без сети.
+
+Синтетические апдейты (/start, /fight, /shop + покупка, /teamfight,
+/leaderboard, ходы пошагового боя, удары в рейде) идут через тот же Application и те же обработчики, что и
+в main(); вместо Telegram — заглушка, которая только записывает вызовы.
+База — временный файл с заданным числом игроков.
+
+Пример:
+    python bench.py --players 10000 --updates 5000 --concurrency 64
+    python bench.py --players 1000000 --max-p95 50   # ненулевой код при регрессии
+    python bench.py --dispatch   # разбор колбэков: роутер против цепочки регулярок
+    python bench.py --scenario duel --players 50000   # ход при 50000 идущих боях
+    python bench.py --scenario raid --updates 20000 --concurrency 2000   # удары по одному боссу
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+from telegram import Update
+from telegram.request import BaseRequest
+
+BENCH_TOKEN = "123456:BENCH"
+
+# ------------ Заглушка Telegram ------------
+class RecordingRequest(BaseRequest):
+    """Отвечает на методы Bot API правдоподобными ответами и считает вызовы."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls: dict = {}
+        self._message_ids = itertools.count(1)
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit("/", 1)[-1]
+        self.calls[api_method] = self.calls.get(api_method, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        params = request_data.parameters if request_data else {}
+        if api_method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif api_method.startswith(("answer", "set", "delete")):
+            result = True
+        else:
+            chat_id = params.get("chat_id", 1)
+            result = {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": params.get("text", ""),
+            }
+            if api_method == "sendPhoto":
+                result["photo"] = [{"file_id": "bench-file", "file_unique_id": "bench", "width": 1, "height": 1}]
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+# ------------ Синтетические апдейты ------------
+_ids = itertools.count(1)
+
+def _user(uid: int) -> dict:
+    return {"id": uid, "is_bot": False, "first_name": f"Bench{uid}", "username": f"bench{uid}"}
+
+def command_update(uid: int, text: str) -> dict:
+    command = text.split()[0]
+    return {
+        "update_id": next(_ids),
+        "message": {
+            "message_id": next(_ids),
+            "date": int(time.time()),
+            "chat": {"id": uid, "type": "private"},
+            "from": _user(uid),
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(command)}],
+        },
+    }
+
+def callback_update(uid: int, data: str) -> dict:
+    return {
+        "update_id": next(_ids),
+        "callback_query": {
+            "id": str(next(_ids)),
+            "from": _user(uid),
+            "chat_instance": str(uid),
+            "data": data,
+            "message": {
+                "message_id": next(_ids),
+                "date": int(time.time()),
+                "chat": {"id": uid, "type": "private"},
+                "from": _user(1),
+                "text": "menu",
+            },
+        },
+    }
+
+SCENARIOS = {
+    "start": lambda uid: command_update(uid, "/start"),
+    "fight": lambda uid: command_update(uid, "/fight"),
+    "shop": lambda uid: command_update(uid, "/shop"),
+    "buy": lambda uid: callback_update(uid, "buy:healing_herb"),
+    "teamfight": lambda uid: command_update(uid, "/teamfight"),
+    "leaderboard": lambda uid: command_update(uid, "/leaderboard"),
+    "battle": lambda uid: command_update(uid, "/battle"),
+    # атака в бою, заготовленном populate(); первый ход — 0
+    "duel": lambda uid: callback_update(uid, f"bt:{uid}:a:0"),
+    # удар по рейду, заготовленному populate(), — у всех один и тот же босс
+    "raid": lambda uid: callback_update(uid, f"ra:{BENCH_RAID_ID}"),
+    # кнопки меню make_user_buttons по кругу
+    "menu": lambda uid: callback_update(uid, f"{MENU_PREFIXES[uid % len(MENU_PREFIXES)]}:{uid}"),
+    # один клиент долбит /fight: почти всё должен отсечь антиспам
+    "spam": lambda uid: command_update(1, "/fight"),
+}
+
+BENCH_RAID_ID = 1
+MENU_PREFIXES = ["pr", "in", "f", "tm", "tu", "lb", "ex", "tf"]
+
+# доли в смешанной нагрузке
+DEFAULT_MIX = {"start": 1, "fight": 5, "shop": 1, "buy": 2, "teamfight": 1, "leaderboard": 1}
+
+
+# ------------ Подготовка базы ------------
+def populate(path: str, players: int, teams: int, styles: list, battles: int = 0, raid: bool = False):
+    """Заполняет пустую базу игроками, командами по двое, идущими боями и рейдом."""
+    from duels import STATE
+    from gamedata import MONSTERS
+
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=OFF")
+    rnd = random.Random(1)
+    chunk = 50000
+    for start in range(1, players + 1, chunk):
+        rows = []
+        for uid in range(start, min(players, start + chunk - 1) + 1):
+            xp = rnd.randint(0, 800)
+            rows.append((uid, f"bench{uid}", f"Bench{uid}", rnd.choice(styles), 1, xp,
+                         rnd.randint(0, 500), 30, 30, 4, 5, "", "", ""))
+        conn.executemany(
+            "INSERT INTO players (user_id, username, name, style, lvl, xp, gold, hp, max_hp, atk,"
+            " energy, last_daily, inventory, last_energy_tick) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
+            rows,
+        )
+    for t in range(teams):
+        a, b = 2 * t + 1, 2 * t + 2
+        cur = conn.execute("INSERT INTO teams (leader_id, member_ids, active) VALUES (?,?,1)", (a, f"{a},{b}"))
+        conn.executemany("INSERT INTO team_members (team_id, user_id) VALUES (?,?)",
+                         [(cur.lastrowid, a), (cur.lastrowid, b)])
+    expires = time.time() + 86400
+    for start in range(1, battles + 1, chunk):
+        rows = []
+        for uid in range(start, min(battles, start + chunk - 1) + 1):
+            m = rnd.randrange(4)
+            rows.append((uid, 0, expires, STATE.pack(m, MONSTERS[m]["hp"], 30)))
+        conn.executemany("INSERT INTO battles (user_id, turn, expires_at, state) VALUES (?,?,?,?)", rows)
+    if raid:
+        # босс не должен пасть за прогон: меряем удары, а не «рейд окончен»
+        conn.execute("INSERT INTO raids (raid_id, chat_id, boss, hp, ends_at) VALUES (?, -100, 'boss1', ?, ?)",
+                     (BENCH_RAID_ID, 10 ** 9, expires))
+    conn.commit()
+    conn.close()
+
+
+def percentile(sorted_values: list, q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    i = min(len(sorted_values) - 1, int(round(q / 100 * (len(sorted_values) - 1))))
+    return sorted_values[i]
+
+
+# ------------ Разбор колбэков ------------
+def legacy_callback_chain():
+    """Обработчики в том порядке, в каком их регистрировал build_application() до роутера."""
+    from telegram.ext import CallbackQueryHandler, CommandHandler, MessageHandler, filters
+
+    async def noop(update, context):
+        pass
+
+    chain = []
+    for kind, arg in [
+        ("cmd", "start"), ("cb", r"^choose_style:"), ("cmd", "profile"), ("cmd", "inventory"),
+        ("cmd", "shop"), ("cb", r"^buy:"), ("cmd", "fight"), ("cmd", "daily"), ("cmd", "use"),
+        ("cmd", "teamup"), ("cmd", "team"), ("cmd", "teamfight"), ("cmd", "leaderboard"),
+        ("cb", r"^leaderboard:"), ("cmd", "explore"), ("cmd", "energy"), ("msg", None),
+        ("cb", r"^choose:"), ("cb", r"^team_(accept|decline):"),
+    ]:
+        if kind == "cmd":
+            chain.append(CommandHandler(arg, noop))
+        elif kind == "cb":
+            chain.append(CallbackQueryHandler(noop, pattern=arg))
+        else:
+            chain.append(MessageHandler(filters.COMMAND, noop))
+    return chain
+
+def bench_dispatch(bot, n: int) -> dict:
+    """
+    Время выбора обработчика для колбэка (без самого обработчика).
+    Цепочка получает старые длинные callback_data, роутер — новые.
+    Кнопки меню в цепочке не находили обработчика и проверялись до конца.
+    """
+    kinds = [
+        ("choose_style:luna", "st:luna"), ("buy:healing_herb", "b:healing_herb"),
+        ("team_accept:7", "ta:7"), ("team_decline:7", "td:7"),
+        *[(f"{old}:7", f"{new}:7") for old, new in zip(
+            ["profile", "inventory", "fight", "team", "teamup", "leaderboard", "explore", "teamfight"],
+            MENU_PREFIXES,
+        )],
+    ]
+    chain = legacy_callback_chain()
+    router = bot.build_router()
+
+    def run(updates, dispatch):
+        started = time.perf_counter()
+        for _ in range(n // len(updates) + 1):
+            for update in updates:
+                dispatch(update)
+        return (time.perf_counter() - started) / ((n // len(updates) + 1) * len(updates))
+
+    def via_chain(update):
+        for handler in chain:
+            check = handler.check_update(update)
+            if check is not None and check is not False:
+                return handler
+
+    old = [Update.de_json(callback_update(7, data), None) for data, _ in kinds]
+    new = [Update.de_json(callback_update(7, data), None) for _, data in kinds]
+    chain_s = run(old, via_chain)
+    router_s = run(new, router.check_update)
+    return {
+        "updates": n,
+        "chain_ns": round(chain_s * 1e9, 1),
+        "router_ns": round(router_s * 1e9, 1),
+        "speedup": round(chain_s / router_s, 1),
+        "payload_bytes_old": sum(len(d) for d, _ in kinds),
+        "payload_bytes_new": sum(len(d) for _, d in kinds),
+    }
+
+
+# ------------ Прогон ------------
+async def run_bench(bot, args) -> dict:
+    request = RecordingRequest(latency=args.api_latency / 1000)
+    app = bot.build_application(BENCH_TOKEN, request=request)
+
+    rnd = random.Random(args.seed)
+    mix = DEFAULT_MIX if args.scenario == "mix" else {args.scenario: 1}
+    kinds = rnd.choices(list(mix), weights=list(mix.values()), k=args.updates)
+    team_players = 2 * args.teams
+    # у каждого игрока один бой: ходы идут по игрокам подряд, чтобы номер хода совпал
+    duel_ids = itertools.cycle(range(1, max(1, args.battles) + 1))
+    # в рейде игроки тоже идут по кругу: повтор раньше RAID_COOLDOWN — только отказ
+    raid_ids = itertools.cycle(range(1, args.players + 1))
+    payloads = []
+    for kind in kinds:
+        if kind == "teamfight" and team_players:
+            uid = rnd.randint(1, team_players)
+        elif kind == "duel":
+            uid = next(duel_ids)
+        elif kind == "raid":
+            uid = next(raid_ids)
+        else:
+            uid = rnd.randint(1, args.players)
+        payloads.append((kind, SCENARIOS[kind](uid)))
+
+    latencies: dict = {kind: [] for kind in mix}
+    sem = asyncio.Semaphore(args.concurrency)
+
+    async def one(kind, payload):
+        async with sem:
+            update = Update.de_json(payload, app.bot)
+            started = time.perf_counter()
+            await app.process_update(update)
+            latencies[kind].append(time.perf_counter() - started)
+
+    async with app:
+        started = time.perf_counter()
+        await app.post_init(app)
+        startup = time.perf_counter() - started
+        request.calls.clear()
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one(kind, payload) for kind, payload in payloads))
+        elapsed = time.perf_counter() - started
+        await app.post_shutdown(app)
+
+    all_ms = sorted(x * 1000 for values in latencies.values() for x in values)
+    report = {
+        "players": args.players,
+        "updates": args.updates,
+        "concurrency": args.concurrency,
+        "startup_s": round(startup, 3),
+        "elapsed_s": round(elapsed, 3),
+        "updates_per_s": round(args.updates / elapsed, 1),
+        "p50_ms": round(percentile(all_ms, 50), 3),
+        "p95_ms": round(percentile(all_ms, 95), 3),
+        "p99_ms": round(percentile(all_ms, 99), 3),
+        "by_kind": {},
+        "api_calls": dict(sorted(request.calls.items())),
+    }
+    for kind, values in latencies.items():
+        ms = sorted(x * 1000 for x in values)
+        report["by_kind"][kind] = {
+            "n": len(ms),
+            "p50_ms": round(percentile(ms, 50), 3),
+            "p95_ms": round(percentile(ms, 95), 3),
+            "p99_ms": round(percentile(ms, 99), 3),
+        }
+    return report
+
+
+def print_report(report: dict):
+    print(f"игроков: {report['players']}  апдейтов: {report['updates']}  "
+          f"параллельно: {report['concurrency']}  старт: {report['startup_s']} с")
+    print(f"{report['updates_per_s']} апдейтов/с  p50 {report['p50_ms']} мс  "
+          f"p95 {report['p95_ms']} мс  p99 {report['p99_ms']} мс")
+    for kind, r in report["by_kind"].items():
+        print(f"  {kind:<12} n={r['n']:<6} p50 {r['p50_ms']:>8} мс  p95 {r['p95_ms']:>8} мс  p99 {r['p99_ms']:>8} мс")
+    print("вызовы API:", ", ".join(f"{k}={v}" for k, v in report["api_calls"].items()))
+
+
+def parse_args(argv=None):
+    ap = argparse.ArgumentParser(description="Нагрузочный прогон обработчиков бота")
+    ap.add_argument("--players", type=int, default=10000, help="игроков в таблице players")
+    ap.add_argument("--teams", type=int, default=None, help="команд по двое (по умолчанию players/10)")
+    ap.add_argument("--updates", type=int, default=5000)
+    ap.add_argument("--concurrency", type=int, default=64)
+    ap.add_argument("--scenario", default="mix", choices=["mix", *SCENARIOS])
+    ap.add_argument("--api-latency", type=float, default=0.0, help="задержка заглушки Telegram, мс")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--db", default=None, help="путь к базе (по умолчанию временный файл)")
+    ap.add_argument("--json", action="store_true", help="вывести отчёт в JSON")
+    ap.add_argument("--metrics", action="store_true", help="после отчёта вывести /metrics")
+    ap.add_argument("--max-p95", type=float, default=None, help="порог p95 в мс для CI")
+    ap.add_argument("--dispatch", action="store_true", help="только замер разбора колбэков")
+    ap.add_argument("--battles", type=int, default=None,
+                    help="идущих пошаговых боёв (по умолчанию у всех игроков в сценарии duel)")
+    args = ap.parse_args(argv)
+    if args.battles is None:
+        args.battles = args.players if args.scenario == "duel" else 0
+    args.battles = min(args.battles, args.players)
+    if args.teams is None:
+        args.teams = args.players // 10
+    args.teams = min(args.teams, args.players // 2)
+    return args
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    tmpdir = None
+    if args.db is None:
+        tmpdir = tempfile.TemporaryDirectory(prefix="sailor-bench-")
+        args.db = os.path.join(tmpdir.name, "bench.db")
+
+    # sailor_bot читает DB_PATH при импорте
+    os.environ["DB_PATH"] = args.db
+    os.environ.setdefault("BOT_TOKEN", BENCH_TOKEN)
+    os.environ.setdefault("BATTLE_SEED", str(args.seed))
+    import sailor_bot as bot
+
+    if args.dispatch:
+        report = bench_dispatch(bot, args.updates)
+        print(json.dumps(report, ensure_ascii=False, indent=2) if args.json else
+              f"цепочка: {report['chain_ns']} нс  роутер: {report['router_ns']} нс  "
+              f"(×{report['speedup']})  callback_data: {report['payload_bytes_old']} → "
+              f"{report['payload_bytes_new']} байт")
+        return 0
+
+    # схема и миграции — как при обычном старте, затем синтетические данные
+    async def prepare():
+        await bot.init_db()
+        await bot.close_db()
+    asyncio.run(prepare())
+    populate(args.db, args.players, args.teams, list(bot.STYLES), args.battles, args.scenario == "raid")
+
+    report = asyncio.run(run_bench(bot, args))
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
+    if args.metrics:
+        print(bot.metrics.render())
+    if tmpdir is not None:
+        tmpdir.cleanup()
+    if args.max_p95 is not None and report["p95_ms"] > args.max_p95:
+        print(f"p95 {report['p95_ms']} мс превышает порог {args.max_p95} мс", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,191 @@
+"""
+Примитивы конкурентности: блокировки по ключу, token bucket,
+ограничение частоты и склейка повторных апдейтов.
+"""
+
+import asyncio
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+
+class KeyedLocks:
+    """
+    Набор asyncio-блокировок по ключу (обычно user_id).
+
+    Обновления одного игрока выполняются по очереди, разных — параллельно.
+    Несколько ключей берутся в отсортированном порядке, поэтому
+    одновременные hold(a, b) и hold(b, a) не приводят к взаимоблокировке.
+    Запись о ключе живёт, пока есть владелец или ожидающие, потом удаляется.
+    """
+
+    def __init__(self):
+        self._locks: dict = {}  # key -> [asyncio.Lock, владельцы + ожидающие]
+        self.acquired = 0
+        self.contended = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def __len__(self):
+        return len(self._locks)
+
+    async def _acquire(self, key):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        lock = entry[0]
+        contended = lock.locked()
+        started = time.perf_counter()
+        try:
+            # и свободный замок может отдать управление: после release он
+            # сначала достаётся разбуженному ожидающему
+            await lock.acquire()
+        except BaseException:
+            # отменённый ожидающий не должен держать запись о ключе вечно
+            self._drop(key, entry)
+            raise
+        self.acquired += 1
+        if contended:
+            waited = time.perf_counter() - started
+            self.contended += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+
+    def _release(self, key):
+        entry = self._locks[key]
+        entry[0].release()
+        self._drop(key, entry)
+
+    def _drop(self, key, entry):
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self._locks[key]
+
+    @asynccontextmanager
+    async def hold(self, *keys):
+        taken = []
+        try:
+            for key in sorted(set(keys)):
+                await self._acquire(key)
+                taken.append(key)
+            yield
+        finally:
+            for key in reversed(taken):
+                self._release(key)
+
+    def stats(self) -> dict:
+        return {
+            "active_keys": len(self._locks),
+            "acquired": self.acquired,
+            "contended": self.contended,
+            "wait_seconds_total": self.wait_total,
+            "wait_seconds_max": self.wait_max,
+        }
+
+
+class TokenBucket:
+    """
+    Классический token bucket: rate токенов в секунду, не больше capacity.
+    take() не ждёт сам, а говорит, сколько подождать, — так его можно
+    использовать и со sleep, и с call_later.
+    """
+
+    __slots__ = ("rate", "capacity", "tokens", "stamp")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def take(self, n: float = 1.0) -> float:
+        """Забирает n токенов и возвращает 0 или, если их нет, сколько секунд ждать."""
+        now = time.monotonic()
+        self._refill(now)
+        if self.tokens >= n:
+            self.tokens -= n
+            return 0.0
+        return (n - self.tokens) / self.rate
+
+    def full(self) -> bool:
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity
+
+
+class Throttle:
+    """
+    Token bucket на каждый ключ (обычно user_id): rate апдейтов в секунду,
+    всплеск до burst. Ведра хранятся в LRU на max_keys ключей — давно
+    молчавший игрок вытесняется первым, а его ведро и так было полным.
+    """
+
+    def __init__(self, rate: float, burst: float, max_keys: int = 100_000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets: OrderedDict = OrderedDict()  # key -> TokenBucket
+        self._warned: set = set()
+        self.allowed = 0
+        self.rejected = 0
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def hit(self, key) -> float:
+        """0 — пропустить апдейт, иначе через сколько секунд появится токен."""
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.rate, self.burst)
+            if len(self._buckets) > self.max_keys:
+                old, _ = self._buckets.popitem(last=False)
+                self._warned.discard(old)
+        else:
+            self._buckets.move_to_end(key)
+        wait = bucket.take()
+        if wait:
+            self.rejected += 1
+        else:
+            self.allowed += 1
+            self._warned.discard(key)
+        return wait
+
+    def should_warn(self, key) -> bool:
+        """True один раз за серию отказов: предупреждение не тратит квоту на каждый отказ."""
+        if key in self._warned:
+            return False
+        self._warned.add(key)
+        return True
+
+
+class Coalescer:
+    """
+    Ключи апдейтов, которые сейчас обрабатываются. Пока обработка не
+    завершилась, такой же апдейт (тот же игрок, та же команда) не нужен —
+    он склеивается с первым. ttl страхует от ключа, который не был снят
+    (например, задачу отменили): по истечении ключ снова свободен.
+    """
+
+    def __init__(self, ttl: float = 30.0):
+        self.ttl = ttl
+        self._active: dict = {}  # key -> monotonic-срок
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._active)
+
+    def enter(self, key) -> bool:
+        now = time.monotonic()
+        deadline = self._active.get(key)
+        if deadline is not None and deadline > now:
+            self.coalesced += 1
+            return False
+        self._active[key] = now + self.ttl
+        return True
+
+    def leave(self, key):
+        self._active.pop(key, None)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Разовый перенос игроков и команд из SQLite в PostgreSQL перед тем, как
+включить DATABASE_URL: без него бот на сервере стартует с пустой базой.
+
+Переносятся players (вместе с версиями), inventory, teams и team_members —
+то, что с DATABASE_URL живёт на сервере (см. postgres.py). Остальные
+таблицы остаются в локальной SQLite. Схема на сервере создаётся теми же
+миграциями, что и при старте бота; в непустую базу скрипт не пишет.
+
+Пример (бот остановлен):
+    python copy_to_postgres.py /data/sailor.db postgresql://bot@db/sailor
+"""
+
+import argparse
+import asyncio
+import os
+import sqlite3
+import sys
+from urllib.parse import quote
+
+from postgres import PgDatabase, init_postgres
+from repos import PLAYER_COLUMNS
+
+# таблица -> колонки; порядок — как у вставки
+TABLES = {
+    "players": PLAYER_COLUMNS + ("version",),
+    "inventory": ("user_id", "item_key", "qty"),
+    "teams": ("team_id", "leader_id", "active"),
+    "team_members": ("team_id", "user_id"),
+}
+
+
+def read_tables(path: str) -> dict:
+    conn = sqlite3.connect(f"file:{quote(os.path.abspath(path))}?mode=ro", uri=True)
+    try:
+        return {
+            table: conn.execute(f"SELECT {', '.join(cols)} FROM {table}").fetchall()
+            for table, cols in TABLES.items()
+        }
+    finally:
+        conn.close()
+
+
+async def _copy(conn, data: dict) -> bool:
+    if await conn.fetchval("SELECT EXISTS (SELECT 1 FROM players) OR EXISTS (SELECT 1 FROM teams)"):
+        return False
+    for table, cols in TABLES.items():
+        if data[table]:
+            await conn.copy_records_to_table(table, records=data[table], columns=cols)
+    # новые команды получат номера после перенесённых
+    await conn.execute("SELECT setval(pg_get_serial_sequence('teams', 'team_id'), max(team_id)) FROM teams")
+    return True
+
+
+async def copy(path: str, dsn: str) -> dict | None:
+    """Число перенесённых строк по таблицам или None, если на сервере уже есть данные."""
+    data = read_tables(path)
+    db = PgDatabase(dsn, max_size=1)
+    try:
+        await init_postgres(db)
+        if not await db.transaction(_copy, data):
+            return None
+    finally:
+        await db.close()
+    return {table: len(rows) for table, rows in data.items()}
+
+
+def parse_args(argv=None):
+    ap = argparse.ArgumentParser(description="Перенос игроков и команд из SQLite в PostgreSQL")
+    ap.add_argument("db", help="файл SQLite (DB_PATH)")
+    ap.add_argument("dsn", nargs="?", default=os.getenv("DATABASE_URL"),
+                    help="postgresql://… (по умолчанию DATABASE_URL)")
+    return ap.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    if not args.dsn:
+        print("Не задан адрес PostgreSQL: аргумент dsn или DATABASE_URL", file=sys.stderr)
+        return 2
+    counts = asyncio.run(copy(args.db, args.dsn))
+    if counts is None:
+        print("В PostgreSQL уже есть игроки или команды — перенос не выполнен", file=sys.stderr)
+        return 1
+    print(", ".join(f"{table}: {n}" for table, n in counts.items()))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
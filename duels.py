@@ -0,0 +1,156 @@
+"""
+Пошаговые бои, которые ещё идут (/battle).
+
+Состояние боя — battle.Duel в памяти; таблица battles — его контрольная
+точка на случай перезапуска. Точка снимается только на границе хода
+(start, save, finish) и уходит в базу пачкой по таймеру (flush), так что
+ход — это поиск и запись в словаре, сколько бы боёв ни шло одновременно.
+Брошенные бои удаляются по сроку (purge).
+
+С несколькими воркерами (shared=True) следующий ход может прийти в другой
+процесс: тогда бой читается из базы на каждом ходу и пишется сразу,
+с проверкой номера хода — двойное нажатие проходит ровно один раз.
+"""
+
+import struct
+import time
+
+from battle import Duel
+from repos import register_migration
+from storage import StaleWrite
+
+MIGRATE_BATTLES = """
+CREATE TABLE IF NOT EXISTS battles (
+    user_id INTEGER PRIMARY KEY,
+    turn INTEGER NOT NULL,
+    expires_at REAL NOT NULL,
+    state BLOB NOT NULL -- STATE: индекс монстра, HP монстра, HP игрока
+);
+CREATE INDEX IF NOT EXISTS idx_battles_expires ON battles(expires_at)
+"""
+register_migration(11, MIGRATE_BATTLES)
+
+STATE = struct.Struct("<Hhh")
+
+SQL_SELECT = "SELECT user_id, turn, expires_at, state FROM battles"
+SQL_UPSERT = "INSERT OR REPLACE INTO battles (user_id, turn, expires_at, state) VALUES (?, ?, ?, ?)"
+
+
+def _row(d: Duel) -> tuple:
+    return (d.user_id, d.turn, d.expires_at, STATE.pack(d.monster, d.monster_hp, d.hp))
+
+def _from_row(row) -> Duel:
+    user_id, turn, expires_at, state = row
+    return Duel(user_id, *STATE.unpack(state), turn, expires_at)
+
+
+class DuelRegistry:
+    def __init__(self, db, ttl: float = 600.0, shared: bool = False):
+        self.db = db
+        self.ttl = ttl  # срок боя без ходов
+        self.shared = shared
+        self._items: dict = {}  # user_id -> Duel
+        self._dirty: dict = {}  # user_id -> строка для battles
+        self._finished: set = set()  # user_id, чьи строки надо удалить
+        self.started = 0
+        self.finished: dict = {}  # исход -> боёв
+        self.expired = 0
+        self.checkpoints = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    async def load(self):
+        if self.shared:
+            return
+        rows = await self.db.fetchall(SQL_SELECT + " WHERE expires_at > ?", (time.time(),))
+        self._items = {row[0]: _from_row(row) for row in rows}
+        self._dirty.clear()
+        self._finished.clear()
+
+    async def get(self, user_id: int) -> Duel | None:
+        if self.shared:
+            row = await self.db.fetchone(SQL_SELECT + " WHERE user_id = ? AND expires_at > ?", (user_id, time.time()))
+            return _from_row(row) if row else None
+        d = self._items.get(user_id)
+        if d is not None and d.expires_at <= time.time():
+            return None
+        return d
+
+    async def start(self, d: Duel):
+        """Новый бой игрока; истёкший старый, если был, заменяется."""
+        d.expires_at = time.time() + self.ttl
+        if self.shared:
+            await self.db.execute(SQL_UPSERT, _row(d))
+        else:
+            self._items[d.user_id] = d
+            self._checkpoint(d)
+        self.started += 1
+
+    async def save(self, d: Duel):
+        """Конец хода: duel_turn уже увеличил d.turn."""
+        d.expires_at = time.time() + self.ttl
+        if not self.shared:
+            self._checkpoint(d)
+            return
+        changed = await self.db.execute(
+            "UPDATE battles SET turn = ?, expires_at = ?, state = ? WHERE user_id = ? AND turn = ?",
+            (*_row(d)[1:], d.user_id, d.turn - 1),
+        )
+        if not changed:
+            raise StaleWrite("battles", [d.user_id])
+
+    async def finish(self, d: Duel, outcome: str):
+        """Бой окончен на последнем ходу; награды — после этого вызова."""
+        if self.shared:
+            removed = await self.db.execute(
+                "DELETE FROM battles WHERE user_id = ? AND turn = ?", (d.user_id, d.turn - 1),
+            )
+            if not removed:
+                raise StaleWrite("battles", [d.user_id])
+        else:
+            self._items.pop(d.user_id, None)
+            self._dirty.pop(d.user_id, None)
+            self._finished.add(d.user_id)
+        self.finished[outcome] = self.finished.get(outcome, 0) + 1
+
+    def _checkpoint(self, d: Duel):
+        # снимок на границе хода: следующие ходы его уже не меняют
+        self._dirty[d.user_id] = _row(d)
+        self._finished.discard(d.user_id)
+
+    async def flush(self) -> int:
+        """Пишет накопленные контрольные точки одной транзакцией."""
+        if not self._dirty and not self._finished:
+            return 0
+        rows, self._dirty = list(self._dirty.values()), {}
+        gone, self._finished = list(self._finished), set()
+        try:
+            await self.db.transaction(_write_checkpoints, rows, gone)
+        except BaseException:
+            # вернуть неотправленное, не затирая то, что случилось после
+            for row in rows:
+                if row[0] not in self._finished:
+                    self._dirty.setdefault(row[0], row)
+            for user_id in gone:
+                if user_id not in self._dirty:
+                    self._finished.add(user_id)
+            raise
+        self.checkpoints += len(rows)
+        return len(rows) + len(gone)
+
+    async def purge(self) -> int:
+        """Удаляет брошенные бои из памяти и базы."""
+        now = time.time()
+        stale = [uid for uid, d in self._items.items() if d.expires_at <= now]
+        for uid in stale:
+            del self._items[uid]
+            self._dirty.pop(uid, None)
+        removed = await self.db.execute("DELETE FROM battles WHERE expires_at <= ?", (now,))
+        self.expired += removed if self.shared else len(stale)
+        return removed
+
+
+def _write_checkpoints(conn, rows, gone):
+    conn.executemany("DELETE FROM battles WHERE user_id = ?", [(uid,) for uid in gone])
+    conn.executemany(SQL_UPSERT, rows)
@@ -0,0 +1,75 @@
+"""
+Игровые данные: стихии, предметы, монстры, уровни и индексы по ним.
+Модуль не зависит от Telegram и базы — его читают и бот, и battle.py
+при офлайн-расчёте баланса.
+"""
+
+STYLES = {
+    "luna": {"name": "Сейлор Мун 🌙", "hp_base": 30, "atk_base": 3, "img": "https://i.pinimg.com/1200x/6a/02/19/6a0219632e0cf643b21a15f134ba79c4.jpg" },
+    "fire": {"name": "Сейлор Марс 🔥", "hp_base": 26, "atk_base": 5, "img": "https://i.pinimg.com/736x/38/ee/d2/38eed255dd4c9895304dfe7aa03fda0e.jpg"},
+    "jupiter": {"name": "Сейлор Юпитер ⚡", "hp_base": 34, "atk_base": 4, "img": "https://i.pinimg.com/736x/b8/f7/ba/b8f7ba5311e3d8acea0834aedbf5dda6.jpg"},
+    "water": {"name": "Сейлор Меркурий 💧", "hp_base": 32, "atk_base": 3, "img": "https://i.pinimg.com/736x/b1/61/1a/b1611addcf1190d311218c22614e1e36.jpg"},
+    "love": {"name": "Сейлор Венера 💖", "hp_base": 28, "atk_base": 4, "img": "https://i.pinimg.com/736x/91/c1/f6/91c1f699cc6764e6dd2af9b660d709ba.jpg"},
+}
+
+ITEMS = {
+    "luna_brooch": {"title": "Лунная брошь", "desc": "Небольшой бонус к атаке", "price": 50, "atk": 2},
+    "healing_herb": {"title": "Лунный эликсир", "desc": "Восстанавливает энергию/HP", "price": 30, "heal": 10},
+    "moon_crystal": {"title": "Лунный кристалл", "desc": "Редкий ресурс для трансформаций", "price": 0, "rare": True},
+}
+
+MONSTERS = [
+    {"id": "m1", "name": "Слабый демон", "lvl": 1, "hp": 8, "atk": 2, "reward_xp": 10, "reward_gold": 10},
+    {"id": "m2", "name": "Средний демон", "lvl": 2, "hp": 14, "atk": 3, "reward_xp": 18, "reward_gold": 18},
+    {"id": "m3", "name": "Сильный демон", "lvl": 3, "hp": 22, "atk": 5, "reward_xp": 35, "reward_gold": 40},
+    {"id": "m4", "name": "Сильный демон", "lvl": 4, "hp": 30, "atk": 7, "reward_xp": 45, "reward_gold": 50},
+
+    {"id": "boss1", "name": "👾 БОСС: Джедайт", "lvl": 5, "hp": 50, "atk": 8, "reward_xp": 120, "reward_gold": 120},
+    {"id": "boss2", "name": "👾 БОСС: Нефрит", "lvl": 10, "hp": 60, "atk": 9, "reward_xp": 120, "reward_gold": 120},
+    {"id": "boss3", "name": "👾 БОСС: Зойсайт", "lvl": 15, "hp": 70, "atk": 10, "reward_xp": 120, "reward_gold": 120},
+    {"id": "boss4", "name": "👾 БОСС: Кунсайт", "lvl": 20, "hp": 80, "atk": 20, "reward_xp": 120, "reward_gold": 120},
+
+    {"id": "boss5", "name": "👾 БОСС: Петсайт", "lvl": 5, "hp": 50, "atk": 8, "reward_xp": 120, "reward_gold": 120},
+    {"id": "boss6", "name": "👾 БОСС: Калаверайт", "lvl": 10, "hp": 60, "atk": 9, "reward_xp": 120, "reward_gold": 120},
+    {"id": "boss7", "name": "👾 БОСС: Бертерайт", "lvl": 15, "hp": 70, "atk": 10, "reward_xp": 120, "reward_gold": 120},
+    {"id": "boss8", "name": "👾 БОСС: Кермисайт", "lvl": 20, "hp": 80, "atk": 20, "reward_xp": 120, "reward_gold": 120},
+
+    {"id": "superboss1", "name": "👹💥 СУПЕРБОСС: Королева Погибель", "lvl": 50, "hp": 90, "atk": 20, "reward_xp": 200, "reward_gold": 200},
+    {"id": "superboss2", "name": "👹💥 СУПЕРБОСС: Рубеус", "lvl": 50, "hp": 90, "atk": 20, "reward_xp": 200, "reward_gold": 200},
+    {"id": "superboss3", "name": "👹💥 СУПЕРБОСС: Изумруд", "lvl": 50, "hp": 90, "atk": 20, "reward_xp": 200, "reward_gold": 200},
+    {"id": "superboss4", "name": "👹💥 СУПЕРБОСС: Мудрец", "lvl": 50, "hp": 90, "atk": 20, "reward_xp": 200, "reward_gold": 200},
+
+
+
+]
+
+LEVELS = [
+    (0, "Сейлор-новичок"),
+    (50, "Сейлор-защитник"),
+    (150, "Сейлор-воительница"),
+    (350, "Лунная принцесса"),
+    (700, "Лунная королева"),
+]
+
+DAILY_EXP_BONUS = 5
+MAX_ENERGY = 5
+ENERGY_REGEN_SECONDS = 3600  # одна единица энергии в час
+# прибавка к max_hp и атаке за каждый новый уровень
+LEVEL_UP_HP = 5
+LEVEL_UP_ATK = 1
+
+# ------------ Производные данные (строятся один раз при импорте) ------------
+# Горячие пути (бой, уровни) не пересобирают эти структуры на каждый вызов.
+MAX_MONSTER_LVL = max(m["lvl"] for m in MONSTERS)
+
+# MONSTER_POOLS[n] — монстры с lvl <= n; бой берёт пул по уровню игрока
+MONSTER_POOLS = [
+    tuple(m for m in MONSTERS if m["lvl"] <= n) for n in range(MAX_MONSTER_LVL + 1)
+]
+BOSSES = tuple(m for m in MONSTERS if m["id"].startswith("boss"))
+SUPER_BOSSES = tuple(m for m in MONSTERS if m["id"].startswith("superboss"))
+
+LEVEL_THRESHOLDS = [req for req, _ in LEVELS]
+
+def monster_pool_for(lvl: int) -> tuple:
+    return MONSTER_POOLS[min(MAX_MONSTER_LVL, max(1, lvl + 1))]
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+"""
+Журнал игровых событий: бои, покупки, ежедневные награды, предметы,
+командные награды. Таблица game_log только дописывается.
+
+Событие — (seq, время, user_id, вид, data), где data — JSON:
+  set — значения изменённых полей игрока после события (всегда с gold);
+  dg  — на сколько событие должно было изменить золото;
+  остальное — подробности (предмет, монстр, цена).
+Поля в set — итоговые значения, а не разницы: свёртка событий по порядку
+seq даёт состояние игрока, повторное применение ничего не ломает.
+
+Обработчики только кладут событие в буфер (record), в базу буфер уходит
+одной транзакцией по таймеру (flush). Снимки player_snapshots — свёртка
+журнала по игрокам до отметки game_log_snapshot.seq; они дописываются
+порциями (build_snapshots), поэтому восстановление не читает весь журнал.
+
+Таблица players остаётся основным хранилищем: журнал нужен для аудита
+и восстановления. Утилита (бот при этом должен быть остановлен):
+    python gamelog.py snapshot /data/sailor.db
+    python gamelog.py replay /data/sailor.db [--upto SEQ] [--dry-run]
+    python gamelog.py audit /data/sailor.db [--user ID]
+"""
+
+import argparse
+import json
+import sqlite3
+import sys
+import time
+
+from repos import register_migration
+
+MIGRATE_GAME_LOG = """
+CREATE TABLE IF NOT EXISTS game_log (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    ts REAL NOT NULL,
+    user_id INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_game_log_user ON game_log(user_id, seq);
+CREATE TABLE IF NOT EXISTS player_snapshots (
+    user_id INTEGER PRIMARY KEY,
+    seq INTEGER NOT NULL,
+    state TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS game_log_snapshot (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    seq INTEGER NOT NULL
+)
+"""
+register_migration(10, MIGRATE_GAME_LOG)
+
+SQL_APPEND = "INSERT INTO game_log (ts, user_id, kind, data) VALUES (?, ?, ?, ?)"
+
+
+class GameLog:
+    def __init__(self, db):
+        self.db = db
+        self._buffer: list = []
+        self.recorded = 0
+        self.written = 0
+        self.folded = 0
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def record(self, kind: str, user_id: int, state: dict, **info):
+        """state — значения полей после события; сериализуется сразу."""
+        data = json.dumps({"set": state, **info}, ensure_ascii=False, separators=(",", ":"))
+        self._buffer.append((time.time(), user_id, kind, data))
+        self.recorded += 1
+
+    async def flush(self) -> int:
+        if not self._buffer:
+            return 0
+        rows, self._buffer = self._buffer, []
+        try:
+            await self.db.executemany(SQL_APPEND, rows)
+        except BaseException:
+            # порядок сохраняем: неотправленные — перед новыми
+            self._buffer[:0] = rows
+            raise
+        self.written += len(rows)
+        return len(rows)
+
+    async def snapshot(self, limit: int = 5000) -> int:
+        """Сворачивает в снимки до limit событий после отметки."""
+        folded = await self.db.transaction(build_snapshots, limit)
+        self.folded += folded
+        return folded
+
+
+# ------------ Свёртка (общая для бота и утилиты) ------------
+def snapshot_seq(conn) -> int:
+    row = conn.execute("SELECT seq FROM game_log_snapshot WHERE id = 1").fetchone()
+    return row[0] if row else 0
+
+def _chunks(seq, size: int = 500):
+    seq = list(seq)
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
+
+def load_snapshots(conn, user_ids) -> dict:
+    states = {}
+    for part in _chunks(user_ids):
+        marks = ",".join("?" * len(part))
+        for uid, state in conn.execute(
+            f"SELECT user_id, state FROM player_snapshots WHERE user_id IN ({marks})", part,
+        ):
+            states[uid] = json.loads(state)
+    return states
+
+def build_snapshots(conn, limit: int) -> int:
+    """В открытой транзакции: следующие limit событий — в player_snapshots."""
+    after = snapshot_seq(conn)
+    rows = conn.execute(
+        "SELECT seq, user_id, data FROM game_log WHERE seq > ? ORDER BY seq LIMIT ?", (after, limit),
+    ).fetchall()
+    if not rows:
+        return 0
+    states = load_snapshots(conn, {uid for _, uid, _ in rows})
+    last = {}
+    for seq, uid, data in rows:
+        states.setdefault(uid, {}).update(json.loads(data)["set"])
+        last[uid] = seq
+    conn.executemany(
+        "INSERT OR REPLACE INTO player_snapshots (user_id, seq, state) VALUES (?, ?, ?)",
+        [(uid, seq, json.dumps(states[uid], ensure_ascii=False, separators=(",", ":"))) for uid, seq in last.items()],
+    )
+    conn.execute("INSERT OR REPLACE INTO game_log_snapshot (id, seq) VALUES (1, ?)", (rows[-1][0],))
+    return len(rows)
+
+def fold_log(conn, upto: int | None = None) -> dict:
+    """Состояния игроков по журналу с нуля (без снимков), до seq включительно."""
+    sql, params = "SELECT user_id, data FROM game_log", ()
+    if upto is not None:
+        sql, params = sql + " WHERE seq <= ?", (upto,)
+    states = {}
+    for uid, data in conn.execute(sql + " ORDER BY seq", params):
+        states.setdefault(uid, {}).update(json.loads(data)["set"])
+    return states
+
+
+# ------------ Утилита ------------
+def _connect(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+    conn.execute("PRAGMA busy_timeout=5000")
+    return conn
+
+def _transaction(conn, fn, *args):
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        result = fn(conn, *args)
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+    return result
+
+def snapshot_all(conn, batch: int = 50000) -> int:
+    total = 0
+    while True:
+        n = _transaction(conn, build_snapshots, batch)
+        if not n:
+            return total
+        total += n
+
+def _write_players(conn, states: dict, columns: tuple) -> tuple:
+    updated, skipped = 0, 0
+    for uid, state in states.items():
+        cols = [c for c in columns if c in state and c != "user_id"]
+        exists = conn.execute("SELECT 1 FROM players WHERE user_id = ?", (uid,)).fetchone()
+        if exists:
+            sets = ", ".join(f"{c} = ?" for c in cols)
+            conn.execute(
+                f"UPDATE players SET {sets + ', ' if sets else ''}version = version + 1 WHERE user_id = ?",
+                [state[c] for c in cols] + [uid],
+            )
+        elif len(cols) == len(columns) - 1:
+            conn.execute(
+                f"INSERT INTO players (user_id, {', '.join(cols)}) VALUES (?{', ?' * len(cols)})",
+                [uid] + [state[c] for c in cols],
+            )
+        else:
+            # игрок появился до журнала и целиком в нём не записан
+            skipped += 1
+            continue
+        if "inventory" in state:
+            conn.execute("DELETE FROM inventory WHERE user_id = ?", (uid,))
+            conn.executemany(
+                "INSERT INTO inventory (user_id, item_key, qty) VALUES (?, ?, ?)",
+                [(uid, key, qty) for key, qty in state["inventory"].items() if qty > 0],
+            )
+        updated += 1
+    return updated, skipped
+
+def replay(conn, upto: int | None = None, dry_run: bool = False) -> dict:
+    """
+    Переписывает players (и inventory) состояниями из журнала: по снимкам,
+    или с нуля до upto. Поля, которых в журнале нет, не трогаются.
+    """
+    from repos import PLAYER_COLUMNS
+
+    if upto is None:
+        snapshot_all(conn)
+        states = {uid: json.loads(s) for uid, s in conn.execute("SELECT user_id, state FROM player_snapshots")}
+    else:
+        states = fold_log(conn, upto)
+    if dry_run:
+        differ = 0
+        for uid, state in states.items():
+            cols = [c for c in PLAYER_COLUMNS if c in state and c != "user_id"]
+            if not cols:
+                continue
+            row = conn.execute(f"SELECT {', '.join(cols)} FROM players WHERE user_id = ?", (uid,)).fetchone()
+            if row is None or list(row) != [state[c] for c in cols]:
+                differ += 1
+        return {"players": len(states), "differ": differ}
+    updated, skipped = _transaction(conn, _write_players, states, PLAYER_COLUMNS)
+    return {"players": len(states), "updated": updated, "skipped": skipped}
+
+def audit(conn, user_id: int | None = None) -> list:
+    """
+    События, после которых золото разошлось с объявленным изменением dg:
+    [(seq, user_id, kind, было, dg, стало)]. Так видны потерянные
+    обновления, например две покупки, записавшие одно и то же золото.
+    """
+    sql, params = "SELECT seq, user_id, kind, data FROM game_log", ()
+    if user_id is not None:
+        sql, params = sql + " WHERE user_id = ?", (user_id,)
+    gold, bad = {}, []
+    for seq, uid, kind, data in conn.execute(sql + " ORDER BY seq", params):
+        event = json.loads(data)
+        after = event["set"].get("gold")
+        before = gold.get(uid)
+        if before is not None and after is not None and "dg" in event and before + event["dg"] != after:
+            bad.append((seq, uid, kind, before, event["dg"], after))
+        if after is not None:
+            gold[uid] = after
+    return bad
+
+
+def parse_args(argv=None):
+    ap = argparse.ArgumentParser(description="Журнал игровых событий: снимки, восстановление, аудит")
+    sub = ap.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("snapshot", help="свернуть журнал в снимки до конца")
+    p.add_argument("db")
+    p = sub.add_parser("replay", help="переписать players по журналу")
+    p.add_argument("db")
+    p.add_argument("--upto", type=int, help="состояние на момент seq (с нуля, без снимков)")
+    p.add_argument("--dry-run", action="store_true", help="только посчитать расхождения")
+    p = sub.add_parser("audit", help="найти расхождения золота с событиями")
+    p.add_argument("db")
+    p.add_argument("--user", type=int)
+    return ap.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    conn = _connect(args.db)
+    try:
+        if args.command == "snapshot":
+            print(f"событий свёрнуто: {snapshot_all(conn)}, отметка seq={snapshot_seq(conn)}")
+        elif args.command == "replay":
+            print(replay(conn, args.upto, args.dry_run))
+        else:
+            bad = audit(conn, args.user)
+            for seq, uid, kind, before, dg, after in bad:
+                print(f"seq={seq} user={uid} {kind}: было {before}, dg {dg:+d}, стало {after} (ждали {before + dg})")
+            print(f"расхождений: {len(bad)}")
+            return 1 if bad else 0
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,150 @@
+"""
+Приглашения в команду, ожидающие ответа.
+
+Кнопки «Принять/Отклонить» несут только invite_id: кто пригласил и кого,
+знает реестр, а не callback_data. Приглашение можно принять или отклонить
+ровно один раз — повторное нажатие ничего не создаёт. Пара
+(лидер, приглашённый) имеет не больше одного живого приглашения.
+
+Реестр держит приглашения в памяти и пишет их в локальную SQLite, поэтому
+они переживают перезапуск. С несколькими воркерами (shared=True)
+приглашение мог создать другой процесс: тогда решает база — удаление
+строки с RETURNING срабатывает ровно у одного нажатия.
+"""
+
+import time
+from dataclasses import dataclass
+
+from repos import register_migration
+
+MIGRATE_TEAM_INVITES = """
+CREATE TABLE IF NOT EXISTS team_invites (
+    invite_id INTEGER PRIMARY KEY AUTOINCREMENT, -- номера не переиспользуются: старые кнопки не оживут
+    leader_id INTEGER NOT NULL,
+    target_id INTEGER NOT NULL,
+    expires_at REAL NOT NULL,
+    UNIQUE (leader_id, target_id)
+);
+CREATE INDEX IF NOT EXISTS idx_team_invites_expires ON team_invites(expires_at)
+"""
+register_migration(9, MIGRATE_TEAM_INVITES)
+
+
+@dataclass
+class Invite:
+    invite_id: int
+    leader_id: int
+    target_id: int
+    expires_at: float  # unix-время
+
+
+class InviteRegistry:
+    def __init__(self, db, ttl: float = 86400.0, shared: bool = False):
+        self.db = db
+        self.ttl = ttl
+        self.shared = shared
+        self._items: dict = {}  # invite_id -> Invite
+        self._pairs: dict = {}  # (leader_id, target_id) -> invite_id
+        self.created = 0
+        self.accepted = 0
+        self.declined = 0
+        self.expired = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    async def load(self):
+        rows = await self.db.fetchall(
+            "SELECT invite_id, leader_id, target_id, expires_at FROM team_invites WHERE expires_at > ?",
+            (time.time(),),
+        )
+        self._items.clear()
+        self._pairs.clear()
+        for row in rows:
+            self._remember(Invite(*row))
+
+    def _remember(self, inv: Invite):
+        self._items[inv.invite_id] = inv
+        self._pairs[(inv.leader_id, inv.target_id)] = inv.invite_id
+
+    def _forget(self, inv: Invite):
+        self._items.pop(inv.invite_id, None)
+        if self._pairs.get((inv.leader_id, inv.target_id)) == inv.invite_id:
+            del self._pairs[(inv.leader_id, inv.target_id)]
+
+    def pending(self, leader_id: int, target_id: int) -> Invite | None:
+        inv = self._items.get(self._pairs.get((leader_id, target_id)))
+        if inv is not None and inv.expires_at <= time.time():
+            return None
+        return inv
+
+    async def create(self, leader_id: int, target_id: int) -> Invite | None:
+        """Новое приглашение или None, если такое же ещё ждёт ответа."""
+        if self.pending(leader_id, target_id) is not None:
+            return None
+        now = time.time()
+        invite_id = await self.db.transaction(_create_invite, leader_id, target_id, now, now + self.ttl)
+        if invite_id is None:
+            # живое приглашение есть в базе — его создал другой воркер
+            return None
+        inv = Invite(invite_id, leader_id, target_id, now + self.ttl)
+        self._remember(inv)
+        self.created += 1
+        return inv
+
+    async def _take(self, invite_id: int, target_id: int) -> Invite | None:
+        inv = self._items.get(invite_id)
+        if inv is None and not self.shared:
+            return None
+        if inv is not None:
+            if inv.target_id != target_id:
+                return None
+            self._forget(inv)
+        row = await self.db.transaction(_take_invite, invite_id, target_id, time.time())
+        if row is None:
+            return None
+        return Invite(invite_id, row[0], target_id, row[1])
+
+    async def accept(self, invite_id: int, target_id: int) -> Invite | None:
+        """Забирает приглашение для target_id; None — его нет, истекло или уже отвечено."""
+        inv = await self._take(invite_id, target_id)
+        if inv is not None:
+            self.accepted += 1
+        return inv
+
+    async def decline(self, invite_id: int, target_id: int) -> Invite | None:
+        inv = await self._take(invite_id, target_id)
+        if inv is not None:
+            self.declined += 1
+        return inv
+
+    async def purge(self) -> int:
+        """Удаляет истёкшие приглашения из памяти и базы."""
+        now = time.time()
+        for inv in [inv for inv in self._items.values() if inv.expires_at <= now]:
+            self._forget(inv)
+        removed = await self.db.execute("DELETE FROM team_invites WHERE expires_at <= ?", (now,))
+        self.expired += removed
+        return removed
+
+
+def _create_invite(conn, leader_id, target_id, now, expires_at):
+    conn.execute(
+        "DELETE FROM team_invites WHERE leader_id = ? AND target_id = ? AND expires_at <= ?",
+        (leader_id, target_id, now),
+    )
+    cur = conn.execute(
+        "INSERT OR IGNORE INTO team_invites (leader_id, target_id, expires_at) VALUES (?, ?, ?)",
+        (leader_id, target_id, expires_at),
+    )
+    return cur.lastrowid if cur.rowcount == 1 else None
+
+
+def _take_invite(conn, invite_id, target_id, now):
+    # fetchall: выражение с RETURNING должно завершиться до COMMIT
+    rows = conn.execute(
+        "DELETE FROM team_invites WHERE invite_id = ? AND target_id = ? AND expires_at > ? "
+        "RETURNING leader_id, expires_at",
+        (invite_id, target_id, now),
+    ).fetchall()
+    return rows[0] if rows else None
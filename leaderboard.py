@@ -0,0 +1,105 @@
+"""
+Рейтинг игроков в памяти: топ-N и место игрока без запросов к базе.
+"""
+
+import time
+from array import array
+from bisect import bisect_left, insort
+
+
+def pack_score(lvl: int, xp: int) -> int:
+    # сортировка как в ORDER BY lvl DESC, xp DESC; отрицание — чтобы лучшие шли первыми
+    return -((lvl << 40) | xp)
+
+
+class Leaderboard:
+    """
+    Все очки хранятся в отсортированном array('q') — 8 байт на игрока,
+    место считается бинарным поиском. Имена держим только для топа.
+
+    Изменение очков требует старые значения (lvl, xp) — их знает тот,
+    кто меняет игрока, поэтому отдельный словарь user_id -> очки не нужен.
+    Если игрок из топа опустился ниже границы, топ помечается устаревшим
+    и перечитывается из индекса через refill().
+
+    Если базу делят несколько процессов, чужие изменения сюда не приходят:
+    max_age > 0 задаёт, как долго топ считается свежим, а место игрока
+    уточняется периодическим load().
+    """
+
+    def __init__(self, size: int = 10, max_age: float = 0.0):
+        self.size = size
+        self.max_age = max_age
+        self._scores = array("q")
+        self._top: list = []  # [(score, user_id, name, lvl, xp)] по возрастанию score
+        self.stale = False
+        self.refilled_at = time.monotonic()
+
+    def __len__(self):
+        return len(self._scores)
+
+    def load(self, rows):
+        """rows: (user_id, name, lvl, xp), уже отсортированные по рейтингу."""
+        scores = array("q")
+        top = []
+        for user_id, name, lvl, xp in rows:
+            s = pack_score(lvl or 0, xp or 0)
+            scores.append(s)
+            if len(top) < self.size:
+                top.append((s, user_id, name, lvl or 0, xp or 0))
+        self._scores = scores
+        self._top = top
+        self.stale = False
+        self.refilled_at = time.monotonic()
+
+    def refill(self, rows):
+        """Заменяет только топ (например, после выпадения игрока из него)."""
+        self._top = [(pack_score(lvl, xp), uid, name, lvl, xp) for uid, name, lvl, xp in rows][: self.size]
+        self.stale = False
+        self.refilled_at = time.monotonic()
+
+    def needs_refill(self) -> bool:
+        if self.stale:
+            return True
+        return self.max_age > 0 and time.monotonic() - self.refilled_at > self.max_age
+
+    def add(self, user_id: int, name: str, lvl: int, xp: int):
+        insort(self._scores, pack_score(lvl, xp))
+        self._touch_top(user_id, name, lvl, xp)
+
+    def remove(self, lvl: int, xp: int):
+        s = pack_score(lvl, xp)
+        i = bisect_left(self._scores, s)
+        if i < len(self._scores) and self._scores[i] == s:
+            del self._scores[i]
+
+    def update(self, user_id: int, name: str, old_lvl: int, old_xp: int, lvl: int, xp: int):
+        if (old_lvl, old_xp) != (lvl, xp):
+            self.remove(old_lvl, old_xp)
+            insort(self._scores, pack_score(lvl, xp))
+        self._touch_top(user_id, name, lvl, xp)
+
+    def _touch_top(self, user_id, name, lvl, xp):
+        # вызывается, когда _scores уже содержит новые очки игрока
+        s = pack_score(lvl, xp)
+        was_in_top = False
+        for i, entry in enumerate(self._top):
+            if entry[1] == user_id:
+                del self._top[i]
+                was_in_top = True
+                break
+        if bisect_left(self._scores, s) < self.size:
+            insort(self._top, (s, user_id, name, lvl, xp))
+            if len(self._top) > self.size:
+                self._top.pop()
+        elif was_in_top:
+            # место в топе освободилось, а кто его занял — знает только индекс
+            self.stale = True
+
+    def top(self) -> list:
+        """[(name, lvl, xp)] лучших игроков."""
+        return [(name, lvl, xp) for _, _, name, lvl, xp in self._top]
+
+    def rank(self, lvl: int, xp: int) -> int:
+        """Место игрока с такими очками (одинаковые очки делят место)."""
+        return bisect_left(self._scores, pack_score(lvl, xp)) + 1
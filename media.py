@@ -0,0 +1,102 @@
+"""
+Кеш file_id для картинок, которые бот отправляет по URL.
+
+Первый раз картинка уходит по ссылке, Telegram скачивает её сам и
+возвращает file_id; дальше отправляем уже file_id — без повторной
+загрузки с внешнего хоста. file_id действителен только для бота,
+который его получил, поэтому ключ — (bot_id, url).
+
+file_id может перестать работать (Telegram его отозвал, у того же бота
+сменился токен). Тогда отправка получает BadRequest: id удаляется из
+кеша и из базы (on_failed), а картинка уходит по ссылке заново.
+"""
+
+from telegram.error import BadRequest
+
+from repos import register_migration
+
+MIGRATE_MEDIA_CACHE = """
+CREATE TABLE IF NOT EXISTS media_cache (
+    bot_id INTEGER NOT NULL,
+    url TEXT NOT NULL,
+    file_id TEXT NOT NULL,
+    PRIMARY KEY (bot_id, url)
+) WITHOUT ROWID
+"""
+register_migration(5, MIGRATE_MEDIA_CACHE)
+
+
+class MediaCache:
+    def __init__(self, db):
+        self.db = db
+        self.bot_id = None
+        self._ids: dict = {}  # url -> file_id
+        self.hits = 0
+        self.misses = 0
+        self.invalidated = 0
+
+    def __len__(self):
+        return len(self._ids)
+
+    async def load(self, bot_id: int):
+        self.bot_id = bot_id
+        rows = await self.db.fetchall("SELECT url, file_id FROM media_cache WHERE bot_id = ?", (bot_id,))
+        self._ids = dict(rows)
+
+    def photo(self, url: str):
+        """file_id, если картинка уже отправлялась, иначе сама ссылка."""
+        file_id = self._ids.get(url)
+        if file_id is None:
+            self.misses += 1
+            return url
+        self.hits += 1
+        return file_id
+
+    def on_sent(self, url: str):
+        """Колбэк для outbox: запоминает file_id из отправленного сообщения. None, если уже знаем."""
+        if url in self._ids:
+            return None
+
+        async def remember(message):
+            if not getattr(message, "photo", None):
+                return
+            file_id = message.photo[-1].file_id
+            if self._ids.get(url) == file_id:
+                return
+            self._ids[url] = file_id
+            await self.db.execute(
+                "INSERT OR REPLACE INTO media_cache (bot_id, url, file_id) VALUES (?, ?, ?)",
+                (self.bot_id, url, file_id),
+            )
+
+        return remember
+
+    def on_failed(self, url: str, photo, resend):
+        """
+        Колбэк для outbox на отказ в отправке photo (результата photo(url)).
+        Если ушёл закешированный file_id и Telegram ответил BadRequest,
+        id забывается и вызывается resend() — один повтор уже по ссылке.
+        None, если отправлялась сама ссылка: повторять нечего.
+        """
+        if photo == url:
+            return None
+
+        async def forget(error):
+            if not isinstance(error, BadRequest):
+                return
+            await self.forget(url, photo)
+            resend()
+
+        return forget
+
+    async def forget(self, url: str, file_id: str):
+        if self._ids.get(url) == file_id:
+            del self._ids[url]
+        self.invalidated += 1
+        await self.db.execute(
+            "DELETE FROM media_cache WHERE bot_id = ? AND url = ? AND file_id = ?",
+            (self.bot_id, url, file_id),
+        )
+
+    def missing(self, urls) -> list:
+        return [url for url in dict.fromkeys(urls) if url and url not in self._ids]
@@ -0,0 +1,227 @@
+"""
+Метрики горячего пути: время обработчиков с разбивкой на базу, Telegram API
+и собственные вычисления, число запросов к базе. Отдаются в текстовом
+формате Prometheus (см. webhook.py, путь /metrics).
+"""
+
+import functools
+import time
+from contextvars import ContextVar
+
+from telegram.request import BaseRequest
+
+# границы гистограммы времени обработчика, секунды
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class UpdateStats:
+    """
+    Накопители на время обработки одного апдейта. Каждый запрос к базе —
+    одна выдача соединения (читателя, писателя или из пула); connections —
+    какие разные соединения апдейт при этом занимал.
+    """
+
+    __slots__ = ("db_seconds", "api_seconds", "queries", "api_calls", "connections")
+
+    def __init__(self):
+        self.db_seconds = 0.0
+        self.api_seconds = 0.0
+        self.queries = 0
+        self.api_calls = 0
+        self.connections: set = set()
+
+
+# статистика текущего апдейта; contextvars живут в пределах задачи обработчика
+current: ContextVar[UpdateStats | None] = ContextVar("sailor_update_stats", default=None)
+
+
+class HandlerMetrics:
+    __slots__ = ("count", "errors", "wall", "db", "api", "compute", "queries", "api_calls", "connections",
+                 "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.wall = 0.0
+        self.db = 0.0
+        self.api = 0.0
+        self.compute = 0.0
+        self.queries = 0
+        self.api_calls = 0
+        self.connections = 0
+        self.buckets = [0] * len(BUCKETS)
+
+    def observe(self, wall: float, stats: UpdateStats, failed: bool):
+        self.count += 1
+        self.errors += failed
+        self.wall += wall
+        self.db += stats.db_seconds
+        self.api += stats.api_seconds
+        self.compute += max(0.0, wall - stats.db_seconds - stats.api_seconds)
+        self.queries += stats.queries
+        self.api_calls += stats.api_calls
+        self.connections += len(stats.connections)
+        for i, bound in enumerate(BUCKETS):
+            if wall <= bound:
+                self.buckets[i] += 1
+                break
+
+
+class Registry:
+    def __init__(self):
+        self.handlers: dict = {}
+        self.queries_total = 0
+        self.db_seconds_total = 0.0
+        self.api_calls_total = 0
+        self.api_seconds_total = 0.0
+        # метки всех образцов: у нескольких воркеров — номер процесса, чтобы
+        # счётчики разных процессов не выглядели одним сбрасывающимся рядом
+        self.labels: dict = {}
+        self._collectors = []
+
+    # ------------ Сбор ------------
+    def observe_query(self, seconds: float, write: bool, conn=None):
+        self.queries_total += 1
+        self.db_seconds_total += seconds
+        stats = current.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.db_seconds += seconds
+            if conn is not None:
+                stats.connections.add(conn)
+
+    def observe_api(self, seconds: float):
+        self.api_calls_total += 1
+        self.api_seconds_total += seconds
+        stats = current.get()
+        if stats is not None:
+            stats.api_calls += 1
+            stats.api_seconds += seconds
+
+    def add_collector(self, fn):
+        """fn() -> [(имя, тип, описание, [(метки, значение)])] — снимается при каждом /metrics."""
+        self._collectors.append(fn)
+
+    def instrument(self, callback, name: str | None = None):
+        name = name or getattr(callback, "__name__", "handler")
+        hm = self.handlers.setdefault(name, HandlerMetrics())
+
+        @functools.wraps(callback)
+        async def wrapper(update, context):
+            stats = UpdateStats()
+            token = current.set(stats)
+            started = time.perf_counter()
+            failed = False
+            try:
+                return await callback(update, context)
+            except BaseException as e:
+                failed = True
+                # error_handler получает только исключение — пометим, чей вызов упал
+                e.sailor_handler = name
+                raise
+            finally:
+                hm.observe(time.perf_counter() - started, stats, failed)
+                current.reset(token)
+
+        return wrapper
+
+    def instrument_application(self, app):
+        """
+        Оборачивает колбэки всех зарегистрированных обработчиков.
+        У маршрутизатора (router.CallbackRouter) замеряется каждый маршрут.
+        """
+        for handlers in app.handlers.values():
+            for handler in handlers:
+                routes = getattr(handler, "routes", None)
+                if routes is None:
+                    handler.callback = self.instrument(handler.callback)
+                    continue
+                # псевдонимы ведут на тот же Route — оборачиваем его один раз
+                for route in {id(r): r for r in routes.values()}.values():
+                    route.callback = self.instrument(route.callback)
+
+    # ------------ Экспорт ------------
+    def render(self) -> str:
+        out = []
+
+        def lab(labels):
+            return _labels({**self.labels, **labels})
+
+        def family(name, kind, help_text, samples):
+            out.append(f"# HELP {name} {help_text}")
+            out.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                out.append(f"{name}{lab(labels)} {value}")
+
+        hs = sorted(self.handlers.items())
+        out.append("# HELP sailor_handler_seconds Полное время обработчика")
+        out.append("# TYPE sailor_handler_seconds histogram")
+        for name, hm in hs:
+            cumulative = 0
+            for bound, n in zip(BUCKETS, hm.buckets):
+                cumulative += n
+                out.append(f'sailor_handler_seconds_bucket{lab({"handler": name, "le": bound})} {cumulative}')
+            out.append(f'sailor_handler_seconds_bucket{lab({"handler": name, "le": "+Inf"})} {hm.count}')
+            out.append(f'sailor_handler_seconds_sum{lab({"handler": name})} {hm.wall}')
+            out.append(f'sailor_handler_seconds_count{lab({"handler": name})} {hm.count}')
+        family("sailor_handler_db_seconds_total", "counter", "Время ожидания базы внутри обработчика",
+               [({"handler": n}, hm.db) for n, hm in hs])
+        family("sailor_handler_api_seconds_total", "counter", "Время вызовов Telegram API внутри обработчика",
+               [({"handler": n}, hm.api) for n, hm in hs])
+        family("sailor_handler_compute_seconds_total", "counter", "Время собственных вычислений обработчика",
+               [({"handler": n}, hm.compute) for n, hm in hs])
+        family("sailor_handler_queries_total", "counter", "Запросов к базе из обработчика",
+               [({"handler": n}, hm.queries) for n, hm in hs])
+        family("sailor_handler_connections_total", "counter",
+               "Разных соединений с базой, занятых обработчиком (сумма по апдейтам)",
+               [({"handler": n}, hm.connections) for n, hm in hs])
+        family("sailor_handler_api_calls_total", "counter", "Вызовов Telegram API из обработчика",
+               [({"handler": n}, hm.api_calls) for n, hm in hs])
+        family("sailor_handler_errors_total", "counter", "Обработчик завершился исключением",
+               [({"handler": n}, hm.errors) for n, hm in hs])
+        family("sailor_db_queries_total", "counter", "Запросов к базе всего", [({}, self.queries_total)])
+        family("sailor_db_seconds_total", "counter", "Время запросов к базе всего", [({}, self.db_seconds_total)])
+        family("sailor_api_calls_total", "counter", "Вызовов Telegram API всего", [({}, self.api_calls_total)])
+        family("sailor_api_seconds_total", "counter", "Время вызовов Telegram API всего", [({}, self.api_seconds_total)])
+        for fn in self._collectors:
+            for name, kind, help_text, samples in fn():
+                family(name, kind, help_text, samples)
+        return "\n".join(out) + "\n"
+
+
+def _labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    parts = []
+    for k, v in labels.items():
+        v = str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{k}="{v}"')
+    return "{" + ",".join(parts) + "}"
+
+
+class TimedRequest(BaseRequest):
+    """Обёртка над BaseRequest бота: замеряет каждый вызов Bot API."""
+
+    def __init__(self, inner: BaseRequest, registry: "Registry"):
+        self.inner = inner
+        self.registry = registry
+
+    @property
+    def read_timeout(self):
+        return self.inner.read_timeout
+
+    async def initialize(self):
+        await self.inner.initialize()
+
+    async def shutdown(self):
+        await self.inner.shutdown()
+
+    async def do_request(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await self.inner.do_request(*args, **kwargs)
+        finally:
+            self.registry.observe_api(time.perf_counter() - started)
+
+
+registry = Registry()
@@ -0,0 +1,231 @@
+"""
+Исходящие сообщения: очередь доставки в Telegram с учётом лимитов.
+
+Обработчик кладёт сообщение в очередь и сразу возвращается, отправкой
+занимаются воркеры. Лимиты Bot API — около 30 сообщений в секунду на бота,
+примерно одно в секунду в личный чат и 20 в минуту в группу — соблюдаются
+token bucket'ами: общим и по одному на чат. Сообщения одного чата уходят
+строго по порядку.
+
+При 429 (RetryAfter) доставка ставится на паузу на указанное Telegram время
+и повторяется; сетевые ошибки повторяются с экспоненциальной задержкой.
+Остальные ошибки (бот заблокирован, неверный запрос) не повторяются;
+о них узнаёт колбэк on_failed, если он передан.
+"""
+
+import asyncio
+import inspect
+import random
+import time
+from collections import deque
+
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
+
+from concurrency import TokenBucket
+
+GLOBAL_RATE = 30.0
+PRIVATE_RATE, PRIVATE_BURST = 1.0, 3
+GROUP_RATE, GROUP_BURST = 20 / 60, 3
+
+
+def _seconds(value) -> float:
+    # RetryAfter.retry_after — int или timedelta в зависимости от настроек PTB
+    return value.total_seconds() if hasattr(value, "total_seconds") else float(value)
+
+
+class _Job:
+    __slots__ = ("method", "kwargs", "on_sent", "on_failed", "attempts")
+
+    def __init__(self, method: str, kwargs: dict, on_sent=None, on_failed=None):
+        self.method = method
+        self.kwargs = kwargs
+        self.on_sent = on_sent
+        self.on_failed = on_failed
+        self.attempts = 0
+
+
+class _Chat:
+    __slots__ = ("jobs", "bucket", "scheduled")
+
+    def __init__(self, bucket: TokenBucket):
+        self.jobs = deque()
+        self.bucket = bucket
+        self.scheduled = False  # chat_id уже стоит в очереди готовых или ждёт таймера
+
+
+class Outbox:
+    def __init__(self, workers: int = 8, global_rate: float = GLOBAL_RATE,
+                 max_attempts: int = 5, backoff: float = 1.0, max_backoff: float = 30.0):
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._global = TokenBucket(global_rate, global_rate)
+        self._paused_until = 0.0
+        self._chats: dict = {}  # chat_id -> _Chat
+        self._ready: asyncio.Queue = asyncio.Queue()
+        self._tasks: list = []
+        self._bot = None
+        self.in_flight = 0
+        self.enqueued = 0
+        self.sent = 0
+        self.retries = 0
+        self.failed = 0
+
+    def __len__(self):
+        return sum(len(chat.jobs) for chat in self._chats.values())
+
+    # ------------ Постановка в очередь ------------
+    def send_message(self, chat_id: int, text: str, on_sent=None, on_failed=None, **kwargs):
+        self.put(chat_id, "send_message", dict(chat_id=chat_id, text=text, **kwargs), on_sent, on_failed)
+
+    def send_photo(self, chat_id: int, photo, on_sent=None, on_failed=None, **kwargs):
+        self.put(chat_id, "send_photo", dict(chat_id=chat_id, photo=photo, **kwargs), on_sent, on_failed)
+
+    def put(self, chat_id: int, method: str, kwargs: dict, on_sent=None, on_failed=None):
+        """
+        Любой метод Bot API. on_sent(результат) вызывается после успешной отправки,
+        on_failed(ошибка) — когда от отправки отказались; оба могут быть корутинами.
+        """
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            if chat_id < 0:
+                bucket = TokenBucket(GROUP_RATE, GROUP_BURST)
+            else:
+                bucket = TokenBucket(PRIVATE_RATE, PRIVATE_BURST)
+            chat = self._chats[chat_id] = _Chat(bucket)
+        chat.jobs.append(_Job(method, kwargs, on_sent, on_failed))
+        self.enqueued += 1
+        if not chat.scheduled:
+            chat.scheduled = True
+            self._ready.put_nowait(chat_id)
+
+    # ------------ Жизненный цикл ------------
+    def start(self, bot):
+        if self._tasks:
+            return
+        self._bot = bot
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = 10.0):
+        """Дожидается отправки очереди (не дольше timeout) и останавливает воркеров."""
+        deadline = time.monotonic() + timeout
+        while (len(self) or self.in_flight) and self._tasks and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if len(self):
+            print(f"Outbox: не отправлено {len(self)} сообщений при остановке")
+
+    # ------------ Доставка ------------
+    def _schedule(self, chat_id, delay: float):
+        if delay > 0:
+            asyncio.get_running_loop().call_later(delay, self._ready.put_nowait, chat_id)
+        else:
+            self._ready.put_nowait(chat_id)
+
+    def _forget(self, chat_id):
+        # корзина пустого чата уже полная — хранить её незачем
+        chat = self._chats.get(chat_id)
+        if chat is not None and not chat.jobs and not chat.scheduled and chat.bucket.full():
+            del self._chats[chat_id]
+
+    async def _global_slot(self):
+        while True:
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+            wait = self._global.take()
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    async def _worker(self):
+        while True:
+            chat_id = await self._ready.get()
+            chat = self._chats[chat_id]
+            wait = chat.bucket.take()
+            if wait:
+                self._schedule(chat_id, wait)
+                continue
+            await self._global_slot()
+            self.in_flight += 1
+            try:
+                delay = await self._deliver(chat.jobs[0])
+            finally:
+                self.in_flight -= 1
+            if delay is None:
+                chat.jobs.popleft()
+                delay = 0.0
+            if chat.jobs:
+                self._schedule(chat_id, delay)
+            else:
+                chat.scheduled = False
+                b = chat.bucket
+                asyncio.get_running_loop().call_later(b.capacity / b.rate, self._forget, chat_id)
+
+    async def _deliver(self, job: _Job):
+        """None — задание завершено (успешно или окончательно нет), иначе через сколько повторить."""
+        try:
+            result = await getattr(self._bot, job.method)(**job.kwargs)
+        except RetryAfter as e:
+            # флуд-контроль касается всего бота: пауза для всех чатов
+            delay = _seconds(e.retry_after)
+            self._paused_until = max(self._paused_until, time.monotonic() + delay)
+            self.retries += 1
+            return delay
+        except NetworkError as e:
+            if isinstance(e, BadRequest):
+                # в PTB BadRequest — подкласс NetworkError, но повтор тот же запрос не исправит
+                return await self._reject(job, e)
+            job.attempts += 1
+            if job.attempts >= self.max_attempts:
+                self.failed += 1
+                print(f"Outbox: {job.method} не доставлено после {job.attempts} попыток: {e}")
+                await self._notify(job, job.on_failed, e)
+                return None
+            self.retries += 1
+            delay = min(self.max_backoff, self.backoff * 2 ** (job.attempts - 1))
+            return delay * random.uniform(0.5, 1.0)
+        except TelegramError as e:
+            # бот заблокирован, чат не найден и т.п. — повтор не поможет
+            return await self._reject(job, e)
+        except Exception as e:
+            self.failed += 1
+            print(f"Outbox: ошибка {job.method}: {e}")
+            await self._notify(job, job.on_failed, e)
+            return None
+        self.sent += 1
+        await self._notify(job, job.on_sent, result)
+        return None
+
+    async def _reject(self, job: _Job, e: Exception):
+        self.failed += 1
+        print(f"Outbox: {job.method} в {job.kwargs.get('chat_id')} отклонено: {e}")
+        await self._notify(job, job.on_failed, e)
+        return None
+
+    @staticmethod
+    async def _notify(job: _Job, callback, value):
+        if callback is None:
+            return
+        try:
+            done = callback(value)
+            if inspect.isawaitable(done):
+                await done
+        except Exception as e:
+            print(f"Outbox: ошибка колбэка для {job.method}: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "queued": len(self),
+            "in_flight": self.in_flight,
+            "chats": len(self._chats),
+            "enqueued": self.enqueued,
+            "sent": self.sent,
+            "retries": self.retries,
+            "failed": self.failed,
+        }
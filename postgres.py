@@ -0,0 +1,347 @@
+"""
+Серверная база: игроки и команды в PostgreSQL через пул соединений asyncpg.
+
+Включается переменной DATABASE_URL (см. sailor_bot.py). asyncpg
+импортируется только при старте пула, поэтому без него бот на SQLite
+работает как раньше. Запросы те же, что в repos.py, с поправкой на
+диалект: плейсхолдеры $1, ON CONFLICT вместо INSERT OR ..., string_agg.
+"""
+
+import asyncio
+import time
+
+from gamedata import MAX_ENERGY, ENERGY_REGEN_SECONDS
+from repos import PLAYER_COLUMNS, PlayerRepo, TeamRepo
+from storage import StaleWrite, TableWriter
+
+# ключ advisory-блокировки: воркеры стартуют одновременно, миграции выполняет один
+MIGRATION_LOCK = 0x5A11_0001
+
+
+class PgDatabase:
+    """
+    Пул соединений asyncpg с тем же набором методов чтения, что у
+    storage.Database. transaction(fn, *args) вызывает корутину
+    fn(conn, *args) внутри транзакции на одном соединении из пула.
+    """
+
+    def __init__(self, dsn: str, min_size: int = 1, max_size: int = 10):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.pool = None
+        self.connections_opened = 0
+        # observer(секунды, запись ли, соединение) — как у storage.Database;
+        # соединение здесь — pid серверного процесса
+        self.observer = None
+
+    async def start(self):
+        if self.pool is not None:
+            return
+        import asyncpg  # нужен только с серверной базой
+
+        self.pool = await asyncpg.create_pool(
+            self.dsn, min_size=self.min_size, max_size=self.max_size, init=self._on_connect,
+        )
+
+    async def _on_connect(self, conn):
+        self.connections_opened += 1
+
+    async def close(self):
+        if self.pool is not None:
+            pool, self.pool = self.pool, None
+            await pool.close()
+
+    async def _timed(self, write: bool, fn):
+        """fn(conn) на соединении из пула, с замером для observer."""
+        if self.pool is None:
+            await self.start()
+        started = time.perf_counter()
+        used = None
+        try:
+            async with self.pool.acquire() as conn:
+                used = conn.get_server_pid()
+                return await fn(conn)
+        finally:
+            if self.observer is not None:
+                self.observer(time.perf_counter() - started, write, used)
+
+    # ------------ Чтение ------------
+    async def fetchone(self, sql: str, params=()):
+        return await self._timed(False, lambda conn: conn.fetchrow(sql, *params))
+
+    async def fetchall(self, sql: str, params=()):
+        return await self._timed(False, lambda conn: conn.fetch(sql, *params))
+
+    # ------------ Запись ------------
+    async def execute(self, sql: str, params=()) -> int:
+        """Одиночный запрос на запись, возвращает число затронутых строк."""
+        return rowcount(await self._timed(True, lambda conn: conn.execute(sql, *params)))
+
+    async def transaction(self, fn, *args):
+        async def run(conn):
+            async with conn.transaction():
+                return await fn(conn, *args)
+
+        return await self._timed(True, run)
+
+    async def migrate(self, migrations) -> int:
+        """
+        Применяет недостающие миграции (SQL или корутины fn(conn)) одной
+        транзакцией. Номер последней хранится в таблице schema_version.
+        """
+        return await self.transaction(_migrate, list(migrations))
+
+
+def rowcount(status: str) -> int:
+    # asyncpg возвращает тег команды: "UPDATE 1", "INSERT 0 1", "DELETE 3"
+    tail = status.rsplit(" ", 1)[-1]
+    return int(tail) if tail.isdigit() else 0
+
+
+async def _migrate(conn, migrations):
+    await conn.execute("SELECT pg_advisory_xact_lock($1)", MIGRATION_LOCK)
+    await conn.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)")
+    version = await conn.fetchval("SELECT max(version) FROM schema_version") or 0
+    for step in migrations[version:]:
+        if callable(step):
+            await step(conn)
+        else:
+            await conn.execute(step)
+    if len(migrations) > version:
+        await conn.execute("DELETE FROM schema_version")
+        await conn.execute("INSERT INTO schema_version (version) VALUES ($1)", len(migrations))
+    return max(version, len(migrations))
+
+
+class PgTableWriter(TableWriter):
+    """
+    TableWriter для PostgreSQL. Записи одного процесса идут по очереди
+    (как через единственный поток-писатель SQLite): иначе два снимка
+    одного объекта могли бы обогнать друг друга на разных соединениях пула.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._lock = asyncio.Lock()
+
+    def _insert_stmt(self) -> str:
+        cols = self.columns + ((self.version,) if self.version else ())
+        marks = ", ".join(f"${i}" for i in range(1, len(cols) + 1))
+        sql = f"INSERT INTO {self.table} ({', '.join(cols)}) VALUES ({marks}) ON CONFLICT ({self.key}) DO "
+        if self.version:
+            return sql + "NOTHING"
+        return sql + "UPDATE SET " + ", ".join(f"{c} = EXCLUDED.{c}" for c in self.columns if c != self.key)
+
+    def _build_update(self, fields: tuple) -> str:
+        sets = [f"{f} = ${i}" for i, f in enumerate(fields, 1)]
+        n = len(fields)
+        if self.version:
+            v = self.version
+            sets.append(f"{v} = {v} + 1")
+            return f"UPDATE {self.table} SET {', '.join(sets)} WHERE {self.key} = ${n + 1} AND {v} = ${n + 2}"
+        return f"UPDATE {self.table} SET {', '.join(sets)} WHERE {self.key} = ${n + 1}"
+
+    async def apply(self, batches):
+        if not batches:
+            return
+        async with self._lock:
+            await self.db.transaction(_write_batches, self.table, batches)
+
+
+async def _write_batches(conn, table, batches):
+    stale = []
+    for sql, rows, keys in batches:
+        if keys is None:
+            await conn.executemany(sql, rows)
+            continue
+        for row, key in zip(rows, keys):
+            if rowcount(await conn.execute(sql, *row)) != 1:
+                stale.append(key)
+    if stale:
+        raise StaleWrite(table, stale)
+
+
+# ------------ Схема ------------
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS players (
+    user_id BIGINT PRIMARY KEY,
+    username TEXT,
+    name TEXT,
+    style TEXT,
+    lvl INTEGER,
+    xp BIGINT,
+    gold BIGINT,
+    hp INTEGER,
+    max_hp INTEGER,
+    atk INTEGER,
+    energy INTEGER,
+    last_daily TEXT,
+    last_energy_tick TEXT DEFAULT '',
+    version INTEGER NOT NULL DEFAULT 1
+);
+CREATE INDEX IF NOT EXISTS idx_players_rank ON players (lvl DESC, xp DESC, user_id) INCLUDE (name);
+CREATE TABLE IF NOT EXISTS inventory (
+    user_id BIGINT NOT NULL,
+    item_key TEXT NOT NULL,
+    qty INTEGER NOT NULL,
+    PRIMARY KEY (user_id, item_key)
+);
+CREATE TABLE IF NOT EXISTS teams (
+    team_id BIGSERIAL PRIMARY KEY,
+    leader_id BIGINT,
+    active INTEGER DEFAULT 1
+);
+CREATE TABLE IF NOT EXISTS team_members (
+    team_id BIGINT NOT NULL,
+    user_id BIGINT NOT NULL,
+    PRIMARY KEY (team_id, user_id)
+);
+CREATE INDEX IF NOT EXISTS idx_team_members_user ON team_members (user_id, team_id);
+"""
+
+# Новые шаги добавлять только в конец.
+MIGRATIONS = [
+    SCHEMA,
+    "CREATE INDEX IF NOT EXISTS idx_players_username ON players (lower(username))",
+    "CREATE INDEX IF NOT EXISTS idx_teams_leader ON teams (leader_id, team_id) WHERE active = 1",
+]
+
+async def init_postgres(db: PgDatabase):
+    await db.start()
+    await db.migrate(MIGRATIONS)
+
+
+# ------------ Игроки ------------
+SQL_SELECT_PLAYERS = (
+    f"SELECT {', '.join('p.' + c for c in PLAYER_COLUMNS)}, "
+    "(SELECT string_agg(i.item_key || ':' || i.qty, ',') FROM inventory i WHERE i.user_id = p.user_id), "
+    "p.version FROM players p"
+)
+SQL_LOAD_PLAYER = SQL_SELECT_PLAYERS + " WHERE p.user_id = $1"
+SQL_LOAD_PLAYERS = SQL_SELECT_PLAYERS + " WHERE p.user_id = ANY($1::bigint[])"
+SQL_RANKING = "SELECT user_id, name, lvl, xp FROM players ORDER BY lvl DESC, xp DESC, user_id"
+SQL_FIND_BY_USERNAME = "SELECT user_id FROM players WHERE lower(username) = lower($1) LIMIT 1"
+SQL_REGEN_SLICE = (
+    "SELECT max(user_id) FROM (SELECT user_id FROM players WHERE user_id > $1 ORDER BY user_id LIMIT $2) s"
+)
+# см. SQL_REGEN_ENERGY в repos.py; пустая отметка через NULLIF, потому что
+# порядок проверок в WHERE не гарантирован и '' не должна доходить до приведения
+_REGEN_TICK = "NULLIF(last_energy_tick, '')::timestamptz"
+_REGEN_GAINED = f"floor(extract(epoch FROM $3::text::timestamptz - {_REGEN_TICK}) / $5)::int"
+SQL_REGEN_ENERGY = f"""
+UPDATE players SET
+    energy = least($4::int, energy + {_REGEN_GAINED}),
+    last_energy_tick = CASE WHEN energy + {_REGEN_GAINED} >= $4::int THEN $3::text
+        ELSE to_char(({_REGEN_TICK} + make_interval(secs => {_REGEN_GAINED} * $5)) AT TIME ZONE 'UTC',
+                     'YYYY-MM-DD"T"HH24:MI:SS.US"+00:00"') END,
+    version = version + 1
+WHERE user_id > $1 AND user_id <= $2 AND energy < $4::int AND {_REGEN_GAINED} >= 1
+    AND NOT (user_id = ANY($6::bigint[]))
+RETURNING user_id
+"""
+
+
+async def _regen_energy(conn, after, limit, exclude, now):
+    hi = await conn.fetchval(SQL_REGEN_SLICE, after, limit)
+    if hi is None:
+        return None, []
+    skip = [uid for uid in exclude if after < uid <= hi]
+    rows = await conn.fetch(SQL_REGEN_ENERGY, after, hi, now, MAX_ENERGY, ENERGY_REGEN_SECONDS, skip)
+    return hi, [r[0] for r in rows]
+
+
+def pg_inventory_rows(p, fields):
+    if "inventory" not in fields:
+        return []
+    rows = [("DELETE FROM inventory WHERE user_id = $1", (p.user_id,))]
+    rows += [
+        ("INSERT INTO inventory (user_id, item_key, qty) VALUES ($1, $2, $3)", (p.user_id, key, qty))
+        for key, qty in p.inventory.items()
+        if qty > 0
+    ]
+    return rows
+
+
+class PgPlayerRepo(PlayerRepo):
+    def __init__(self, db: PgDatabase):
+        self.db = db
+        self.writer = PgTableWriter(
+            db, self.table, "user_id", PLAYER_COLUMNS, extra=pg_inventory_rows, version="version",
+        )
+
+    async def get(self, user_id: int):
+        return await self.db.fetchone(SQL_LOAD_PLAYER, (user_id,))
+
+    async def get_many(self, user_ids) -> list:
+        user_ids = list(user_ids)
+        if not user_ids:
+            return []
+        return await self.db.fetchall(SQL_LOAD_PLAYERS, (user_ids,))
+
+    async def find_by_username(self, username: str) -> int | None:
+        row = await self.db.fetchone(SQL_FIND_BY_USERNAME, (username,))
+        return row[0] if row else None
+
+    async def ranking(self, limit: int | None = None) -> list:
+        if limit is None:
+            return await self.db.fetchall(SQL_RANKING)
+        return await self.db.fetchall(SQL_RANKING + " LIMIT $1", (limit,))
+
+    async def regen_energy(self, after: int, limit: int, exclude, now: str) -> tuple:
+        return await self.db.transaction(_regen_energy, after, limit, exclude, now)
+
+    def prepare(self, changes):
+        return self.writer.prepare(changes)
+
+    async def apply(self, batch):
+        await self.writer.apply(batch)
+
+
+# ------------ Команды ------------
+SQL_USER_TEAMS = """
+SELECT t.team_id, t.leader_id, m.user_id, p.username, p.name
+FROM team_members me
+JOIN teams t ON t.team_id = me.team_id AND t.active = 1
+JOIN team_members m ON m.team_id = me.team_id
+LEFT JOIN players p ON p.user_id = m.user_id
+WHERE me.user_id = $1
+ORDER BY t.team_id
+"""
+
+async def _create_team(conn, leader_id: int, member_ids: list):
+    team_id = await conn.fetchval(
+        "INSERT INTO teams (leader_id, active) VALUES ($1, 1) RETURNING team_id", leader_id,
+    )
+    await conn.executemany(
+        "INSERT INTO team_members (team_id, user_id) VALUES ($1, $2) ON CONFLICT DO NOTHING",
+        [(team_id, uid) for uid in member_ids],
+    )
+    return team_id
+
+async def _join_team(conn, leader_id: int, user_id: int):
+    # два одновременных принятия у одного лидера не должны создать две команды
+    await conn.execute("SELECT pg_advisory_xact_lock(hashtextextended('team:' || $1::bigint, 0))", leader_id)
+    team_id = await conn.fetchval(
+        "SELECT team_id FROM teams WHERE leader_id = $1 AND active = 1 ORDER BY team_id LIMIT 1", leader_id,
+    )
+    if team_id is None:
+        return await _create_team(conn, leader_id, [leader_id, user_id]), True
+    await conn.execute(
+        "INSERT INTO team_members (team_id, user_id) VALUES ($1, $2) ON CONFLICT DO NOTHING", team_id, user_id,
+    )
+    return team_id, False
+
+
+class PgTeamRepo(TeamRepo):
+    def __init__(self, db: PgDatabase):
+        self.db = db
+
+    async def user_teams(self, user_id: int) -> list:
+        return await self.db.fetchall(SQL_USER_TEAMS, (user_id,))
+
+    async def create(self, leader_id: int, member_ids: list) -> int:
+        return await self.db.transaction(_create_team, leader_id, member_ids)
+
+    async def join(self, leader_id: int, user_id: int) -> tuple:
+        return await self.db.transaction(_join_team, leader_id, user_id)
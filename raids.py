@@ -0,0 +1,292 @@
+"""
+Рейды: групповой чат бьёт общего босса, пока не выйдет время.
+
+Удары не трогают общую строку босса: каждый процесс копит урон в своём
+счётчике (шард — воркер: внутри процесса всё и так идёт в одном потоке),
+а задача планировщика сливает шард в базу одной транзакцией (merge) и
+читает оттуда общий урон всех воркеров. Поэтому HP босса между слияниями —
+оценка: общий урон плюс ещё не слитый свой.
+
+Когда босс пал или время вышло, рейд забирает ровно один воркер (claim).
+У проигранного рейда строки raid_damage удаляются в той же транзакции, у
+выигранного — остаются, пока награды не записаны (settle): если выплата
+упала, её повторит unpaid. Отметка claimed_at — аренда выплаты, чтобы
+повтор не пошёл параллельно с живой выплатой другого воркера.
+Выплата и settle — разные транзакции (игроки могут жить в PostgreSQL):
+если процесс умрёт ровно между ними, награды выплатятся повторно, но
+не пропадут.
+"""
+
+import time
+
+from gamedata import MONSTERS
+from repos import register_migration
+
+MIGRATE_RAIDS = """
+CREATE TABLE IF NOT EXISTS raids (
+    raid_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id INTEGER NOT NULL,
+    message_id INTEGER,
+    boss TEXT NOT NULL,
+    hp INTEGER NOT NULL,
+    damage INTEGER NOT NULL DEFAULT 0,
+    ends_at REAL NOT NULL,
+    active INTEGER NOT NULL DEFAULT 1,
+    claimed_at REAL -- выигранный рейд забран на выплату, NULL — выплачен или проигран
+);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_raids_active_chat ON raids(chat_id) WHERE active = 1;
+CREATE INDEX IF NOT EXISTS idx_raids_unpaid ON raids(claimed_at) WHERE claimed_at IS NOT NULL;
+CREATE TABLE IF NOT EXISTS raid_damage (
+    raid_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    damage INTEGER NOT NULL,
+    PRIMARY KEY (raid_id, user_id)
+) WITHOUT ROWID
+"""
+register_migration(12, MIGRATE_RAIDS)
+
+SQL_SELECT = "SELECT raid_id, chat_id, message_id, boss, hp, damage, ends_at FROM raids"
+
+_MONSTER_INDEX = {m["id"]: i for i, m in enumerate(MONSTERS)}
+
+
+class Raid:
+    __slots__ = (
+        "raid_id", "chat_id", "message_id", "monster", "hp", "damage", "ends_at",
+        "pending", "pending_total", "last_hit", "hits", "closed",
+    )
+
+    def __init__(self, raid_id: int, chat_id: int, message_id: int | None, boss: str,
+                 hp: int, damage: int, ends_at: float):
+        self.raid_id = raid_id
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.monster = _MONSTER_INDEX[boss]
+        self.hp = hp
+        self.damage = damage  # слитый урон всех воркеров
+        self.ends_at = ends_at  # unix-время
+        self.pending: dict = {}  # user_id -> урон, ещё не слитый в базу
+        self.pending_total = 0
+        self.last_hit: dict = {}  # user_id -> время последнего удара
+        self.hits = 0
+        self.closed = False
+
+    @property
+    def boss(self) -> dict:
+        return MONSTERS[self.monster]
+
+    @property
+    def hp_left(self) -> int:
+        return max(0, self.hp - self.damage - self.pending_total)
+
+    def over(self, now: float | None = None) -> bool:
+        return self.closed or self.hp_left <= 0 or (now or time.time()) >= self.ends_at
+
+
+class RaidRegistry:
+    def __init__(self, db, shared: bool = False):
+        self.db = db
+        self.shared = shared
+        self._items: dict = {}  # raid_id -> Raid
+        self._by_chat: dict = {}  # chat_id -> raid_id
+        self.started = 0
+        self.hits = 0
+        self.merged = 0
+        self.paid = 0
+        self.retried = 0  # выплат, взятых на повтор
+        self.finished: dict = {}  # исход -> рейдов
+
+    def __len__(self):
+        return len(self._items)
+
+    def active(self) -> list:
+        return list(self._items.values())
+
+    def _remember(self, raid: Raid):
+        self._items[raid.raid_id] = raid
+        self._by_chat[raid.chat_id] = raid.raid_id
+
+    def _forget(self, raid: Raid):
+        self._items.pop(raid.raid_id, None)
+        if self._by_chat.get(raid.chat_id) == raid.raid_id:
+            del self._by_chat[raid.chat_id]
+
+    async def load(self):
+        rows = await self.db.fetchall(SQL_SELECT + " WHERE active = 1")
+        self._items.clear()
+        self._by_chat.clear()
+        for row in rows:
+            self._remember(Raid(*row))
+
+    async def get(self, raid_id: int) -> Raid | None:
+        raid = self._items.get(raid_id)
+        if raid is None and self.shared:
+            # рейд начат в другом воркере
+            row = await self.db.fetchone(SQL_SELECT + " WHERE raid_id = ? AND active = 1", (raid_id,))
+            if row is not None:
+                raid = self._items.get(raid_id) or Raid(*row)
+                self._remember(raid)
+        return raid
+
+    def in_chat(self, chat_id: int) -> Raid | None:
+        return self._items.get(self._by_chat.get(chat_id))
+
+    async def start(self, chat_id: int, boss: dict, hp: int, duration: float) -> Raid | None:
+        """Новый рейд или None, если в чате уже идёт другой."""
+        ends_at = time.time() + duration
+        raid_id = await self.db.transaction(_start_raid, chat_id, boss["id"], hp, ends_at)
+        if raid_id is None:
+            return None
+        raid = Raid(raid_id, chat_id, None, boss["id"], hp, 0, ends_at)
+        self._remember(raid)
+        self.started += 1
+        return raid
+
+    async def set_message(self, raid: Raid, message_id: int):
+        raid.message_id = message_id
+        await self.db.execute("UPDATE raids SET message_id = ? WHERE raid_id = ?", (message_id, raid.raid_id))
+
+    def hit(self, raid: Raid, user_id: int, damage: int, cooldown: float) -> float:
+        """
+        Засчитывает удар в шард этого процесса. Возвращает 0 или сколько
+        секунд игроку ещё ждать до следующего удара (тогда удар не засчитан).
+        """
+        now = time.time()
+        wait = raid.last_hit.get(user_id, 0.0) + cooldown - now
+        if wait > 0:
+            return wait
+        raid.last_hit[user_id] = now
+        raid.pending[user_id] = raid.pending.get(user_id, 0) + damage
+        raid.pending_total += damage
+        raid.hits += 1
+        self.hits += 1
+        return 0.0
+
+    async def merge(self) -> list:
+        """
+        Сливает шард в базу одной транзакцией и обновляет общий урон.
+        Возвращает рейды, которые пора завершать.
+        """
+        batch = []
+        for raid in self._items.values():
+            if raid.pending:
+                batch.append((raid, raid.pending, raid.pending_total))
+                raid.pending, raid.pending_total = {}, 0
+        if batch or self.shared:
+            try:
+                totals = await self.db.transaction(
+                    _merge_damage, [(raid.raid_id, pending) for raid, pending, _ in batch],
+                )
+            except BaseException:
+                # вернуть несохранённое; удары после снятия шарда уже в новом pending
+                for raid, pending, total in batch:
+                    for uid, dmg in pending.items():
+                        raid.pending[uid] = raid.pending.get(uid, 0) + dmg
+                    raid.pending_total += total
+                raise
+            self.merged += sum(len(pending) for _, pending, _ in batch)
+            for raid in list(self._items.values()):
+                if raid.raid_id in totals:
+                    raid.damage = totals[raid.raid_id]
+                elif self.shared and not raid.closed:
+                    # рейд уже завершил другой воркер
+                    self._forget(raid)
+        now = time.time()
+        return [raid for raid in self._items.values() if not raid.closed and raid.over(now)]
+
+    async def claim(self, raid: Raid, outcome: str) -> dict | None:
+        """
+        Закрывает рейд: {user_id: урон} для наград или None, если его
+        уже забрал другой воркер. Удары после вызова не принимаются.
+        Урон выигранного рейда остаётся в базе до settle().
+        """
+        raid.closed = True
+        pending, raid.pending, raid.pending_total = raid.pending, {}, 0
+        try:
+            damage = await self.db.transaction(_claim_raid, raid.raid_id, pending, outcome == "won", time.time())
+        except BaseException:
+            # рейд остаётся открытым: следующее слияние попробует снова
+            raid.closed = False
+            for uid, dmg in pending.items():
+                raid.pending[uid] = raid.pending.get(uid, 0) + dmg
+            raid.pending_total += sum(pending.values())
+            raise
+        self._forget(raid)
+        if damage is not None:
+            self.finished[outcome] = self.finished.get(outcome, 0) + 1
+        return damage
+
+    async def settle(self, raid: Raid):
+        """Награды записаны: урон рейда больше не нужен."""
+        await self.db.transaction(_settle_raid, raid.raid_id)
+        self.paid += 1
+
+    async def unpaid(self, lease: float, limit: int = 20) -> list:
+        """
+        Выигранные рейды, чья выплата не дошла до settle за lease секунд:
+        [(Raid, {user_id: урон})]. Выплата снова арендуется на lease.
+        """
+        rows = await self.db.transaction(_take_unpaid, time.time(), lease, limit)
+        self.retried += len(rows)
+        return [(Raid(*row), damage) for row, damage in rows]
+
+
+def _start_raid(conn, chat_id, boss, hp, ends_at):
+    # второй активный рейд в чате не пустит уникальный частичный индекс
+    cur = conn.execute(
+        "INSERT OR IGNORE INTO raids (chat_id, boss, hp, ends_at) VALUES (?, ?, ?, ?)",
+        (chat_id, boss, hp, ends_at),
+    )
+    return cur.lastrowid if cur.rowcount == 1 else None
+
+
+def _add_damage(conn, raid_id, pending) -> int:
+    conn.executemany(
+        "INSERT INTO raid_damage (raid_id, user_id, damage) VALUES (?, ?, ?) "
+        "ON CONFLICT (raid_id, user_id) DO UPDATE SET damage = damage + excluded.damage",
+        [(raid_id, uid, dmg) for uid, dmg in pending.items()],
+    )
+    total = sum(pending.values())
+    conn.execute("UPDATE raids SET damage = damage + ? WHERE raid_id = ?", (total, raid_id))
+    return total
+
+
+def _merge_damage(conn, batch):
+    for raid_id, pending in batch:
+        _add_damage(conn, raid_id, pending)
+    return dict(conn.execute("SELECT raid_id, damage FROM raids WHERE active = 1"))
+
+
+def _claim_raid(conn, raid_id, pending, won, now):
+    if not conn.execute(
+        "UPDATE raids SET active = 0, claimed_at = ? WHERE raid_id = ? AND active = 1",
+        (now if won else None, raid_id),
+    ).rowcount:
+        return None
+    if pending:
+        _add_damage(conn, raid_id, pending)
+    if won:
+        # строки снимет settle после выплаты
+        return dict(conn.execute("SELECT user_id, damage FROM raid_damage WHERE raid_id = ?", (raid_id,)))
+    # fetchall: выражение с RETURNING должно завершиться до COMMIT
+    return dict(conn.execute(
+        "DELETE FROM raid_damage WHERE raid_id = ? RETURNING user_id, damage", (raid_id,),
+    ).fetchall())
+
+
+def _settle_raid(conn, raid_id):
+    conn.execute("DELETE FROM raid_damage WHERE raid_id = ?", (raid_id,))
+    conn.execute("UPDATE raids SET claimed_at = NULL WHERE raid_id = ?", (raid_id,))
+
+
+def _take_unpaid(conn, now, lease, limit):
+    rows = conn.execute(
+        SQL_SELECT + " WHERE active = 0 AND claimed_at <= ? ORDER BY claimed_at LIMIT ?",
+        (now - lease, limit),
+    ).fetchall()
+    taken = []
+    for row in rows:
+        conn.execute("UPDATE raids SET claimed_at = ? WHERE raid_id = ?", (now, row[0]))
+        damage = dict(conn.execute("SELECT user_id, damage FROM raid_damage WHERE raid_id = ?", (row[0],)))
+        taken.append((row, damage))
+    return taken
@@ -0,0 +1,367 @@
+"""
+Репозитории игроков и команд: весь SQL про players, inventory и teams
+живёт здесь, обработчики бота работают только через PlayerRepo и TeamRepo.
+
+Реализация для SQLite — в этом модуле, для сервера PostgreSQL — в
+postgres.py. Репозиторий игроков одновременно служит store для
+WriteBehindCache: кеш решает, кого и какие поля писать, репозиторий — как.
+"""
+
+import abc
+
+from gamedata import MAX_ENERGY, ENERGY_REGEN_SECONDS
+from storage import TableWriter
+
+# players.inventory больше не пишется: предметы лежат в таблице inventory
+PLAYER_COLUMNS = (
+    "user_id", "username", "name", "style", "lvl", "xp", "gold",
+    "hp", "max_hp", "atk", "energy", "last_daily", "last_energy_tick",
+)
+
+
+class PlayerRepo(abc.ABC):
+    """
+    Хранилище игроков. Строка игрока — кортеж
+    (*PLAYER_COLUMNS, инвентарь "item:qty,item:qty" или None, version).
+    """
+
+    table = "players"
+
+    @abc.abstractmethod
+    async def get(self, user_id: int):
+        """Строка игрока или None."""
+
+    @abc.abstractmethod
+    async def get_many(self, user_ids) -> list:
+        """Строки найденных игроков, порядок не гарантирован."""
+
+    @abc.abstractmethod
+    async def find_by_username(self, username: str) -> int | None:
+        """user_id по username без учёта регистра или None."""
+
+    @abc.abstractmethod
+    async def ranking(self, limit: int | None = None) -> list:
+        """[(user_id, name, lvl, xp)] по убыванию lvl, xp."""
+
+    @abc.abstractmethod
+    async def regen_energy(self, after: int, limit: int, exclude, now: str) -> tuple:
+        """
+        Переносит накопленную регенерацию энергии в строки одним UPDATE —
+        по следующему отрезку из limit игроков с user_id > after, кроме
+        exclude (их держит кеш). now — текущее время в ISO-формате.
+        Возвращает (последний user_id отрезка или None, если игроки
+        кончились, [user_id изменённых строк]).
+        """
+
+    # ------------ Store для WriteBehindCache ------------
+    @abc.abstractmethod
+    def prepare(self, changes):
+        """Синхронно снимает значения изменённых полей в пачку для apply()."""
+
+    @abc.abstractmethod
+    async def apply(self, batch):
+        """Пишет пачку одной транзакцией; при конфликте версий — StaleWrite."""
+
+
+class TeamRepo(abc.ABC):
+    """Хранилище команд и их состава."""
+
+    @abc.abstractmethod
+    async def user_teams(self, user_id: int) -> list:
+        """
+        Активные команды игрока с составом:
+        [(team_id, leader_id, member_id, username, name)] по team_id.
+        """
+
+    @abc.abstractmethod
+    async def create(self, leader_id: int, member_ids: list) -> int:
+        """Создаёт активную команду одной транзакцией, возвращает team_id."""
+
+    @abc.abstractmethod
+    async def join(self, leader_id: int, user_id: int) -> tuple:
+        """
+        Добавляет user_id в активную команду лидера (самую раннюю), а если
+        её нет — создаёт. Повторный вызов ничего не добавляет.
+        Возвращает (team_id, создана ли команда).
+        """
+
+
+# ------------ SQLite: схема и миграции ------------
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS players (
+    user_id INTEGER PRIMARY KEY,
+    username TEXT,
+    name TEXT,
+    style TEXT,
+    lvl INTEGER,
+    xp INTEGER,
+    gold INTEGER,
+    hp INTEGER,
+    max_hp INTEGER,
+    atk INTEGER,
+    energy INTEGER,
+    last_daily TEXT,
+    inventory TEXT,
+    last_energy_tick TEXT DEFAULT '',
+    version INTEGER NOT NULL DEFAULT 1
+);
+CREATE TABLE IF NOT EXISTS teams (
+    team_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    leader_id INTEGER,
+    member_ids TEXT, -- comma-separated
+    active INTEGER DEFAULT 1
+);
+"""
+
+def migrate_team_members(conn):
+    # раньше состав команды хранился строкой teams.member_ids
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS team_members (
+            team_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            PRIMARY KEY (team_id, user_id)
+        ) WITHOUT ROWID
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_team_members_user ON team_members(user_id, team_id)")
+    rows = conn.execute("SELECT team_id, member_ids FROM teams").fetchall()
+    conn.executemany(
+        "INSERT OR IGNORE INTO team_members (team_id, user_id) VALUES (?, ?)",
+        [
+            (team_id, int(uid))
+            for team_id, member_ids in rows
+            for uid in (member_ids or "").split(",")
+            if uid.strip().isdigit()
+        ],
+    )
+
+def migrate_inventory(conn):
+    # раньше инвентарь был строкой players.inventory вида "a,b,a"
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS inventory (
+            user_id INTEGER NOT NULL,
+            item_key TEXT NOT NULL,
+            qty INTEGER NOT NULL,
+            PRIMARY KEY (user_id, item_key)
+        ) WITHOUT ROWID
+        """
+    )
+    counts = {}
+    for user_id, inv in conn.execute("SELECT user_id, inventory FROM players WHERE inventory != ''"):
+        for key in (inv or "").split(","):
+            if key:
+                counts[(user_id, key)] = counts.get((user_id, key), 0) + 1
+    conn.executemany(
+        "INSERT OR REPLACE INTO inventory (user_id, item_key, qty) VALUES (?, ?, ?)",
+        [(user_id, key, qty) for (user_id, key), qty in counts.items()],
+    )
+    conn.execute("UPDATE players SET inventory = '' WHERE inventory != ''")
+
+def migrate_energy_tick(conn):
+    # в старых базах колонки могло не быть, хотя в схеме она объявлена
+    cols = {r[1] for r in conn.execute("PRAGMA table_info(players)")}
+    if "last_energy_tick" not in cols:
+        conn.execute("ALTER TABLE players ADD COLUMN last_energy_tick TEXT DEFAULT ''")
+
+def migrate_player_version(conn):
+    # версия строки для оптимистичной блокировки между процессами
+    cols = {r[1] for r in conn.execute("PRAGMA table_info(players)")}
+    if "version" not in cols:
+        conn.execute("ALTER TABLE players ADD COLUMN version INTEGER NOT NULL DEFAULT 1")
+
+# покрывающий индекс для рейтинга: топ и загрузка идут без обращения к таблице
+MIGRATE_RANK_INDEX = """
+CREATE INDEX IF NOT EXISTS idx_players_rank ON players(lvl DESC, xp DESC, user_id, name)
+"""
+
+# поиск для /teamup: Telegram сравнивает ники без учёта регистра, ники — ASCII
+MIGRATE_USERNAME_INDEX = """
+CREATE INDEX IF NOT EXISTS idx_players_username ON players(username COLLATE NOCASE)
+"""
+
+MIGRATE_TEAMS_LEADER_INDEX = """
+CREATE INDEX IF NOT EXISTS idx_teams_leader ON teams(leader_id, team_id) WHERE active = 1
+"""
+
+# Миграции применяются по порядку номеров, номер последней — в PRAGMA
+# user_version. Таблицы модулей (media, invites, gamelog, duels,
+# raids) те регистрируют сами через register_migration, поэтому repos
+# их не импортирует. Номера не меняются; новый шаг — следующий свободный номер.
+MIGRATIONS = {
+    1: migrate_team_members,
+    2: MIGRATE_RANK_INDEX,
+    3: migrate_inventory,
+    4: migrate_energy_tick,
+    6: migrate_player_version,
+    7: MIGRATE_USERNAME_INDEX,
+    8: MIGRATE_TEAMS_LEADER_INDEX,
+}
+
+def register_migration(step: int, migration):
+    """migration — SQL или fn(conn), как у Database.migrate; step — его постоянный номер."""
+    if MIGRATIONS.setdefault(step, migration) is not migration:
+        raise ValueError(f"номер миграции {step} уже занят")
+
+def migrations() -> list:
+    missing = sorted(set(range(1, max(MIGRATIONS) + 1)) - set(MIGRATIONS))
+    if missing:
+        # пропущенный шаг сдвинул бы номера всех следующих
+        raise RuntimeError(f"миграции {missing} не зарегистрированы: модуль не импортирован?")
+    return [MIGRATIONS[i] for i in sorted(MIGRATIONS)]
+
+async def init_sqlite(db):
+    await db.executescript(SCHEMA)
+    await db.migrate(migrations())
+
+
+# ------------ SQLite: игроки ------------
+GET_MANY_CHUNK = 500  # user_id в одном IN (...)
+# инвентарь приходит тем же запросом в виде "item:qty,item:qty"
+SQL_SELECT_PLAYERS = (
+    f"SELECT {', '.join('p.' + c for c in PLAYER_COLUMNS)}, "
+    "(SELECT group_concat(i.item_key || ':' || i.qty) FROM inventory i WHERE i.user_id = p.user_id), "
+    "p.version FROM players p"
+)
+# запросы держим константами, чтобы sqlite3 переиспользовал подготовленные выражения
+SQL_LOAD_PLAYER = SQL_SELECT_PLAYERS + " WHERE p.user_id = ?"
+SQL_RANKING = "SELECT user_id, name, lvl, xp FROM players ORDER BY lvl DESC, xp DESC, user_id"
+SQL_FIND_BY_USERNAME = "SELECT user_id FROM players WHERE username = ? COLLATE NOCASE LIMIT 1"
+
+# Регенерация энергии тем же правилом, что current_energy в боте: целые
+# единицы за прошедшее время, отметка сдвигается на потраченные на них
+# секунды, а при полной энергии становится текущим временем.
+SQL_REGEN_SLICE = (
+    "SELECT max(user_id) FROM (SELECT user_id FROM players WHERE user_id > ? ORDER BY user_id LIMIT ?)"
+)
+_REGEN_GAINED = "CAST((julianday(:now) - julianday(last_energy_tick)) * 86400 / :regen AS INTEGER)"
+SQL_REGEN_ENERGY = f"""
+UPDATE players SET
+    energy = min(:max, energy + {_REGEN_GAINED}),
+    last_energy_tick = CASE WHEN energy + {_REGEN_GAINED} >= :max THEN :now
+        ELSE strftime('%Y-%m-%dT%H:%M:%f+00:00', julianday(last_energy_tick) + {_REGEN_GAINED} * :regen / 86400.0) END,
+    version = version + 1
+WHERE user_id > :after AND user_id <= :hi AND energy < :max AND last_energy_tick != ''
+    AND {_REGEN_GAINED} >= 1"""
+
+
+def _regen_energy(conn, after, limit, exclude, now):
+    hi = conn.execute(SQL_REGEN_SLICE, (after, limit)).fetchone()[0]
+    if hi is None:
+        return None, []
+    params = {"after": after, "hi": hi, "now": now, "max": MAX_ENERGY, "regen": ENERGY_REGEN_SECONDS}
+    skip = [uid for uid in exclude if after < uid <= hi]
+    sql = SQL_REGEN_ENERGY
+    if skip:
+        sql += f" AND user_id NOT IN ({','.join(f':x{i}' for i in range(len(skip)))})"
+        params.update((f"x{i}", uid) for i, uid in enumerate(skip))
+    return hi, [r[0] for r in conn.execute(sql + " RETURNING user_id", params).fetchall()]
+
+
+def sqlite_inventory_rows(p, fields):
+    # инвентарь игрока переписывается целиком: это несколько строк, по одной на вид предмета
+    if "inventory" not in fields:
+        return []
+    rows = [("DELETE FROM inventory WHERE user_id = ?", (p.user_id,))]
+    rows += [
+        ("INSERT INTO inventory (user_id, item_key, qty) VALUES (?, ?, ?)", (p.user_id, key, qty))
+        for key, qty in p.inventory.items()
+        if qty > 0
+    ]
+    return rows
+
+
+class SqlitePlayerRepo(PlayerRepo):
+    def __init__(self, db):
+        self.db = db
+        self.writer = TableWriter(
+            db, self.table, "user_id", PLAYER_COLUMNS, extra=sqlite_inventory_rows, version="version",
+        )
+
+    async def get(self, user_id: int):
+        return await self.db.fetchone(SQL_LOAD_PLAYER, (user_id,))
+
+    async def get_many(self, user_ids) -> list:
+        # порциями: участников рейда больше, чем параметров в одном запросе SQLite
+        user_ids = tuple(user_ids)
+        rows = []
+        for i in range(0, len(user_ids), GET_MANY_CHUNK):
+            part = user_ids[i:i + GET_MANY_CHUNK]
+            marks = ",".join("?" * len(part))
+            rows += await self.db.fetchall(SQL_SELECT_PLAYERS + f" WHERE p.user_id IN ({marks})", part)
+        return rows
+
+    async def find_by_username(self, username: str) -> int | None:
+        row = await self.db.fetchone(SQL_FIND_BY_USERNAME, (username,))
+        return row[0] if row else None
+
+    async def ranking(self, limit: int | None = None) -> list:
+        if limit is None:
+            return await self.db.fetchall(SQL_RANKING)
+        return await self.db.fetchall(SQL_RANKING + " LIMIT ?", (limit,))
+
+    async def regen_energy(self, after: int, limit: int, exclude, now: str) -> tuple:
+        return await self.db.transaction(_regen_energy, after, limit, exclude, now)
+
+    def prepare(self, changes):
+        return self.writer.prepare(changes)
+
+    async def apply(self, batch):
+        await self.writer.apply(batch)
+
+
+# ------------ SQLite: команды ------------
+# Все активные команды игрока вместе с составом — один запрос по индексам.
+# CROSS JOIN фиксирует порядок: сначала строки игрока из team_members,
+# иначе планировщик может начать с перебора всех активных команд.
+SQL_USER_TEAMS = """
+SELECT t.team_id, t.leader_id, m.user_id, p.username, p.name
+FROM team_members me
+CROSS JOIN teams t ON t.team_id = me.team_id AND t.active = 1
+CROSS JOIN team_members m ON m.team_id = me.team_id
+LEFT JOIN players p ON p.user_id = m.user_id
+WHERE me.user_id = ?
+ORDER BY t.team_id
+"""
+
+def _create_team(conn, leader_id: int, member_ids: list):
+    cur = conn.execute(
+        "INSERT INTO teams (leader_id, member_ids, active) VALUES (?,?,1)",
+        (leader_id, ",".join(str(uid) for uid in member_ids)),
+    )
+    conn.executemany(
+        "INSERT OR IGNORE INTO team_members (team_id, user_id) VALUES (?, ?)",
+        [(cur.lastrowid, uid) for uid in member_ids],
+    )
+    return cur.lastrowid
+
+def _join_team(conn, leader_id: int, user_id: int):
+    row = conn.execute(
+        "SELECT team_id FROM teams WHERE leader_id = ? AND active = 1 ORDER BY team_id LIMIT 1", (leader_id,),
+    ).fetchone()
+    if row is None:
+        return _create_team(conn, leader_id, [leader_id, user_id]), True
+    team_id = row[0]
+    added = conn.execute(
+        "INSERT OR IGNORE INTO team_members (team_id, user_id) VALUES (?, ?)", (team_id, user_id),
+    ).rowcount
+    if added:
+        conn.execute(
+            "UPDATE teams SET member_ids = coalesce(member_ids || ',', '') || ? WHERE team_id = ?", (str(user_id), team_id),
+        )
+    return team_id, False
+
+
+class SqliteTeamRepo(TeamRepo):
+    def __init__(self, db):
+        self.db = db
+
+    async def user_teams(self, user_id: int) -> list:
+        return await self.db.fetchall(SQL_USER_TEAMS, (user_id,))
+
+    async def create(self, leader_id: int, member_ids: list) -> int:
+        return await self.db.transaction(_create_team, leader_id, member_ids)
+
+    async def join(self, leader_id: int, user_id: int) -> tuple:
+        return await self.db.transaction(_join_team, leader_id, user_id)
@@ -0,0 +1,87 @@
+"""
+Маршрутизатор колбэков inline-кнопок.
+
+callback_data имеет вид "префикс:арг:арг". Строка разбирается один раз,
+обработчик берётся из словаря по префиксу — вместо цепочки
+CallbackQueryHandler, где каждый колбэк проверяется регулярками по очереди.
+Аргументы попадают в context.args, как у команд.
+"""
+
+from telegram import Update
+from telegram.ext import BaseHandler
+
+# предел Telegram на callback_data, в байтах
+MAX_CALLBACK_DATA = 64
+
+
+def pack(prefix: str, *args) -> str:
+    data = ":".join((prefix, *map(str, args)))
+    if len(data.encode()) > MAX_CALLBACK_DATA:
+        raise ValueError(f"callback_data длиннее {MAX_CALLBACK_DATA} байт: {data!r}")
+    return data
+
+
+class Route:
+    __slots__ = ("callback", "owner", "answer")
+
+    def __init__(self, callback, owner: bool, answer: bool = True):
+        self.callback = callback
+        self.owner = owner
+        self.answer = answer
+
+
+class CallbackRouter(BaseHandler):
+    """
+    Один обработчик на все колбэки.
+
+    add(prefix, callback, aliases=..., owner=...): aliases — старые
+    префиксы, кнопки с которыми уже разосланы. owner=True — первый
+    аргумент это user_id владельца кнопки: чужое нажатие отклоняется,
+    а сам аргумент в context.args не попадает.
+
+    Запрос отвечается (query.answer) здесь, до вызова обработчика,
+    поэтому сами обработчики answer() не вызывают. Исключение — answer=False:
+    обработчик отвечает сам, всплывающим текстом вместо правки сообщения.
+    Колбэки с неизвестным префиксом тоже отвечаются, чтобы у кнопки не
+    висели «часики».
+    """
+
+    def __init__(self):
+        super().__init__(self._unknown)
+        self.routes: dict = {}  # префикс (и псевдонимы) -> Route
+
+    def add(self, prefix: str, callback, aliases=(), owner: bool = False, answer: bool = True):
+        route = Route(callback, owner, answer)
+        for key in (prefix, *aliases):
+            if key in self.routes:
+                raise ValueError(f"префикс {key!r} уже занят")
+            self.routes[key] = route
+
+    def check_update(self, update: object):
+        if not (isinstance(update, Update) and update.callback_query):
+            return None
+        data = update.callback_query.data
+        if not isinstance(data, str):
+            return None
+        prefix, *args = data.split(":")
+        return self.routes.get(prefix), args
+
+    async def handle_update(self, update, application, check_result, context):
+        route, args = check_result
+        query = update.callback_query
+        if route is None:
+            await query.answer()
+            return None
+        if route.owner:
+            if not args or args[0] != str(query.from_user.id):
+                await query.answer("Это меню другого игрока.", show_alert=True)
+                return None
+            args = args[1:]
+        context.args = args
+        if route.answer:
+            await query.answer()
+        return await route.callback(update, context)
+
+    async def _unknown(self, update, context):
+        # колбэк по умолчанию нужен BaseHandler; сюда handle_update не ходит
+        return None
@@ -9,12 +9,17 @@ from dotenv import load_dotenv
 load_dotenv()  # Это загрузит переменные окружения из файла .env
 import os
 import shutil
+import hashlib
+import tempfile
 import sqlite3
 import asyncio
 import random
+import time
+import functools
+import logging
+from bisect import bisect_right
 from dataclasses import dataclass, asdict
-from datetime import datetime, timedelta
-import requests
+from datetime import datetime, timedelta, timezone
 
 from telegram import (
     Update,
@@ -23,81 +28,103 @@ from telegram import (
     ReplyKeyboardRemove,
     ChatPermissions,
 )
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     ApplicationBuilder,
     ContextTypes,
     CommandHandler,
     MessageHandler,
     filters,
-    CallbackQueryHandler,
+    TypeHandler,
+    ApplicationHandlerStop,
 )
 
-# ------------ Конфигурация и данные игры ------------
+from storage import Database, Snapshot, WriteBehindCache, StaleWrite
+from repos import PLAYER_COLUMNS, SqlitePlayerRepo, SqliteTeamRepo, init_sqlite
+from postgres import PgDatabase, PgPlayerRepo, PgTeamRepo, init_postgres
+from leaderboard import Leaderboard
+from concurrency import KeyedLocks, Throttle, Coalescer
+from outbox import Outbox
+from router import CallbackRouter, pack
+from media import MediaCache
+from invites import InviteRegistry
+from duels import DuelRegistry
+from raids import RaidRegistry
+from gamelog import GameLog
+from analytics import Analytics
+from scheduler import Scheduler
+from metrics import registry as metrics, TimedRequest
+from gamedata import (
+    STYLES, ITEMS, LEVELS, DAILY_EXP_BONUS, MAX_ENERGY, ENERGY_REGEN_SECONDS,
+    LEVEL_UP_HP, LEVEL_UP_ATK, LEVEL_THRESHOLDS,
+)
+import battle
+import webhook
+
+logger = logging.getLogger("sailor_bot")
+
+# ------------ Конфигурация (данные игры — в gamedata.py) ------------
+# Импорт модуля ничего не скачивает и не проверяет: всё это делает main()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
-if not BOT_TOKEN:
-    raise RuntimeError("Пожалуйста, укажи BOT_TOKEN через переменную окружения.")
 WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or None  # проверяется в заголовке каждого апдейта
 PORT = int(os.getenv("PORT", 10000))
-
-DB_PATH = "/data/sailor.db"  # временный путь на контейнере
-GITHUB_DB_URL = "https://raw.githubusercontent.com/nkbss-nkbss/SailorMoonGameBot/main/sailor.db"
-
-if not os.path.exists(DB_PATH):
-    # вариант 1: скачиваем напрямую из GitHub
-    r = requests.get(GITHUB_DB_URL)
-    with open(DB_PATH, "wb") as f:
-        f.write(r.content)
-
-r = requests.get(GITHUB_DB_URL)
-
-STYLES = {
-    "luna": {"name": "Сейлор Мун 🌙", "hp_base": 30, "atk_base": 3, "img": "https://i.pinimg.com/1200x/6a/02/19/6a0219632e0cf643b21a15f134ba79c4.jpg" },
-    "fire": {"name": "Сейлор Марс 🔥", "hp_base": 26, "atk_base": 5, "img": "https://i.pinimg.com/736x/38/ee/d2/38eed255dd4c9895304dfe7aa03fda0e.jpg"},
-    "jupiter": {"name": "Сейлор Юпитер ⚡", "hp_base": 34, "atk_base": 4, "img": "https://i.pinimg.com/736x/b8/f7/ba/b8f7ba5311e3d8acea0834aedbf5dda6.jpg"},
-    "water": {"name": "Сейлор Меркурий 💧", "hp_base": 32, "atk_base": 3, "img": "https://i.pinimg.com/736x/b1/61/1a/b1611addcf1190d311218c22614e1e36.jpg"},
-    "love": {"name": "Сейлор Венера 💖", "hp_base": 28, "atk_base": 4, "img": "https://i.pinimg.com/736x/91/c1/f6/91c1f699cc6764e6dd2af9b660d709ba.jpg"},
-}
-
-ITEMS = {
-    "luna_brooch": {"title": "Лунная брошь", "desc": "Небольшой бонус к атаке", "price": 50, "atk": 2},
-    "healing_herb": {"title": "Лунный эликсир", "desc": "Восстанавливает энергию/HP", "price": 30, "heal": 10},
-    "moon_crystal": {"title": "Лунный кристалл", "desc": "Редкий ресурс для трансформаций", "price": 0, "rare": True},
-}
-
-MONSTERS = [
-    {"id": "m1", "name": "Слабый демон", "lvl": 1, "hp": 8, "atk": 2, "reward_xp": 10, "reward_gold": 10},
-    {"id": "m2", "name": "Средний демон", "lvl": 2, "hp": 14, "atk": 3, "reward_xp": 18, "reward_gold": 18},
-    {"id": "m3", "name": "Сильный демон", "lvl": 3, "hp": 22, "atk": 5, "reward_xp": 35, "reward_gold": 40},
-    {"id": "m4", "name": "Сильный демон", "lvl": 4, "hp": 30, "atk": 7, "reward_xp": 45, "reward_gold": 50},
-
-    {"id": "boss1", "name": "👾 БОСС: Джедайт", "lvl": 5, "hp": 50, "atk": 8, "reward_xp": 120, "reward_gold": 120},
-    {"id": "boss2", "name": "👾 БОСС: Нефрит", "lvl": 10, "hp": 60, "atk": 9, "reward_xp": 120, "reward_gold": 120},
-    {"id": "boss3", "name": "👾 БОСС: Зойсайт", "lvl": 15, "hp": 70, "atk": 10, "reward_xp": 120, "reward_gold": 120},
-    {"id": "boss4", "name": "👾 БОСС: Кунсайт", "lvl": 20, "hp": 80, "atk": 20, "reward_xp": 120, "reward_gold": 120},
-
-    {"id": "boss5", "name": "👾 БОСС: Петсайт", "lvl": 5, "hp": 50, "atk": 8, "reward_xp": 120, "reward_gold": 120},
-    {"id": "boss6", "name": "👾 БОСС: Калаверайт", "lvl": 10, "hp": 60, "atk": 9, "reward_xp": 120, "reward_gold": 120},
-    {"id": "boss7", "name": "👾 БОСС: Бертерайт", "lvl": 15, "hp": 70, "atk": 10, "reward_xp": 120, "reward_gold": 120},
-    {"id": "boss8", "name": "👾 БОСС: Кермисайт", "lvl": 20, "hp": 80, "atk": 20, "reward_xp": 120, "reward_gold": 120},
-
-    {"id": "superboss1", "name": "👹💥 СУПЕРБОСС: Королева Погибель", "lvl": 50, "hp": 90, "atk": 20, "reward_xp": 200, "reward_gold": 200},
-    {"id": "superboss2", "name": "👹💥 СУПЕРБОСС: Рубеус", "lvl": 50, "hp": 90, "atk": 20, "reward_xp": 200, "reward_gold": 200},
-    {"id": "superboss3", "name": "👹💥 СУПЕРБОСС: Изумруд", "lvl": 50, "hp": 90, "atk": 20, "reward_xp": 200, "reward_gold": 200},
-    {"id": "superboss4", "name": "👹💥 СУПЕРБОСС: Мудрец", "lvl": 50, "hp": 90, "atk": 20, "reward_xp": 200, "reward_gold": 200},
-
-
-
-]
-
-LEVELS = [
-    (0, "Сейлор-новичок"),
-    (50, "Сейлор-защитник"),
-    (150, "Сейлор-воительница"),
-    (350, "Лунная принцесса"),
-    (700, "Лунная королева"),
-]
-
-DAILY_EXP_BONUS = 5
+# Несколько процессов на одном порту. Тогда база — единственное общее
+# состояние: игроки пишутся сразу и с проверкой версии, кеш не держит
+# их между апдейтами, рейтинг периодически перечитывается.
+WORKERS = max(1, int(os.getenv("WORKERS", 1)))
+SHARED_STATE = WORKERS > 1
+# номер этого процесса (задаёт build_application); обслуживание общей базы выполняет только воркер 0
+WORKER = 0
+
+DB_PATH = os.getenv("DB_PATH", "/data/sailor.db")  # временный путь на контейнере
+# postgresql://… — игроки и команды живут на сервере PostgreSQL (см. postgres.py);
+# SQLite в DB_PATH тогда хранит только локальный кеш file_id картинок;
+# игроков и команды из неё на сервер переносит copy_to_postgres.py
+DATABASE_URL = os.getenv("DATABASE_URL", "")
+DATABASE_POOL_SIZE = int(os.getenv("DATABASE_POOL_SIZE", 10))
+GITHUB_DB_URL = os.getenv(
+    "SEED_DB_URL", "https://raw.githubusercontent.com/nkbss-nkbss/SailorMoonGameBot/main/sailor.db"
+)
+SEED_DB_SHA256 = os.getenv("SEED_DB_SHA256", "")  # пусто — проверяем только заголовок SQLite
+# чат (например, служебный канал), куда при старте заливаются картинки стихий ради file_id
+MEDIA_WARMUP_CHAT_ID = int(os.getenv("MEDIA_WARMUP_CHAT_ID") or 0)
+# антиспам: команд и нажатий в секунду на игрока и допустимый всплеск; 0 — без ограничения
+THROTTLE_RATE = float(os.getenv("THROTTLE_RATE", 1))
+THROTTLE_BURST = float(os.getenv("THROTTLE_BURST", 5))
+# BATTLE_SEED делает броски воспроизводимыми (отладка, нагрузочные прогоны)
+BATTLE_SEED = os.getenv("BATTLE_SEED")
+battle_rng = random.Random(int(BATTLE_SEED) if BATTLE_SEED else None)
+
+# ------------ Клавиатуры (строятся один раз при импорте) ------------
+# Префиксы callback_data короткие: кнопка несёт "префикс:аргументы" в 64 байтах.
+# Старые длинные префиксы остаются псевдонимами в build_application().
+CB_STYLE = "st"
+CB_BUY = "b"
+# "ta"/"td" несли id лидера, их кнопки больше не принимаются (см. stale_invite_cb)
+CB_TEAM_ACCEPT = "ia"
+CB_TEAM_DECLINE = "id"
+CB_PROFILE = "pr"
+CB_INVENTORY = "in"
+CB_FIGHT = "f"
+CB_TEAM = "tm"
+CB_TEAMUP = "tu"
+CB_LEADERBOARD = "lb"
+CB_EXPLORE = "ex"
+CB_TEAMFIGHT = "tf"
+CB_BATTLE = "bb"
+CB_DUEL = "bt"  # ход пошагового боя: владелец, действие, номер хода
+CB_RAID = "ra"
+
+STYLE_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton(val["name"], callback_data=pack(CB_STYLE, key))]
+    for key, val in STYLES.items()
+])
+SHOP_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton(f"{it['title']} — {it['price']}💠", callback_data=pack(CB_BUY, key))]
+    for key, it in ITEMS.items()
+    if it.get("price", 0) > 0
+])
 
 # ------------ Вспомогательные структуры ------------
 @dataclass
@@ -114,47 +141,186 @@ class Player:
     atk: int
     energy: int
     last_daily: str  # date iso
-    inventory: str  # comma-separated item keys
+    last_energy_tick: str  # iso; с этого момента копится регенерация энергии
+    inventory: dict  # item_key -> количество, хранится в таблице inventory
+    version: int = 0  # версия строки в базе; 0 — ещё не сохранён
+
+    # Отслеживание изменённых полей для отложенной записи (см. player_cache).
+    # Новый объект целиком считается несохранённым.
+    def __post_init__(self):
+        self._dirty = set(PLAYER_COLUMNS) | {"inventory"}
+
+    def __setattr__(self, name, value):
+        dirty = self.__dict__.get("_dirty")
+        if dirty is not None and self.__dict__.get(name) != value:
+            dirty.add(name)
+        object.__setattr__(self, name, value)
 
 # ------------ База данных ------------
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS players (
-            user_id INTEGER PRIMARY KEY,
-            username TEXT,
-            name TEXT,
-            style TEXT,
-            lvl INTEGER,
-            xp INTEGER,
-            gold INTEGER,
-            hp INTEGER,
-            max_hp INTEGER,
-            atk INTEGER,
-            energy INTEGER,
-            last_daily TEXT,
-            inventory TEXT,
-            last_energy_tick TEXT DEFAULT '' 
-        )
-        """
-    )
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS teams (
-            team_id INTEGER PRIMARY KEY AUTOINCREMENT,
-            leader_id INTEGER,
-            member_ids TEXT, -- comma-separated
-            active INTEGER DEFAULT 1
-        )
-        """
-    )
-    conn.commit()
-    conn.close()
+# Одно долгоживущее хранилище на процесс: соединения открываются один раз,
+# запросы выполняются на потоках storage.Database и не блокируют event loop.
+db = Database(DB_PATH)
+db.observer = metrics.observe_query
+
+# Игроки и команды — только через репозитории: обработчики не знают,
+# SQLite под ними или сервер
+if DATABASE_URL:
+    server_db = PgDatabase(DATABASE_URL, max_size=DATABASE_POOL_SIZE)
+    server_db.observer = metrics.observe_query
+    player_repo = PgPlayerRepo(server_db)
+    team_repo = PgTeamRepo(server_db)
+else:
+    server_db = None
+    player_repo = SqlitePlayerRepo(db)
+    team_repo = SqliteTeamRepo(db)
+
+PLAYER_CACHE_SIZE = int(os.getenv("PLAYER_CACHE_SIZE", 10000))
+PLAYER_CACHE_TTL = float(os.getenv("PLAYER_CACHE_TTL", 0 if SHARED_STATE else 600))
+PLAYER_FLUSH_INTERVAL = float(os.getenv("PLAYER_FLUSH_INTERVAL", 5))
+
+# Горячие игроки живут в памяти: чтение без диска, запись — пачками
+# по таймеру (задача flush_players планировщика)
+player_cache = WriteBehindCache(
+    player_repo, "user_id", maxsize=PLAYER_CACHE_SIZE, ttl=PLAYER_CACHE_TTL, version="version",
+)
+
+async def init_db():
+    # локальная SQLite нужна всегда: в ней как минимум кеш file_id картинок
+    await init_sqlite(db)
+    if server_db is not None:
+        await init_postgres(server_db)
+
+async def close_db():
+    await snapshot.close()
+    await db.close()
+    if server_db is not None:
+        await server_db.close()
+
+# Копия локальной базы только для чтения: аналитика и перечитывание рейтинга
+# идут в неё и не делят файл с записью. С серверной базой игроков в ней нет,
+# и рейтинг читается с сервера.
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH", DB_PATH + ".snapshot")
+SNAPSHOT_INTERVAL = float(os.getenv("SNAPSHOT_INTERVAL", 300))
+SNAPSHOT_PAGES = int(os.getenv("SNAPSHOT_PAGES", 1024))
+snapshot = Snapshot(DB_PATH, SNAPSHOT_PATH, pages=SNAPSHOT_PAGES)
+snapshot.observer = metrics.observe_query
+analytics = Analytics(snapshot)
+ranking_repo = player_repo if server_db is not None else SqlitePlayerRepo(snapshot)
+
+SQLITE_MAGIC = b"SQLite format 3\x00"
+
+def bootstrap_db(path: str = DB_PATH, url: str = GITHUB_DB_URL, sha256: str = SEED_DB_SHA256) -> bool:
+    """
+    Скачивает стартовую базу, только если файла ещё нет.
+    Файл качается потоком во временный файл рядом с базой, проверяется
+    (sha256, если задан, иначе заголовок SQLite) и только потом
+    переименовывается. При любой ошибке базы не будет, и init_db создаст
+    пустую схему. Возвращает True, если база была скачана.
+    """
+    if os.path.exists(path) or not url:
+        return False
+    import requests  # нужен только здесь, не тянем его при импорте модуля
+
+    folder = os.path.dirname(path) or "."
+    os.makedirs(folder, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=folder, suffix=".download")
+    try:
+        digest = hashlib.sha256()
+        head = b""
+        with os.fdopen(fd, "wb") as f, requests.get(url, stream=True, timeout=(5, 30)) as r:
+            r.raise_for_status()
+            for chunk in r.iter_content(chunk_size=1 << 16):
+                if len(head) < len(SQLITE_MAGIC):
+                    head += chunk[: len(SQLITE_MAGIC)]
+                digest.update(chunk)
+                f.write(chunk)
+        if sha256:
+            ok = digest.hexdigest() == sha256.lower()
+        else:
+            ok = head.startswith(SQLITE_MAGIC)
+        if not ok:
+            print("Стартовая база не прошла проверку, создаём пустую схему.")
+            return False
+        os.replace(tmp, path)
+        return True
+    except Exception as e:
+        print(f"Не удалось скачать стартовую базу: {e}")
+        return False
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+# ------------ Рейтинг ------------
+LEADERBOARD_SIZE = 10
+# с несколькими воркерами топ перечитывается не реже раза в LEADERBOARD_MAX_AGE,
+# а все очки (для места игрока) — раз в LEADERBOARD_RELOAD секунд
+LEADERBOARD_MAX_AGE = float(os.getenv("LEADERBOARD_MAX_AGE", 5))
+LEADERBOARD_RELOAD = float(os.getenv("LEADERBOARD_RELOAD", 300))
+leaderboard = Leaderboard(size=LEADERBOARD_SIZE, max_age=LEADERBOARD_MAX_AGE if SHARED_STATE else 0)
+
+async def load_leaderboard(repo=None):
+    leaderboard.load(await (repo or player_repo).ranking())
+
+async def refill_leaderboard():
+    # нужен, когда игрок выпал из топа и его место неизвестно или топ устарел
+    await player_cache.flush()
+    leaderboard.refill(await player_repo.ranking(LEADERBOARD_SIZE))
+
+# ------------ Команды: хранение ------------
+@dataclass
+class Team:
+    team_id: int
+    leader_id: int
+    members: list  # [(user_id, отображаемое имя)] в порядке вступления
+
+async def get_user_teams(user_id: int) -> list[Team]:
+    rows = await team_repo.user_teams(user_id)
+    teams = {}
+    for team_id, leader_id, uid, username, name in rows:
+        team = teams.get(team_id)
+        if team is None:
+            team = teams[team_id] = Team(team_id, leader_id, [])
+        # несброшенные изменения имени берём из кеша
+        cached = player_cache.get(uid)
+        if cached is not None:
+            username, name = cached.username, cached.name
+        team.members.append((uid, username or name or str(uid)))
+    return list(teams.values())
+
+async def load_players(user_ids) -> dict:
+    """Загружает сразу нескольких игроков: кеш + один запрос на промахи."""
+    found, missing = {}, []
+    for uid in user_ids:
+        p = player_cache.get(uid)
+        if p is not None:
+            found[uid] = p
+        else:
+            missing.append(uid)
+    if missing:
+        for r in await player_repo.get_many(missing):
+            p = player_cache.add(player_from_row(r))
+            found[p.user_id] = p
+    return found
+
+def snapshot_players(players) -> list:
+    return [
+        (p, {c: getattr(p, c) for c in PLAYER_COLUMNS}, dict(p.inventory), set(p._dirty))
+        for p in players
+    ]
 
-def get_conn():
-    return sqlite3.connect(DB_PATH)
+def restore_players(snapshot):
+    # откат изменений в памяти, если транзакция не прошла
+    for p, values, inventory, dirty in snapshot:
+        cur_lvl, cur_xp = p.lvl, p.xp
+        for c, v in values.items():
+            object.__setattr__(p, c, v)
+        object.__setattr__(p, "inventory", inventory)
+        # рейтинг уже сдвинут add_xp_and_check_level — вернуть прежние очки
+        leaderboard.update(p.user_id, p.name, cur_lvl, cur_xp, p.lvl, p.xp)
+        p._dirty = dirty
+        # устаревших (StaleWrite) кеш уже выбросил — обратно не кладём
+        if p.user_id in player_cache:
+            player_cache.mark_dirty(p)
 
 # ------------ Игровая логика ------------
 def create_player_obj(user_id: int, username: str, name: str, style: str) -> Player:
@@ -174,46 +340,43 @@ def create_player_obj(user_id: int, username: str, name: str, style: str) -> Pla
         atk=atk,
         energy=5,
         last_daily="",
-        inventory="",
+        last_energy_tick="",
+        inventory={},
     )
 
-def save_player(p: Player):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        INSERT OR REPLACE INTO players (
-            user_id, username, name, style, lvl, xp, gold, hp, max_hp, atk, energy, last_daily, inventory
-        ) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)
-        """,
-        (
-            p.user_id,
-            p.username,
-            p.name,
-            p.style,
-            p.lvl,
-            p.xp,
-            p.gold,
-            p.hp,
-            p.max_hp,
-            p.atk,
-            p.energy,
-            p.last_daily,
-            p.inventory,
-        ),
-    )
-    conn.commit()
-    conn.close()
-
-def load_player(user_id: int) -> Player | None:
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM players WHERE user_id = ?", (user_id,))
-    r = cur.fetchone()
-    conn.close()
-    if not r:
-        return None
-    return Player(
+async def save_player(p: Player, event: str | None = None, **info):
+    """event — вид события для журнала game_log, info — его подробности."""
+    fields = set(p._dirty)
+    if SHARED_STATE:
+        # другие воркеры читают базу напрямую: пишем сразу, с проверкой версии
+        await player_cache.write_through([p])
+    else:
+        # на диск попадёт при ближайшем сбросе player_cache
+        player_cache.mark_dirty(p)
+    if event:
+        log_event(event, p, fields, **info)
+
+# ------------ Журнал событий ------------
+# Событие ставится в буфер сразу после save_player, но на диск журнал и
+# строка игрока попадают отдельными транзакциями: журнал — раз в
+# GAME_LOG_FLUSH_INTERVAL (1 с, задача flush_game_log), строка — раз в
+# PLAYER_FLUSH_INTERVAL (5 с, flush_players; с SHARED_STATE — сразу).
+# После сбоя журнал может опережать players на несколько секунд (их
+# восстанавливает gamelog.py replay) или, с SHARED_STATE, отставать на
+# последнюю несброшенную пачку событий.
+GAME_LOG_FLUSH_INTERVAL = float(os.getenv("GAME_LOG_FLUSH_INTERVAL", 1))
+GAME_LOG_SNAPSHOT_INTERVAL = float(os.getenv("GAME_LOG_SNAPSHOT_INTERVAL", 60))
+GAME_LOG_SNAPSHOT_BATCH = int(os.getenv("GAME_LOG_SNAPSHOT_BATCH", 5000))
+LOGGED_FIELDS = PLAYER_COLUMNS[1:] + ("inventory",)
+game_log = GameLog(db)
+
+def log_event(kind: str, p: Player, fields, **info):
+    # значения изменённых полей после события; золото всегда — для аудита по dg
+    state = {f: getattr(p, f) for f in LOGGED_FIELDS if f in fields or f == "gold"}
+    game_log.record(kind, p.user_id, state, **info)
+
+def player_from_row(r) -> Player:
+    p = Player(
         user_id=r[0],
         username=r[1],
         name=r[2],
@@ -226,161 +389,334 @@ def load_player(user_id: int) -> Player | None:
         atk=r[9],
         energy=r[10],
         last_daily=r[11] or "",
-        inventory=r[12] or "",
+        last_energy_tick=r[12] or "",
+        inventory=parse_inventory(r[13]),
+        version=r[14],
     )
+    p._dirty.clear()
+    return p
+
+# энергия и отметка регенерации согласованы только вместе
+ENERGY_FIELDS = {"energy", "last_energy_tick"}
+
+async def rebase_players(players):
+    """
+    Для player_cache.rebase: строка игрока изменилась мимо кеша (в одном
+    процессе это делает только regen_energy_job) — берём её значения и
+    версию, оставляя несохранённые поля из памяти. Энергия в памяти
+    считается тем же правилом, что и фоновая регенерация, поэтому её
+    изменение не теряет начисленного.
+    """
+    fresh = {r[0]: player_from_row(r) for r in await player_repo.get_many([p.user_id for p in players])}
+    for p in players:
+        row = fresh.get(p.user_id)
+        if row is None:
+            continue
+        keep = set(p._dirty)
+        if keep & ENERGY_FIELDS:
+            keep |= ENERGY_FIELDS
+        for c in (*PLAYER_COLUMNS, "inventory", "version"):
+            if c not in keep:
+                object.__setattr__(p, c, getattr(row, c))
+
+if not SHARED_STATE:
+    # у нескольких воркеров конфликт версий означает чужую запись — её не перетираем
+    player_cache.rebase = rebase_players
+
+async def load_player(user_id: int, user=None) -> Player | None:
+    """user — пользователь Telegram из апдейта: по нему обновляется сохранённый ник."""
+    p = player_cache.get(user_id)
+    if p is None:
+        r = await player_repo.get(user_id)
+        if not r:
+            return None
+        p = player_cache.add(player_from_row(r))
+    if user is not None and (user.username or "") != p.username:
+        # игрок сменил ник: иначе /teamup не найдёт его по новому
+        p.username = user.username or ""
+        player_cache.mark_dirty(p)
+    return p
 
 def level_name_for_xp(xp: int):
-    name = LEVELS[0][1]
-    lvl = 1
-    for req, title in LEVELS:
-        if xp >= req:
-            name = title
-    # derive numeric level as index of LEVELS that xp >= req
-    for i, (req, _) in enumerate(LEVELS):
-        if xp >= req:
-            lvl = i+1
-    return lvl, name
+    # numeric level is the count of LEVELS thresholds that xp has reached
+    lvl = max(1, bisect_right(LEVEL_THRESHOLDS, xp))
+    return lvl, LEVELS[lvl - 1][1]
 
 def add_xp_and_check_level(p: Player, add_xp: int):
+    old_xp = p.xp
     p.xp += add_xp
     old_lvl = p.lvl
     new_lvl, _ = level_name_for_xp(p.xp)
     p.lvl = new_lvl
+    leaderboard.update(p.user_id, p.name, old_lvl, old_xp, p.lvl, p.xp)
     # if leveled up, give small bonus
     leveled = False
     if new_lvl > old_lvl:
         leveled = True
-        p.max_hp += 5 * (new_lvl - old_lvl)
-        p.atk += 1 * (new_lvl - old_lvl)
+        p.max_hp += LEVEL_UP_HP * (new_lvl - old_lvl)
+        p.atk += LEVEL_UP_ATK * (new_lvl - old_lvl)
         p.hp = p.max_hp
     return leveled
 
-def add_item_to_player(p: Player, item_key: str):
-    inv = p.inventory.split(",") if p.inventory else []
-    inv.append(item_key)
-    p.inventory = ",".join([i for i in inv if i])
+def parse_inventory(raw: str | None) -> dict:
+    inv = {}
+    for part in (raw or "").split(","):
+        key, _, qty = part.partition(":")
+        if key:
+            inv[key] = int(qty or 1)
+    return inv
+
+def add_item_to_player(p: Player, item_key: str, qty: int = 1):
+    p.inventory[item_key] = p.inventory.get(item_key, 0) + qty
+    p._dirty.add("inventory")
 
 def consume_item_from_player(p: Player, item_key: str) -> bool:
-    inv = p.inventory.split(",") if p.inventory else []
-    if item_key in inv:
-        inv.remove(item_key)
-        p.inventory = ",".join([i for i in inv if i])
-        return True
-    return False
+    have = p.inventory.get(item_key, 0)
+    if have <= 0:
+        return False
+    if have == 1:
+        del p.inventory[item_key]
+    else:
+        p.inventory[item_key] = have - 1
+    p._dirty.add("inventory")
+    return True
 
 def get_inventory_list(p: Player):
-    if not p.inventory:
-        return []
-    return [i for i in p.inventory.split(",") if i]
+    """[(item_key, количество)] в порядке получения."""
+    return [(key, qty) for key, qty in p.inventory.items() if qty > 0]
+
+def item_title(item_key: str, qty: int) -> str:
+    title = ITEMS[item_key]["title"] if item_key in ITEMS else item_key
+    return f"{title} ×{qty}" if qty > 1 else title
 
+@functools.lru_cache(maxsize=4096)
 def make_user_buttons(user_id: int):
     """
     Создает inline-кнопки для основного меню игрока.
+    Разметка неизменяемая, поэтому для недавних игроков берётся из кеша.
+    user_id в кнопках — владелец меню: чужие нажатия роутер отклоняет.
     """
     kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton("📊 Профиль", callback_data=f"profile:{user_id}")],
-        [InlineKeyboardButton("📦 Инвентарь", callback_data=f"inventory:{user_id}")],
-        [InlineKeyboardButton("⚔️ Бой", callback_data=f"fight:{user_id}")],
-        [InlineKeyboardButton("👯 Команда", callback_data=f"team:{user_id}")],
-        [InlineKeyboardButton("🤝 Пригласить в команду", callback_data=f"teamup:{user_id}")],
-        [InlineKeyboardButton("🌟 Рейтинг", callback_data=f"leaderboard:{user_id}")],
-        [InlineKeyboardButton("🚶 Исследовать", callback_data=f"explore:{user_id}")],
-        [InlineKeyboardButton("🛡 Командный бой", callback_data=f"teamfight:{user_id}")]
+        [InlineKeyboardButton("📊 Профиль", callback_data=pack(CB_PROFILE, user_id))],
+        [InlineKeyboardButton("📦 Инвентарь", callback_data=pack(CB_INVENTORY, user_id))],
+        [InlineKeyboardButton("⚔️ Бой", callback_data=pack(CB_FIGHT, user_id))],
+        [InlineKeyboardButton("🗡 Бой по ходам", callback_data=pack(CB_BATTLE, user_id))],
+        [InlineKeyboardButton("👯 Команда", callback_data=pack(CB_TEAM, user_id))],
+        [InlineKeyboardButton("🤝 Пригласить в команду", callback_data=pack(CB_TEAMUP, user_id))],
+        [InlineKeyboardButton("🌟 Рейтинг", callback_data=pack(CB_LEADERBOARD, user_id))],
+        [InlineKeyboardButton("🚶 Исследовать", callback_data=pack(CB_EXPLORE, user_id))],
+        [InlineKeyboardButton("🛡 Командный бой", callback_data=pack(CB_TEAMFIGHT, user_id))]
     ])
     return kb
 
-def check_and_restore_energy(player):
-    now = datetime.now(timezone.utc)
-
-    if not player.last_energy_tick:
-        last_tick = now - timedelta(hours=1)
+# ------------ Энергия ------------
+# Энергия не тикает в базе: хранится значение на момент last_energy_tick,
+# текущее считается при чтении. Пишем только когда энергию тратят или дают.
+def utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
+def current_energy(p: Player, now: datetime | None = None):
+    """(энергия сейчас, секунд до следующей единицы; 0 если энергия полная)"""
+    if p.energy >= MAX_ENERGY:
+        return p.energy, 0
+    if not p.last_energy_tick:
+        # старые записи без отметки: регенерация давно завершилась
+        return MAX_ENERGY, 0
+    now = now or utcnow()
+    elapsed = max(0.0, (now - datetime.fromisoformat(p.last_energy_tick)).total_seconds())
+    energy = min(MAX_ENERGY, p.energy + int(elapsed // ENERGY_REGEN_SECONDS))
+    if energy >= MAX_ENERGY:
+        return energy, 0
+    return energy, ENERGY_REGEN_SECONDS - elapsed % ENERGY_REGEN_SECONDS
+
+def _materialize_energy(p: Player, now: datetime):
+    # переносит накопленную регенерацию в сохраняемые поля
+    energy, _ = current_energy(p, now)
+    if energy >= MAX_ENERGY or not p.last_energy_tick:
+        p.last_energy_tick = now.isoformat()
     else:
-        last_tick = datetime.fromisoformat(player.last_energy_tick)
-
-    hours_passed = int((now - last_tick).total_seconds() // 3600)
-    
-    if hours_passed > 0:
-        player.energy = min(5, player.energy + hours_passed)
-        player.last_energy_tick = (last_tick + timedelta(hours=hours_passed)).isoformat()
-        save_player(player)
-    
-    next_tick = last_tick + timedelta(hours=hours_passed + 1)
-    seconds_left = (next_tick - now).total_seconds()
-    minutes = int(seconds_left // 60)
-    seconds = int(seconds_left % 60)
-    
-    return minutes, seconds
+        last = datetime.fromisoformat(p.last_energy_tick)
+        gained = energy - p.energy
+        p.last_energy_tick = (last + timedelta(seconds=gained * ENERGY_REGEN_SECONDS)).isoformat()
+    p.energy = energy
+
+def spend_energy(p: Player, amount: int = 1, now: datetime | None = None) -> bool:
+    now = now or utcnow()
+    if current_energy(p, now)[0] < amount:
+        return False
+    _materialize_energy(p, now)
+    p.energy -= amount
+    return True
+
+def grant_energy(p: Player, amount: int, now: datetime | None = None):
+    now = now or utcnow()
+    _materialize_energy(p, now)
+    p.energy = min(MAX_ENERGY, p.energy + amount)
+
+# ------------ Блокировки игроков ------------
+# concurrent_updates(True): два быстрых нажатия одного игрока идут параллельно,
+# поэтому изменения одного игрока выполняем строго по очереди
+user_locks = KeyedLocks()
+
+def serialized_per_user(handler):
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        async with user_locks.hold(update.effective_user.id):
+            return await handler(update, context)
+    return wrapper
+
+# ------------ Исходящие сообщения ------------
+# уведомления другим игрокам и тяжёлые ответы (фото) не держат обработчик:
+# они уходят через очередь с учётом лимитов Telegram
+outbox = Outbox()
+
+# картинки стихий после первой отправки уходят по file_id, а не по URL
+media = MediaCache(db)
+
+def send_style_photo(chat_id: int, style: dict, caption: str):
+    url = style["img"]
+    photo = media.photo(url)
+
+    def resend():
+        # закешированный file_id не приняли: по ссылке, с запоминанием нового id
+        outbox.send_photo(chat_id, photo=url, caption=caption, on_sent=media.on_sent(url))
+
+    outbox.send_photo(chat_id, photo=photo, caption=caption, on_sent=media.on_sent(url),
+                      on_failed=media.on_failed(url, photo, resend))
+
+def warm_up_media(chat_id: int):
+    """Заливает ещё не закешированные картинки стихий в служебный чат и удаляет сообщения."""
+    for url in media.missing(s["img"] for s in STYLES.values()):
+        remember = media.on_sent(url)
+
+        async def done(message, remember=remember):
+            await remember(message)
+            outbox.put(chat_id, "delete_message", {"chat_id": chat_id, "message_id": message.message_id})
+
+        outbox.send_photo(chat_id, photo=url, disable_notification=True, on_sent=done)
+
+# ------------ Антиспам ------------
+# Проверки идут в группе -1, до любых обработчиков: отказ не трогает базу
+# и не держит блокировку игрока. Сообщение об отказе уходит один раз за
+# серию и через outbox; на нажатия кнопок Telegram всё равно ждёт answer.
+throttle = Throttle(THROTTLE_RATE, THROTTLE_BURST)
+inflight = Coalescer()
+
+def update_key(update: Update):
+    # (игрок, текст команды или callback_data); остальные апдейты обработчиков не вызывают
+    user = update.effective_user
+    if user is None:
+        return None
+    if update.callback_query is not None and update.callback_query.data:
+        return user.id, update.callback_query.data
+    msg = update.message
+    if msg is not None and msg.text and msg.text.startswith("/"):
+        return user.id, msg.text
+    return None
+
+async def gate_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    key = update_key(update)
+    if key is None:
+        return
+    if not inflight.enter(key):
+        # такой же апдейт ещё обрабатывается — этот ничего нового не даст
+        if update.callback_query:
+            await update.callback_query.answer()
+        raise ApplicationHandlerStop
+    if THROTTLE_RATE > 0 and throttle.hit(key[0]):
+        inflight.leave(key)
+        text = "Слишком часто — подожди пару секунд 🌙"
+        if update.callback_query:
+            await update.callback_query.answer(text)
+        elif throttle.should_warn(key[0]):
+            outbox.send_message(update.effective_chat.id, text=text)
+        raise ApplicationHandlerStop
+
+async def release_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # последняя группа: апдейт обработан, такой же снова можно принимать
+    key = update_key(update)
+    if key is not None:
+        inflight.leave(key)
 
-    
 # ------------ Команды бота ------------
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     chat = update.effective_chat
-    p = load_player(user.id)
+    p = await load_player(user.id, user)
     if p:
         await update.effective_message.reply_text(
             f"С возвращением, {p.name} — {STYLES[p.style]['name']}! "
-            f"Профиль: /profile"
+            f"Профиль: /profile",
+            reply_markup=make_user_buttons(user.id),
         )
         return
 
     # ask to choose style via inline keyboard
-    kb = []
-    for key, val in STYLES.items():
-        kb.append([InlineKeyboardButton(val["name"], callback_data=f"choose_style:{key}")])
     await update.effective_message.reply_text(
         "Добро пожаловать, новобранка! 🌙\nВыбери Стихию Силы, чтобы стать Сейлор-воительницей:",
-        reply_markup=InlineKeyboardMarkup(kb),
+        reply_markup=STYLE_KEYBOARD,
     )
 
+@serialized_per_user
 async def cb_choose_style(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
-
-    style_key = query.data.split(":")[1]
+    style_key = context.args[0] if context.args else ""
+    if style_key not in STYLES:
+        return
     user = query.from_user
 
     # Создаём объект Player через create_player_obj, который автоматически присваивает начальные значения
+    old = await load_player(user.id)
     p = create_player_obj(user.id, user.username or "", user.first_name, style_key)
+    if old:
+        p.version = old.version  # перезапись существующей строки, а не вставка
+        leaderboard.update(p.user_id, p.name, old.lvl, old.xp, p.lvl, p.xp)
+    else:
+        leaderboard.add(p.user_id, p.name, p.lvl, p.xp)
     
     # Сохраняем игрока в базе данных
-    save_player(p)
+    await save_player(p, "start")
 
     style = STYLES[style_key]
 
-    await query.message.reply_photo(
-        photo=style["img"],
+    send_style_photo(
+        query.message.chat_id,
+        style,
         caption=f"✨ Ты выбрал(а) путь {style['name']}!\nТеперь ты настоящий защитник во имя Луны 🌙"
     )
 
 async def cmd_energy(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    player = load_player(user.id)
+    player = await load_player(user.id, user)
     if not player:
         await update.effective_message.reply_text("Сначала /start.")
         return
     
-    minutes, seconds = check_and_restore_energy(player)
+    energy, seconds_left = current_energy(player)
+    if seconds_left:
+        next_text = f"До следующей единицы: {int(seconds_left // 60)} мин {int(seconds_left % 60)} сек"
+    else:
+        next_text = "Энергия полностью восстановлена."
     await update.effective_message.reply_text(
-        f"⚡ Твоя энергия: {player.energy}/{5}\n"
-        f"До следующей единицы: {minutes} мин {seconds} сек"
+        f"⚡ Твоя энергия: {energy}/{MAX_ENERGY}\n" + next_text
     )
 
 
 
 async def cmd_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    p = load_player(user.id)
+    p = await load_player(user.id, user)
     if not p:
-        await update.message.reply_text("Ты ещё не зарегистрирован(а). Напиши /start 🌙")
+        await update.effective_message.reply_text("Ты ещё не зарегистрирован(а). Напиши /start 🌙")
         return
 
     style = STYLES.get(p.style, {"name": "Неизвестно", "img": None})
     inv = get_inventory_list(p)
-    inv_text = ", ".join([ITEMS[i]["title"] for i in inv if i in ITEMS]) if inv else "пусто"
+    inv_text = ", ".join([item_title(key, qty) for key, qty in inv if key in ITEMS]) if inv else "пусто"
 
-    await update.message.reply_photo(
-        photo=style["img"],
+    send_style_photo(
+        update.effective_chat.id,
+        style,
         caption=f"🌙 Профиль {p.name}\n"
                 f"Воин: {style['name']}\n"
                 f"Уровень: {p.lvl}\n"
@@ -388,7 +724,7 @@ async def cmd_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 f"Gold: {p.gold}\n"
                 f"HP: {p.hp}/{p.max_hp}\n"
                 f"Атака: {p.atk}\n"
-                f"Энергия: {p.energy}\n"
+                f"Энергия: {current_energy(p)[0]}/{MAX_ENERGY}\n"
                 f"Инвентарь: {inv_text}"
     )
     
@@ -396,7 +732,7 @@ async def cmd_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def cmd_inventory(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    p = load_player(user.id)
+    p = await load_player(user.id, user)
     if not p:
         await update.effective_message.reply_text("Сначала /start.")
         return
@@ -405,31 +741,23 @@ async def cmd_inventory(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.effective_message.reply_text("Инвентарь пуст.")
         return
     lines = []
-    for i in inv:
-        if i in ITEMS:
-            it = ITEMS[i]
-            lines.append(f"{it['title']} — {it['desc']}")
+    for key, qty in inv:
+        if key in ITEMS:
+            lines.append(f"{item_title(key, qty)} — {ITEMS[key]['desc']}")
         else:
-            lines.append(f"{i} — (неизвестно)")
+            lines.append(f"{item_title(key, qty)} — (неизвестно)")
     await update.effective_message.reply_text("📦 Твой инвентарь:\n" + "\n".join(lines))
 
 async def cmd_shop(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # show shop as inline buttons
-    kb = []
-    for key, it in ITEMS.items():
-        if it.get("price", 0) > 0:
-            kb.append([InlineKeyboardButton(f"{it['title']} — {it['price']}💠", callback_data=f"buy:{key}")])
-    await update.effective_message.reply_text("Магазин Сейлор — выбери предмет:", reply_markup=InlineKeyboardMarkup(kb))
+    await update.effective_message.reply_text("Магазин Сейлор — выбери предмет:", reply_markup=SHOP_KEYBOARD)
 
+@serialized_per_user
 async def shop_buy_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
-    await q.answer()
-    data = q.data
-    if not data.startswith("buy:"):
-        return
-    item_key = data.split(":", 1)[1]
+    item_key = context.args[0] if context.args else ""
     user = q.from_user
-    p = load_player(user.id)
+    p = await load_player(user.id, user)
     if not p:
         await q.edit_message_text("Сначала зарегистрируйся: /start")
         return
@@ -443,46 +771,41 @@ async def shop_buy_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     p.gold -= price
     add_item_to_player(p, item_key)
-    save_player(p)
+    await save_player(p, "buy", item=item_key, dg=-price)
     await q.edit_message_text(f"Ты купила {item['title']}! Он в инвентаре.")
 
+@serialized_per_user
 async def cmd_fight(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    p = load_player(user.id)
+    p = await load_player(user.id, user)
     if not p:
         await update.effective_message.reply_text("Сначала /start.")
         return
-    if p.energy <= 0:
+    if not spend_energy(p):
         await update.effective_message.reply_text("Энергия закончилась. Попробуй позже или используй предметы для восстановления.")
         return
     # choose monster roughly by player level
-    pool = [m for m in MONSTERS if m["lvl"] <= max(1, p.lvl+1)]
-    monster = random.choice(pool)
-    # simple fight simulation: player roll + atk vs monster hp/atk
-    p.energy -= 1
-    player_roll = random.randint(1, 10) + p.atk
-    monster_roll = random.randint(1, 10) + monster["atk"]
-    # determine outcome
+    monster = battle.pick_monster(p.lvl, battle_rng)
+    fight = battle.fight(p.atk, monster, battle_rng)
     result_text = []
     result_text.append(f"⚔️ Ты встретила: *{monster['name']}* (ур. {monster['lvl']})")
-    result_text.append(f"Твой бросок (atk+рандом): {player_roll}   |   Монстр: {monster_roll}")
-    if player_roll >= monster_roll:
+    result_text.append(f"Твой бросок (atk+рандом): {fight.player_roll}   |   Монстр: {fight.monster_roll}")
+    if fight.won:
         # victory
         xp = monster["reward_xp"]
         gold = monster["reward_gold"]
         add_xp_and_check_level(p, xp)
         p.gold += gold
-        # small chance to drop moon_crystal
-        if random.random() < 0.08:
+        if fight.drop:
             add_item_to_player(p, "moon_crystal")
             drop_text = "\n✨ Тебе выпал Лунный кристалл!"
         else:
             drop_text = ""
-        save_player(p)
+        await save_player(p, "fight", monster=monster["id"], won=True, dg=gold)
         result_text.append(f"🌟 Победа! +{xp} XP, +{gold}💠.{drop_text}")
     else:
         # defeat
-        dmg = max(1, monster["atk"] + random.randint(0, 3))
+        dmg = fight.damage
         p.hp -= dmg
         if p.hp <= 0:
             # faint, reset hp to half max
@@ -490,13 +813,132 @@ async def cmd_fight(update: Update, context: ContextTypes.DEFAULT_TYPE):
             result_text.append(f"💥 Поражение. Ты была сбита с ног и теряешь {dmg} HP. Восстановлена до {p.hp} HP.")
         else:
             result_text.append(f"💥 Поражение. Ты теряешь {dmg} HP. Текущее HP: {p.hp}/{p.max_hp}")
-        save_player(p)
+        await save_player(p, "fight", monster=monster["id"], won=False, dg=0)
     result = "\n".join(result_text)
     await update.effective_message.reply_markdown(result)
 
+# ------------ Пошаговый бой ------------
+# Бой идёт в памяти (duels), в таблицу battles попадает только состояние
+# на границе хода — пачкой по таймеру (задача flush_duels). Игрок
+# сохраняется один раз, в конце боя; HP игрока во время боя — в самом бою.
+DUEL_TTL = float(os.getenv("DUEL_TTL", 600))
+DUEL_FLUSH_INTERVAL = float(os.getenv("DUEL_FLUSH_INTERVAL", 1))
+DUEL_PURGE_INTERVAL = float(os.getenv("DUEL_PURGE_INTERVAL", 60))
+
+duels = DuelRegistry(db, ttl=DUEL_TTL, shared=SHARED_STATE)
+
+def duel_keyboard(d: battle.Duel) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton("⚔️ Атака", callback_data=pack(CB_DUEL, d.user_id, battle.ATTACK, d.turn)),
+        InlineKeyboardButton("🧪 Лечение", callback_data=pack(CB_DUEL, d.user_id, battle.ITEM, d.turn)),
+        InlineKeyboardButton("🏃 Сбежать", callback_data=pack(CB_DUEL, d.user_id, battle.FLEE, d.turn)),
+    ]])
+
+def duel_status(d: battle.Duel, p: Player) -> str:
+    foe = d.foe
+    return (f"👾 {foe['name']}: {max(0, d.monster_hp)}/{foe['hp']} HP\n"
+            f"💖 Ты: {max(0, d.hp)}/{p.max_hp} HP\n"
+            f"Ход {d.turn + 1}")
+
+def turn_text(r: battle.TurnResult, item: str | None) -> str:
+    lines = [f"Твой бросок: {r.player_roll}   |   Монстр: {r.monster_roll}"]
+    if r.action == battle.ITEM:
+        lines.append(f"🧪 {ITEMS[item]['title']}: +{r.healed} HP.")
+    if r.dealt:
+        lines.append(f"🌙 Ты наносишь {r.dealt} урона.")
+    if r.action == battle.FLEE and not r.taken:
+        lines.append("🏃 Ты сбежала с поля боя.")
+    elif r.action == battle.FLEE:
+        lines.append("Сбежать не вышло!")
+    if r.taken:
+        lines.append(f"💥 Монстр наносит тебе {r.taken} урона.")
+    return "\n".join(lines)
+
+def healing_item(p: Player) -> str | None:
+    return next((key for key, qty in p.inventory.items() if qty > 0 and ITEMS.get(key, {}).get("heal")), None)
+
+@serialized_per_user
+async def cmd_battle(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    p = await load_player(user.id, user)
+    if not p:
+        await update.effective_message.reply_text("Сначала /start.")
+        return
+    d = await duels.get(user.id)
+    if d is not None:
+        head = "⚔️ Бой ещё идёт!"
+    else:
+        if not spend_energy(p):
+            await update.effective_message.reply_text("Энергия закончилась. Попробуй позже или используй предметы для восстановления.")
+            return
+        d = battle.start_duel(user.id, p.lvl, p.hp, battle_rng)
+        await save_player(p, "battle_start", monster=d.foe["id"], dg=0)
+        await duels.start(d)
+        head = f"⚔️ Ты встретила: *{d.foe['name']}* (ур. {d.foe['lvl']}). Бой по ходам!"
+    await update.effective_message.reply_markdown(head + "\n" + duel_status(d, p), reply_markup=duel_keyboard(d))
+
+@serialized_per_user
+async def duel_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    user = q.from_user
+    if len(context.args) != 2 or not context.args[1].isdigit():
+        return
+    action, turn = context.args[0], int(context.args[1])
+    d = await duels.get(user.id)
+    if d is None:
+        await q.edit_message_text("Этот бой уже окончен. Новый — /battle")
+        return
+    if d.turn != turn:
+        # кнопка с прошлого хода: этот ход уже сделан
+        return
+    p = await load_player(user.id, user)
+    if not p:
+        await q.edit_message_text("Сначала /start.")
+        return
+    item = None
+    if action == battle.ITEM:
+        item = healing_item(p)
+        if item is None:
+            await q.edit_message_text("Лечиться нечем — купи Лунный эликсир в /shop.\n" + duel_status(d, p),
+                                      reply_markup=duel_keyboard(d))
+            return
+        consume_item_from_player(p, item)
+    elif action not in (battle.ATTACK, battle.FLEE):
+        return
+    r = battle.duel_turn(d, action, p.atk, battle_rng, heal=ITEMS[item]["heal"] if item else 0, max_hp=p.max_hp)
+    text = turn_text(r, item)
+    if r.outcome is None:
+        # сначала бой: при конфликте хода (другой воркер) игрок не изменится
+        await duels.save(d)
+        if item:
+            await save_player(p, "use", item=item, dg=0)
+        await q.edit_message_text(text + "\n\n" + duel_status(d, p), reply_markup=duel_keyboard(d))
+        return
+
+    await duels.finish(d, r.outcome)
+    foe = d.foe
+    gold = 0
+    p.hp = max(0, d.hp)
+    if r.outcome == battle.WON:
+        xp, gold = foe["reward_xp"], foe["reward_gold"]
+        add_xp_and_check_level(p, xp)
+        p.gold += gold
+        text += f"\n🌟 Победа за {d.turn} ход(а)! +{xp} XP, +{gold}💠."
+        if r.drop:
+            add_item_to_player(p, "moon_crystal")
+            text += "\n✨ Тебе выпал Лунный кристалл!"
+    elif r.outcome == battle.LOST:
+        p.hp = max(1, p.max_hp // 2)
+        text += f"\n💥 Поражение. Ты была сбита с ног. Восстановлена до {p.hp} HP."
+    else:
+        text += f"\nHP: {p.hp}/{p.max_hp}"
+    await save_player(p, "battle", monster=foe["id"], result=r.outcome, turns=d.turn, dg=gold)
+    await q.edit_message_text(text)
+
+@serialized_per_user
 async def cmd_daily(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    p = load_player(user.id)
+    p = await load_player(user.id, user)
     if not p:
         await update.effective_message.reply_text("Сначала /start.")
         return
@@ -506,15 +948,16 @@ async def cmd_daily(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     p.last_daily = today
     p.gold += 20
-    p.energy = min(5, p.energy + 2)
+    grant_energy(p, 2)
     add_xp_and_check_level(p, DAILY_EXP_BONUS)
-    save_player(p)
+    await save_player(p, "daily", dg=20)
     await update.effective_message.reply_text("🌞 Ежедневная награда: +20💠, +2 Энергии, +5 XP. Удачи, Сейлор!")
 
+@serialized_per_user
 async def cmd_use(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # use item by name: /use luna_brooch
     user = update.effective_user
-    p = load_player(user.id)
+    p = await load_player(user.id, user)
     if not p:
         await update.effective_message.reply_text("Сначала /start.")
         return
@@ -534,58 +977,70 @@ async def cmd_use(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if item.get("heal"):
         heal = item["heal"]
         p.hp = min(p.max_hp, p.hp + heal)
-        await update.effective_message.reply_text(f"✨ Ты использовала {item['title']}. Восстановлено {heal} HP. Текущее HP: {p.hp}/{p.max_hp}")
+        text = f"✨ Ты использовала {item['title']}. Восстановлено {heal} HP. Текущее HP: {p.hp}/{p.max_hp}"
     elif item.get("atk"):
         p.atk += item["atk"]
-        await update.effective_message.reply_text(f"🔰 {item['title']} добавил +{item['atk']} к Атаке навсегда.")
+        text = f"🔰 {item['title']} добавил +{item['atk']} к Атаке навсегда."
     else:
-        await update.effective_message.reply_text(f"Ты использовала {item['title']}.")
-    save_player(p)
+        text = f"Ты использовала {item['title']}."
+    # сначала сохраняем: при конфликте версий игрок не увидит ложного успеха
+    await save_player(p, "use", item=key, dg=0)
+    await update.effective_message.reply_text(text)
 
 async def cmd_leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT name, lvl, xp FROM players ORDER BY lvl DESC, xp DESC LIMIT 10")
-    rows = cur.fetchall()
-    conn.close()
+    # рейтинг целиком в памяти, база нужна только чтобы дозаполнить топ
+    if leaderboard.needs_refill():
+        await refill_leaderboard()
+    rows = leaderboard.top()
 
     if not rows:
-        await update.message.reply_text("Рейтинг пока пуст 🌙")
+        await update.effective_message.reply_text("Рейтинг пока пуст 🌙")
         return
 
     text = "🌟 ТОП-10 защитников Луны 🌟\n\n"
     for i, (name, lvl, xp) in enumerate(rows, start=1):
         text += f"{i}. {name} — {lvl} lvl ({xp} XP)\n"
 
-    await update.message.reply_text(text)
+    p = await load_player(update.effective_user.id, update.effective_user)
+    if p:
+        text += f"\nТвоё место: {leaderboard.rank(p.lvl, p.xp)} из {len(leaderboard)}"
+
+    await update.effective_message.reply_text(text)
 
-def random_event(p: Player) -> str:
+async def random_event(p: Player) -> str:
     events = [
-        ("✨ Ты нашёл волшебный кристалл! +20 XP", lambda: setattr(p, "xp", p.xp + 20)),
+        ("✨ Ты нашёл волшебный кристалл! +20 XP", lambda: add_xp_and_check_level(p, 20)),
         ("💰 Ты нашёл кошелёк с золотом! +30 gold", lambda: setattr(p, "gold", p.gold + 30)),
         ("💔 Тёмная энергия поразила тебя! -10 HP", lambda: setattr(p, "hp", max(0, p.hp - 10))),
         ("👹 Ты встретил монстра! Начинается бой...", lambda: None)
     ]
     event = random.choice(events)
+    gold = p.gold
     event[1]()  # применяем эффект
-    save_player(p)
+    await save_player(p, "explore", dg=p.gold - gold)
     return event[0]
 
+@serialized_per_user
 async def cmd_explore(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    p = load_player(user.id)
+    p = await load_player(user.id, user)
     if not p:
-        await update.message.reply_text("Сначала /start 🌙")
+        await update.effective_message.reply_text("Сначала /start 🌙")
         return
 
-    event_text = random_event(p)
-    await update.message.reply_text(f"🚶‍♀️ {p.name} отправился исследовать мир...\n\n{event_text}")
+    event_text = await random_event(p)
+    await update.effective_message.reply_text(f"🚶‍♀️ {p.name} отправился исследовать мир...\n\n{event_text}")
 
 
 # ------------ Командные механики ------------
+INVITE_TTL = float(os.getenv("INVITE_TTL", 86400))
+INVITE_PURGE_INTERVAL = float(os.getenv("INVITE_PURGE_INTERVAL", 600))
+# приглашения живут в локальной SQLite и при серверной базе: это служебные данные
+invites = InviteRegistry(db, ttl=INVITE_TTL, shared=SHARED_STATE)
+
 async def cmd_teamup(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    p = load_player(user.id)
+    p = await load_player(user.id, user)
     if not p:
         await update.effective_message.reply_text("Сначала /start.")
         return
@@ -594,86 +1049,85 @@ async def cmd_teamup(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     target = context.args[0].lstrip("@")
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT user_id FROM players WHERE username = ?", (target,))
-    row = cur.fetchone()
-    conn.close()
+    await player_cache.flush()
+    target_id = await player_repo.find_by_username(target)
 
-    if not row:
+    if target_id is None:
         await update.effective_message.reply_text("Игрок с таким username не найден или он не регистрировался.")
         return
+    if target_id == user.id:
+        await update.effective_message.reply_text("Нельзя пригласить самого себя.")
+        return
 
-    target_id = row[0]
+    invite = await invites.create(user.id, target_id)
+    if invite is None:
+        await update.effective_message.reply_text(f"Приглашение @{target} уже отправлено. Ждём ответа.")
+        return
 
-    # создаём inline-кнопки
+    # кнопки несут только номер приглашения: кто и кого пригласил, знает реестр
     kb = InlineKeyboardMarkup([
         [
-            InlineKeyboardButton("✅ Принять", callback_data=f"team_accept:{user.id}"),
-            InlineKeyboardButton("❌ Отклонить", callback_data=f"team_decline:{user.id}")
+            InlineKeyboardButton("✅ Принять", callback_data=pack(CB_TEAM_ACCEPT, invite.invite_id)),
+            InlineKeyboardButton("❌ Отклонить", callback_data=pack(CB_TEAM_DECLINE, invite.invite_id))
         ]
     ])
 
-    await context.bot.send_message(
-        chat_id=target_id,
+    outbox.send_message(
+        target_id,
         text=f"👯 @{p.username or p.name} приглашает тебя в команду!",
         reply_markup=kb
     )
 
     await update.effective_message.reply_text(f"Приглашение отправлено @{target}. Ждём ответа.")
 
-async def team_invite_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    q = update.callback_query
-    await q.answer()
+def callback_invite_id(context) -> int | None:
+    # битая или старая кнопка — как неактуальное приглашение, а не ошибка
+    args = context.args
+    return int(args[0]) if args and args[0].isdigit() else None
 
-    data = q.data
+@serialized_per_user
+async def team_accept_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
     user = q.from_user
-    p = load_player(user.id)
+    p = await load_player(user.id, user)
     if not p:
         await q.edit_message_text("Сначала /start.")
         return
 
-    if data.startswith("team_accept:"):
-        leader_id = int(data.split(":")[1])
+    invite_id = callback_invite_id(context)
+    invite = await invites.accept(invite_id, user.id) if invite_id is not None else None
+    if invite is None:
+        await q.edit_message_text("Приглашение уже неактуально.")
+        return
+    _, created = await team_repo.join(invite.leader_id, user.id)
 
-        conn = get_conn()
-        cur = conn.cursor()
-        cur.execute("INSERT INTO teams (leader_id, member_ids, active) VALUES (?,?,1)",
-                    (leader_id, f"{leader_id},{user.id}"))
-        conn.commit()
-        conn.close()
+    await q.edit_message_text("✅ Ты принял(а) приглашение. " + ("Команда создана!" if created else "Ты в команде!"))
+    outbox.send_message(invite.leader_id, text=f"🎉 @{user.username or user.first_name} принял(а) приглашение!")
 
-        await q.edit_message_text("✅ Ты принял(а) приглашение. Команда создана!")
-        await context.bot.send_message(chat_id=leader_id, text=f"🎉 @{user.username or user.first_name} принял(а) приглашение!")
+async def team_decline_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    user = q.from_user
+    invite_id = callback_invite_id(context)
+    invite = await invites.decline(invite_id, user.id) if invite_id is not None else None
+    if invite is None:
+        await q.edit_message_text("Приглашение уже неактуально.")
+        return
+    await q.edit_message_text("❌ Ты отклонил(а) приглашение.")
+    outbox.send_message(invite.leader_id, text=f"😢 @{user.username or user.first_name} отклонил(а) приглашение.")
 
-    elif data.startswith("team_decline:"):
-        leader_id = int(data.split(":")[1])
-        await q.edit_message_text("❌ Ты отклонил(а) приглашение.")
-        await context.bot.send_message(chat_id=leader_id, text=f"😢 @{user.username or user.first_name} отклонил(а) приглашение.")
+async def stale_invite_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # кнопки старого формата: id лидера из callback_data ничем не подтверждён
+    await update.callback_query.edit_message_text("Приглашение устарело — попроси отправить новое.")
 
 
 async def cmd_team(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # показывает команды, в которых состоит пользователь
     user = update.effective_user
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT team_id, leader_id, member_ids, active FROM teams WHERE active=1")
-    rows = cur.fetchall()
-    conn.close()
+    teams = await get_user_teams(user.id)
     res = []
-    for r in rows:
-        team_id, leader_id, member_ids, active = r
-        members = member_ids.split(",") if member_ids else []
-        if str(user.id) in members:
-            # show
-            names = []
-            for uid in members:
-                pl = load_player(int(uid))
-                if pl:
-                    names.append(pl.username or pl.name)
-                else:
-                    names.append(str(uid))
-            res.append(f"Team {team_id}: leader {leader_id}, members: {', '.join(names)}")
+    for t in teams:
+        names = [name for _, name in t.members]
+        res.append(f"Team {t.team_id}: leader {t.leader_id}, members: {', '.join(names)}")
     if not res:
         await update.effective_message.reply_text("Ты не в активных командах.")
     else:
@@ -681,142 +1135,500 @@ async def cmd_team(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def cmd_teamfight(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT team_id, leader_id, member_ids FROM teams WHERE active=1")
-    rows = cur.fetchall()
-    conn.close()
 
     # Найти команду пользователя
-    found = None
-    for r in rows:
-        team_id, leader_id, member_ids = r
-        if str(user.id) in (member_ids or "").split(","):
-            found = (team_id, leader_id, member_ids)
-            break
-    if not found:
+    teams = await get_user_teams(user.id)
+    if not teams:
         await update.effective_message.reply_text("Ты не в активной команде.")
         return
 
-    team_id, leader_id, member_ids = found
-    members = [int(x) for x in member_ids.split(",") if x]
+    team = teams[0]
+    members = [uid for uid, _ in team.members]
 
-    # Проверка энергии и расход
-    insufficient_energy = []
-    for uid in members:
-        pl = load_player(uid)
-        if pl:
-            if pl.energy <= 0:
-                insufficient_energy.append(pl.name)
-            else:
-                pl.energy -= 1
-                save_player(pl)
+    # вся команда блокируется целиком: никто из участников не меняется параллельно
+    async with user_locks.hold(*members):
+        await _team_battle(update, members)
 
+async def _team_battle(update: Update, members: list):
+    # Все участники одним запросом; проверка энергии до любых изменений
+    players = await load_players(members)
+    squad = [players[uid] for uid in members if uid in players]
+    now = utcnow()
+    insufficient_energy = [pl.name for pl in squad if current_energy(pl, now)[0] <= 0]
     if insufficient_energy:
         await update.effective_message.reply_text(
             "💤 Следующие игроки слишком устали для командного боя: " + ", ".join(insufficient_energy)
         )
         return
 
-
-    # --- Подсчёт силы команды ---
-    total_atk = 0
-    total_hp = 0
-    for uid in members:
-        pl = load_player(uid)
-        if pl:
-            total_atk += pl.atk
-            total_hp += pl.hp
-
-    # --- Выбор босса ---
-    bosses = [m for m in MONSTERS if m["id"].startswith("boss")]
-    super_bosses = [m for m in MONSTERS if m["id"].startswith("superboss")]
-
-    # 10% шанс на супербосса
-    if random.random() < 0.10 and super_bosses:
-        boss = random.choice(super_bosses)
-        boss_type = "СУПЕРБОСС"
-    else:
-        boss = random.choice(bosses)
-        boss_type = "БОСС"
-
-    # --- Броски ---
-    team_roll = random.randint(1, 10) + total_atk // max(1, len(members))
-    boss_roll = random.randint(1, 10) + boss["atk"]
+    # --- Босс и броски ---
+    boss, _ = battle.pick_boss(battle_rng)
+    fight = battle.team_fight([pl.atk for pl in squad], boss, battle_rng)
 
     res = [f"👯 Командная битва против {boss['name']}"]
-    res.append(f"Командный бросок: {team_roll}   |   Босс: {boss_roll}")
-
-    if team_roll >= boss_roll:
-        # Победа, распределяем награды
-        xp = boss["reward_xp"] // len(members)
-        gold = boss["reward_gold"] // len(members)
-        drop_text = ""
-        for uid in members:
-            pl = load_player(uid)
-            if pl:
-                add_xp_and_check_level(pl, xp)
-                pl.gold += gold
-                # Шанс на редкий предмет (например, лунный кристалл)
-                if random.random() < 0.08:
+    res.append(f"Командный бросок: {fight.team_roll}   |   Босс: {fight.boss_roll}")
+
+    # Исход считаем в памяти и пишем всех участников одной транзакцией:
+    # либо энергия, награды и дроп сохранятся у всех, либо ни у кого
+    snapshot = snapshot_players(squad)
+    try:
+        for pl in squad:
+            spend_energy(pl, 1, now)
+        if fight.won:
+            # Победа, распределяем награды
+            drop_text = ""
+            for pl, drop in zip(squad, fight.drops):
+                add_xp_and_check_level(pl, fight.xp)
+                pl.gold += fight.gold
+                if drop:
                     add_item_to_player(pl, "moon_crystal")
                     drop_text += f"\n✨ {pl.name} получил Лунный кристалл!"
-                save_player(pl)
-        res.append(f"🌟 Команда победила! Каждому +{xp} XP, +{gold}💠{drop_text}")
-    else:
-        res.append("💥 Босс оказался сильнее. Попробуйте снова после восстановления энергии.")
+            res.append(f"🌟 Команда победила! Каждому +{fight.xp} XP, +{fight.gold}💠{drop_text}")
+        else:
+            res.append("💥 Босс оказался сильнее. Попробуйте снова после восстановления энергии.")
+        fields = [set(pl._dirty) for pl in squad]
+        await player_cache.write_through(squad)
+    except BaseException:
+        restore_players(snapshot)
+        raise
+    for pl, changed in zip(squad, fields):
+        log_event("teamfight", pl, changed, boss=boss["id"], won=fight.won, dg=fight.gold if fight.won else 0)
 
     await update.effective_message.reply_text("\n".join(res))
 
+# ------------ Рейды ------------
+# Удар не пишет ни игрока, ни босса: урон копится в шарде процесса (raids),
+# задача merge_raids сливает его в базу и завершает рейды. Награды всем
+# участникам — одной транзакцией в конце; упавшую выплату повторяет
+# задача retry_raids.
+RAID_DURATION = float(os.getenv("RAID_DURATION", 600))
+RAID_HP_SCALE = int(os.getenv("RAID_HP_SCALE", 50))  # HP рейдового босса = HP босса × это
+RAID_COOLDOWN = float(os.getenv("RAID_COOLDOWN", 3))  # секунд между ударами одного игрока
+RAID_MERGE_INTERVAL = float(os.getenv("RAID_MERGE_INTERVAL", 1))
+RAID_STATUS_INTERVAL = float(os.getenv("RAID_STATUS_INTERVAL", 15))  # лимит Telegram: 20 сообщений в минуту на группу
+RAID_PAY_ATTEMPTS = 3
+RAID_PAY_LEASE = float(os.getenv("RAID_PAY_LEASE", 60))  # через сколько секунд незаконченную выплату можно повторить
+RAID_RETRY_INTERVAL = float(os.getenv("RAID_RETRY_INTERVAL", 30))
+RAID_TOP = 5
+
+raids = RaidRegistry(db, shared=SHARED_STATE)
+raid_shown: dict = {}  # raid_id -> текст, который сейчас в сообщении рейда
+
+def raid_keyboard(raid) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[InlineKeyboardButton("⚔️ Атаковать", callback_data=pack(CB_RAID, raid.raid_id))]])
+
+def raid_status(raid) -> str:
+    minutes = max(0, int(raid.ends_at - time.time()) // 60)
+    return (f"👾 Рейд: {raid.boss['name']}\n"
+            f"❤️ {raid.hp_left}/{raid.hp} HP\n"
+            f"⏳ Осталось около {minutes} мин. Бей по кнопке — раз в {RAID_COOLDOWN:g} с!")
+
+async def cmd_raid(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat = update.effective_chat
+    if chat.type == "private":
+        await update.effective_message.reply_text("Рейды проходят в групповых чатах: добавь бота в группу и напиши там /raid.")
+        return
+    raid = raids.in_chat(chat.id)
+    if raid is None:
+        boss, _ = battle.pick_boss(battle_rng)
+        raid = await raids.start(chat.id, boss, boss["hp"] * RAID_HP_SCALE, RAID_DURATION)
+        if raid is None:
+            await update.effective_message.reply_text("В этом чате уже идёт рейд.")
+            return
+    text = raid_status(raid)
+    msg = await update.effective_message.reply_text(text, reply_markup=raid_keyboard(raid))
+    raid_shown[raid.raid_id] = text
+    await raids.set_message(raid, msg.message_id)
+
+async def raid_attack_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # отвечаем всплывающим текстом: правка общего сообщения на каждый удар
+    # упёрлась бы в лимит Telegram для групп
+    q = update.callback_query
+    raid = await raids.get(int(context.args[0])) if context.args and context.args[0].isdigit() else None
+    if raid is None or raid.over():
+        await q.answer("Рейд уже окончен.")
+        return
+    p = await load_player(q.from_user.id, q.from_user)
+    if not p:
+        await q.answer("Сначала зарегистрируйся: напиши боту /start в личке.", show_alert=True)
+        return
+    damage = battle.raid_hit(p.atk, raid.boss, battle_rng)
+    wait = raids.hit(raid, p.user_id, damage, RAID_COOLDOWN)
+    if wait:
+        await q.answer(f"Переведи дух: следующий удар через {wait:.0f} с.")
+    elif damage:
+        await q.answer(f"⚔️ Удар на {damage}! У босса около {raid.hp_left} HP.")
+    else:
+        await q.answer("Промах! Босс увернулся.")
+
+async def pay_raid(raid, rewards: dict) -> dict:
+    """Награды {user_id: (xp, gold, drop)} всем участникам одной транзакцией."""
+    ids = sorted(rewards)
+    # участники блокируются целиком, как команда в /teamfight
+    async with user_locks.hold(*ids):
+        for attempt in range(RAID_PAY_ATTEMPTS):
+            players = await load_players(ids)
+            squad = [players[uid] for uid in ids if uid in players]
+            snapshot = snapshot_players(squad)
+            try:
+                for pl in squad:
+                    xp, gold, drop = rewards[pl.user_id]
+                    add_xp_and_check_level(pl, xp)
+                    pl.gold += gold
+                    if drop:
+                        add_item_to_player(pl, "moon_crystal")
+                fields = [set(pl._dirty) for pl in squad]
+                await player_cache.write_through(squad)
+            except StaleWrite:
+                # кого-то изменил другой воркер: кеш его выбросил, перечитаем
+                restore_players(snapshot)
+                if attempt == RAID_PAY_ATTEMPTS - 1:
+                    raise
+                continue
+            except BaseException:
+                restore_players(snapshot)
+                raise
+            break
+    for pl, changed in zip(squad, fields):
+        log_event("raid", pl, changed, raid=raid.raid_id, boss=raid.boss["id"], dg=rewards[pl.user_id][1])
+    return players
+
+async def finish_raid(raid):
+    won = raid.hp_left <= 0
+    damage = await raids.claim(raid, "won" if won else "failed")
+    raid_shown.pop(raid.raid_id, None)
+    if damage is None:
+        # рейд закрыл другой воркер
+        return
+    if raid.message_id:
+        outbox.put(raid.chat_id, "edit_message_reply_markup",
+                   dict(chat_id=raid.chat_id, message_id=raid.message_id, reply_markup=None))
+    if won:
+        await settle_raid(raid, damage)
+        return
+    outbox.send_message(raid.chat_id, text=(
+        f"👾 Рейд на {raid.boss['name']} окончен!\n"
+        f"💥 Время вышло, босс ушёл с {raid.hp_left}/{raid.hp} HP. Соберите больше союзников!"
+    ))
+
+async def settle_raid(raid, damage: dict):
+    """
+    Платит за выигранный рейд и только потом снимает его урон из базы:
+    если pay_raid упадёт, урон останется и выплату повторит retry_raids.
+    """
+    boss = raid.boss
+    lines = [f"👾 Рейд на {boss['name']} окончен!"]
+    if damage:
+        rewards = battle.raid_rewards(boss, damage, battle_rng)
+        players = await pay_raid(raid, rewards)
+        lines.append(f"🌟 Босс повержен! Участников: {len(damage)}. Награда — по нанесённому урону.")
+        top = sorted(damage.items(), key=lambda kv: kv[1], reverse=True)[:RAID_TOP]
+        for i, (uid, dealt) in enumerate(top, start=1):
+            pl = players.get(uid)
+            xp, gold, _ = rewards[uid]
+            lines.append(f"{i}. {pl.name if pl else uid} — {dealt} урона, +{xp} XP, +{gold}💠")
+    await raids.settle(raid)
+    outbox.send_message(raid.chat_id, text="\n".join(lines))
+
+async def merge_raids_job():
+    for raid in await raids.merge():
+        await finish_raid(raid)
+
+async def retry_raids_job():
+    # выигранные рейды, чья выплата упала или не закончилась за RAID_PAY_LEASE
+    for raid, damage in await raids.unpaid(RAID_PAY_LEASE):
+        await settle_raid(raid, damage)
+
+async def raid_status_job():
+    # HP в сообщении рейда обновляется не чаще RAID_STATUS_INTERVAL и только при изменении
+    for raid in raids.active():
+        if not raid.message_id or raid.over():
+            continue
+        text = raid_status(raid)
+        if raid_shown.get(raid.raid_id) != text:
+            raid_shown[raid.raid_id] = text
+            outbox.put(raid.chat_id, "edit_message_text", dict(
+                chat_id=raid.chat_id, message_id=raid.message_id, text=text, reply_markup=raid_keyboard(raid),
+            ))
+
 
 # ------------ Удобства и обработчики ошибок ------------
 async def unknown(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.effective_message.reply_text("Неизвестная команда. Доступные: /start /profile /fight /shop /inventory /daily /use /teamup /team /teamfight")
+    await update.effective_message.reply_text("Неизвестная команда. Доступные: /start /profile /fight /battle /shop /inventory /daily /use /teamup /team /teamfight /raid")
+
+def collect_metrics():
+    # состояние кеша, блокировок, пула и очереди отправки для /metrics
+    locks = user_locks.stats()
+    sent = outbox.stats()
+    return [
+        ("sailor_player_cache_size", "gauge", "Игроков в кеше", [({}, len(player_cache))]),
+        ("sailor_player_cache_hits_total", "counter", "Попаданий в кеш игроков", [({}, player_cache.hits)]),
+        ("sailor_player_cache_misses_total", "counter", "Промахов кеша игроков", [({}, player_cache.misses)]),
+        ("sailor_player_version_conflicts_total", "counter", "Записей игроков, отклонённых из-за версии", [({}, player_cache.conflicts)]),
+        ("sailor_player_rebased_total", "counter", "Записей игроков, повторённых поверх свежей строки", [({}, player_cache.rebased)]),
+        ("sailor_db_connections_opened_total", "counter", "Открыто соединений с базой", [({}, db.connections_opened + (server_db.connections_opened if server_db else 0))]),
+        ("sailor_user_locks_active", "gauge", "Ключей с владельцем или ожидающими", [({}, locks["active_keys"])]),
+        ("sailor_user_locks_acquired_total", "counter", "Захватов блокировок игроков", [({}, locks["acquired"])]),
+        ("sailor_user_locks_contended_total", "counter", "Захватов с ожиданием", [({}, locks["contended"])]),
+        ("sailor_user_locks_wait_seconds_total", "counter", "Суммарное ожидание блокировок", [({}, locks["wait_seconds_total"])]),
+        ("sailor_user_locks_wait_seconds_max", "gauge", "Максимальное ожидание блокировки", [({}, locks["wait_seconds_max"])]),
+        ("sailor_leaderboard_players", "gauge", "Игроков в рейтинге", [({}, len(leaderboard))]),
+        ("sailor_outbox_queued", "gauge", "Сообщений в очереди отправки", [({}, sent["queued"])]),
+        ("sailor_outbox_sent_total", "counter", "Отправлено через очередь", [({}, sent["sent"])]),
+        ("sailor_outbox_retries_total", "counter", "Повторов отправки (429 и сетевые ошибки)", [({}, sent["retries"])]),
+        ("sailor_outbox_failed_total", "counter", "Сообщений, от которых отказались", [({}, sent["failed"])]),
+        ("sailor_media_cache_hits_total", "counter", "Картинок отправлено по file_id", [({}, media.hits)]),
+        ("sailor_media_cache_misses_total", "counter", "Картинок отправлено по URL", [({}, media.misses)]),
+        ("sailor_media_cache_invalidated_total", "counter", "file_id, которые Telegram перестал принимать", [({}, media.invalidated)]),
+        ("sailor_throttle_allowed_total", "counter", "Апдейтов, пропущенных антиспамом", [({}, throttle.allowed)]),
+        ("sailor_throttle_rejected_total", "counter", "Апдейтов, отклонённых антиспамом", [({}, throttle.rejected)]),
+        ("sailor_updates_coalesced_total", "counter", "Повторных апдейтов, склеенных с обрабатываемым", [({}, inflight.coalesced)]),
+        ("sailor_team_invites_pending", "gauge", "Приглашений в команду, ждущих ответа", [({}, len(invites))]),
+        ("sailor_team_invites_total", "counter", "Приглашений в команду по исходу", [
+            ({"result": "created"}, invites.created), ({"result": "accepted"}, invites.accepted),
+            ({"result": "declined"}, invites.declined), ({"result": "expired"}, invites.expired),
+        ]),
+        ("sailor_duels_active", "gauge", "Пошаговых боёв в памяти", [({}, len(duels))]),
+        ("sailor_duels_total", "counter", "Пошаговых боёв по исходу", [
+            ({"result": "started"}, duels.started), ({"result": "expired"}, duels.expired),
+            *[({"result": k}, v) for k, v in duels.finished.items()],
+        ]),
+        ("sailor_duel_checkpoints_total", "counter", "Состояний боёв записано в battles", [({}, duels.checkpoints)]),
+        ("sailor_raids_active", "gauge", "Идущих рейдов в этом процессе", [({}, len(raids))]),
+        ("sailor_raids_total", "counter", "Рейдов по исходу", [
+            ({"result": "started"}, raids.started), *[({"result": k}, v) for k, v in raids.finished.items()],
+        ]),
+        ("sailor_raid_hits_total", "counter", "Засчитанных ударов по рейдовым боссам", [({}, raids.hits)]),
+        ("sailor_raid_merged_total", "counter", "Строк урона, слитых в базу", [({}, raids.merged)]),
+        ("sailor_raid_paid_total", "counter", "Выигранных рейдов с записанными наградами", [({}, raids.paid)]),
+        ("sailor_raid_pay_retries_total", "counter", "Выплат за рейды, взятых на повтор", [({}, raids.retried)]),
+        ("sailor_game_log_buffered", "gauge", "Событий журнала, ждущих записи", [({}, len(game_log))]),
+        ("sailor_game_log_written_total", "counter", "Событий журнала записано", [({}, game_log.written)]),
+        ("sailor_game_log_folded_total", "counter", "Событий журнала свёрнуто в снимки", [({}, game_log.folded)]),
+        *analytics_metrics(),
+        ("sailor_energy_regen_players_total", "counter", "Строк игроков с начисленной фоном энергией", [({}, regen_state["players"])]),
+        ("sailor_jobs_runs_total", "counter", "Запусков фоновых задач", [({"job": n}, runs) for n, runs, _, _ in jobs.stats()]),
+        ("sailor_jobs_failures_total", "counter", "Ошибок фоновых задач", [({"job": n}, fails) for n, _, fails, _ in jobs.stats()]),
+        ("sailor_jobs_seconds_total", "counter", "Время работы фоновых задач", [({"job": n}, sec) for n, _, _, sec in jobs.stats()]),
+    ]
+
+def analytics_metrics():
+    # готовые агрегаты по снимку; пустые, пока снимка ещё не было
+    a = analytics.aggregates
+    if not a:
+        return []
+    today = a["gold_by_day"][-1] if a["gold_by_day"] else {"minted": 0, "burned": 0}
+    return [
+        ("sailor_snapshot_age_seconds", "gauge", "Возраст снимка базы", [({}, time.time() - snapshot.refreshed_at)]),
+        ("sailor_snapshot_refresh_seconds", "gauge", "Длительность последнего обновления снимка", [({}, snapshot.seconds)]),
+        ("sailor_players_by_style", "gauge", "Игроков по стихиям (снимок)", [({"style": k}, v) for k, v in a["by_style"].items()]),
+        ("sailor_players_by_level", "gauge", "Игроков по уровням (снимок)", [({"lvl": k}, v) for k, v in a["by_level"].items()]),
+        ("sailor_players_xp", "gauge", "Перцентили XP (снимок)", [({"quantile": q / 100}, v) for q, v in a["xp_percentiles"].items()]),
+        ("sailor_players_gold", "gauge", "Перцентили золота (снимок)", [({"quantile": q / 100}, v) for q, v in a["gold_percentiles"].items()]),
+        ("sailor_gold_total", "gauge", "Золота у всех игроков (снимок)", [({}, a["gold_total"])]),
+        ("sailor_gold_minted_last_day", "gauge", "Золота выдано за последние сутки в журнале", [({}, today["minted"])]),
+        ("sailor_gold_burned_last_day", "gauge", "Золота потрачено за последние сутки в журнале", [({}, today["burned"])]),
+    ]
+
+metrics.add_collector(collect_metrics)
 
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
-    print(f"Ошибка: {context.error}")
+    if isinstance(context.error, StaleWrite):
+        # игрока одновременно изменил другой воркер; кеш уже сброшен, повтор прочитает свежие данные
+        text = "Твои данные только что изменились в другом действии — повтори, пожалуйста."
+    else:
+        # имя упавшего обработчика проставляет обёртка metrics.instrument
+        handler = getattr(context.error, "sailor_handler", "?")
+        logger.exception("Ошибка в обработчике %s", handler, exc_info=context.error)
+        text = "Произошла ошибка — попробуй снова."
     try:
         if isinstance(update, Update) and update.effective_message:
-            await update.effective_message.reply_text("Произошла ошибка — попробуй снова.")
+            await update.effective_message.reply_text(text)
     except Exception:
         pass
 
 
 
-# ------------ Main ------------
-def main():
-    init_db()
-    app = ApplicationBuilder().token(BOT_TOKEN).concurrent_updates(True).build()
+# ------------ Фоновые задачи ------------
+# Всё периодическое идёт через один планировщик: задачи выполняются по
+# очереди и за раз делают ограниченную порцию работы, чтобы не занимать
+# поток-писатель базы надолго и не задерживать обработчики.
+# JobQueue из python-telegram-bot требует отдельной зависимости (APScheduler).
+ENERGY_REGEN_INTERVAL = float(os.getenv("ENERGY_REGEN_INTERVAL", 2))
+ENERGY_REGEN_BATCH = int(os.getenv("ENERGY_REGEN_BATCH", 1000))
+DB_CHECKPOINT_INTERVAL = float(os.getenv("DB_CHECKPOINT_INTERVAL", 60))
+DB_OPTIMIZE_INTERVAL = float(os.getenv("DB_OPTIMIZE_INTERVAL", 3600))
+DB_VACUUM_INTERVAL = float(os.getenv("DB_VACUUM_INTERVAL", 30))
+DB_VACUUM_PAGES = int(os.getenv("DB_VACUUM_PAGES", 256))
+
+jobs = Scheduler()
+# курсор обхода игроков по user_id: за тик — следующий отрезок из ENERGY_REGEN_BATCH
+regen_state = {"after": 0, "players": 0}
+
+async def regen_energy_job():
+    # Энергия по-прежнему считается лениво (current_energy), задача лишь
+    # переносит накопленное в строки, чтобы база не отставала от игры.
+    # Игроков из кеша не трогаем: их строку пишет кеш со своей версией.
+    # Если копия попала в кеш, пока шёл UPDATE, её сброс упрётся в новую
+    # версию, и кеш перенесёт изменения на свежую строку (rebase_players).
+    hi, updated = await player_repo.regen_energy(
+        regen_state["after"], ENERGY_REGEN_BATCH, player_cache.keys(), utcnow().isoformat(),
+    )
+    regen_state["after"] = hi or 0
+    regen_state["players"] += len(updated)
+    # кто попал в кеш, пока шёл UPDATE, перечитается с новой версией
+    for uid in updated:
+        player_cache.invalidate(uid)
+
+async def refresh_snapshot_job():
+    await snapshot.refresh()
+    await analytics.refresh()
+
+async def reopen_snapshot_job():
+    # снимок обновляет воркер 0, остальные подхватывают опубликованный файл
+    if await snapshot.reopen():
+        await analytics.refresh()
+
+def schedule_jobs():
+    # сброс буферов и шардов — в каждом процессе: у каждого они свои
+    jobs.every(PLAYER_FLUSH_INTERVAL, player_cache.flush, name="flush_players")
+    jobs.every(GAME_LOG_FLUSH_INTERVAL, game_log.flush, name="flush_game_log")
+    jobs.every(INVITE_PURGE_INTERVAL, invites.purge, name="purge_invites")
+    jobs.every(DUEL_FLUSH_INTERVAL, duels.flush, name="flush_duels")
+    jobs.every(DUEL_PURGE_INTERVAL, duels.purge, name="purge_duels")
+    jobs.every(RAID_MERGE_INTERVAL, merge_raids_job, name="merge_raids")
+    jobs.every(RAID_STATUS_INTERVAL, raid_status_job, name="raid_status")
+    if WORKER != 0:
+        jobs.every(SNAPSHOT_INTERVAL, reopen_snapshot_job, name="reopen_snapshot")
+    else:
+        # обслуживание общей базы — одна копия на все воркеры
+        jobs.every(ENERGY_REGEN_INTERVAL, regen_energy_job, name="regen_energy")
+        jobs.every(RAID_RETRY_INTERVAL, retry_raids_job, name="retry_raids")
+        jobs.every(SNAPSHOT_INTERVAL, refresh_snapshot_job, name="refresh_snapshot")
+        jobs.every(DB_CHECKPOINT_INTERVAL, db.checkpoint, name="db_checkpoint")
+        jobs.every(DB_OPTIMIZE_INTERVAL, db.optimize, name="db_optimize")
+        jobs.every(GAME_LOG_SNAPSHOT_INTERVAL, functools.partial(game_log.snapshot, GAME_LOG_SNAPSHOT_BATCH), name="game_log_snapshot")
+        jobs.every(DB_VACUUM_INTERVAL, functools.partial(db.incremental_vacuum, DB_VACUUM_PAGES), name="db_vacuum")
+    if SHARED_STATE:
+        # подтягивает в рейтинг изменения других процессов (место игрока — по снимку)
+        jobs.every(LEADERBOARD_RELOAD, functools.partial(load_leaderboard, ranking_repo), name="reload_leaderboard")
 
+# ------------ Main ------------
+async def on_startup(app):
+    db.start()
+    await init_db()
+    await load_leaderboard()
+    await invites.load()
+    await duels.load()
+    await raids.load()
+    if not jobs.jobs:
+        schedule_jobs()
+    jobs.start()
+    await media.load(app.bot.id)
+    outbox.start(app.bot)
+    if MEDIA_WARMUP_CHAT_ID:
+        warm_up_media(MEDIA_WARMUP_CHAT_ID)
+
+async def on_shutdown(app):
+    await jobs.stop()
+    await outbox.stop()
+    await player_cache.stop()
+    await game_log.flush()
+    await duels.flush()
+    # слитый урон переживёт перезапуск, рейд продолжится после него
+    await raids.merge()
+    await close_db()
+
+def build_router() -> CallbackRouter:
+    """Все inline-кнопки бота: один разбор callback_data и поиск по словарю."""
+    router = CallbackRouter()
+    router.add(CB_STYLE, cb_choose_style, aliases=("choose_style", "choose"))
+    router.add(CB_BUY, shop_buy_cb, aliases=("buy",))
+    router.add(CB_TEAM_ACCEPT, team_accept_cb)
+    router.add(CB_TEAM_DECLINE, team_decline_cb)
+    router.add("ta", stale_invite_cb, aliases=("td", "team_accept", "team_decline"))
+    # меню make_user_buttons: первый аргумент — владелец меню
+    router.add(CB_PROFILE, cmd_profile, aliases=("profile",), owner=True)
+    router.add(CB_INVENTORY, cmd_inventory, aliases=("inventory",), owner=True)
+    router.add(CB_FIGHT, cmd_fight, aliases=("fight",), owner=True)
+    router.add(CB_TEAM, cmd_team, aliases=("team",), owner=True)
+    router.add(CB_TEAMUP, cmd_teamup, aliases=("teamup",), owner=True)
+    router.add(CB_LEADERBOARD, cmd_leaderboard, aliases=("leaderboard",), owner=True)
+    router.add(CB_EXPLORE, cmd_explore, aliases=("explore",), owner=True)
+    router.add(CB_TEAMFIGHT, cmd_teamfight, aliases=("teamfight",), owner=True)
+    router.add(CB_BATTLE, cmd_battle, owner=True)
+    router.add(CB_DUEL, duel_cb, owner=True)
+    router.add(CB_RAID, raid_attack_cb, answer=False)
+    return router
+
+def build_application(token: str, request=None, worker: int = 0):
+    """
+    Собирает Application со всеми обработчиками.
+    request — свой BaseRequest (например, заглушка в bench.py) вместо HTTP к Telegram.
+    worker — номер процесса у webhook.serve_workers.
+    """
+    global WORKER
+    WORKER = worker
+    if SHARED_STATE:
+        # счётчики разных процессов — разные ряды
+        metrics.labels["worker"] = worker
+    builder = (
+        ApplicationBuilder()
+        .token(token)
+        .concurrent_updates(True)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    # каждый вызов Bot API замеряется для /metrics
+    builder = builder.request(TimedRequest(request or HTTPXRequest(connection_pool_size=256), metrics))
+    if request is not None:
+        builder = builder.get_updates_request(request)
+    app = builder.build()
+
+    app.add_handler(TypeHandler(Update, gate_update), group=-1)
+    app.add_handler(TypeHandler(Update, release_update), group=1)
     app.add_handler(CommandHandler("start", cmd_start))
-    app.add_handler(CallbackQueryHandler(cb_choose_style, pattern=r"^choose_style:"))
     app.add_handler(CommandHandler("profile", cmd_profile))
     app.add_handler(CommandHandler("inventory", cmd_inventory))
     app.add_handler(CommandHandler("shop", cmd_shop))
-    app.add_handler(CallbackQueryHandler(shop_buy_cb, pattern=r"^buy:"))
     app.add_handler(CommandHandler("fight", cmd_fight))
+    app.add_handler(CommandHandler("battle", cmd_battle))
     app.add_handler(CommandHandler("daily", cmd_daily))
     app.add_handler(CommandHandler("use", cmd_use))
     app.add_handler(CommandHandler("teamup", cmd_teamup))
     app.add_handler(CommandHandler("team", cmd_team))
     app.add_handler(CommandHandler("teamfight", cmd_teamfight))
+    app.add_handler(CommandHandler("raid", cmd_raid))
     app.add_handler(CommandHandler("leaderboard", cmd_leaderboard))
     app.add_handler(CommandHandler("explore", cmd_explore))
     app.add_handler(CommandHandler("energy", cmd_energy))
+    app.add_handler(build_router())
     app.add_handler(MessageHandler(filters.COMMAND, unknown))
     app.add_error_handler(error_handler)
-    app.add_handler(CallbackQueryHandler(cb_choose_style, pattern="^choose:"))
-    app.add_handler(CallbackQueryHandler(team_invite_cb, pattern=r"^team_(accept|decline):"))
-
-    app.run_webhook(
-    listen="0.0.0.0",
-    port=PORT,
-    url_path=BOT_TOKEN,
-    webhook_url=f"{WEBHOOK_URL}/{BOT_TOKEN}"
-    )
+    metrics.instrument_application(app)
+    return app
 
-    print("Бот запущен...")
-    app.run_polling()
+def main():
+    if not BOT_TOKEN:
+        raise RuntimeError("Пожалуйста, укажи BOT_TOKEN через переменную окружения.")
+    logging.basicConfig(format="%(asctime)s %(levelname)s %(name)s: %(message)s", level=logging.INFO)
+    bootstrap_db()
+
+    # свой сервер вместо run_webhook: на том же порту отдаём /metrics
+    options = dict(
+        listen="0.0.0.0",
+        port=PORT,
+        url_path=BOT_TOKEN,
+        webhook_url=f"{WEBHOOK_URL}/{BOT_TOKEN}",
+        registry=metrics,
+        secret=WEBHOOK_SECRET,
+    )
+    if SHARED_STATE:
+        print(f"Бот запущен: {WORKERS} воркеров...")
+        webhook.serve_workers(lambda worker: build_application(BOT_TOKEN, worker=worker), WORKERS, **options)
+    else:
+        print("Бот запущен...")
+        asyncio.run(webhook.serve(build_application(BOT_TOKEN), **options))
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,93 @@
+"""
+Планировщик фоновых задач на одной asyncio-задаче.
+
+Задачи выполняются строго по одной: тяжёлая работа (сброс кеша,
+обслуживание базы) не накладывается друг на друга и не забирает
+поток-писатель SQLite надолго. Первый запуск периодических задач
+разнесён по интервалу, чтобы они не совпадали по времени, а пропущенные
+запуски не догоняются пачкой. Каждая задача сама должна делать за раз
+ограниченную порцию работы.
+"""
+
+import asyncio
+import time
+
+# шаг разнесения первых запусков (доля интервала, золотое сечение)
+_SPREAD = 0.618
+
+
+class Job:
+    __slots__ = ("name", "fn", "interval", "next_run", "runs", "failures", "seconds")
+
+    def __init__(self, name: str, fn, interval: float, next_run: float):
+        self.name = name
+        self.fn = fn
+        self.interval = interval
+        self.next_run = next_run
+        self.runs = 0
+        self.failures = 0
+        self.seconds = 0.0
+
+
+class Scheduler:
+    def __init__(self):
+        self.jobs: list[Job] = []
+        self._task: asyncio.Task | None = None
+        self._wakeup: asyncio.Event | None = None  # создаётся в start(), в цикле событий
+
+    def every(self, interval: float, fn, name: str | None = None, first: float | None = None) -> Job:
+        """
+        Корутина fn() раз в interval секунд. first — задержка первого
+        запуска; по умолчанию задачи разносятся по своему интервалу.
+        """
+        if first is None:
+            first = interval * ((len(self.jobs) + 1) * _SPREAD % 1)
+        job = Job(name or fn.__name__, fn, interval, time.monotonic() + first)
+        self.jobs.append(job)
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return job
+
+    async def _run(self):
+        while True:
+            if not self.jobs:
+                await self._wakeup.wait()
+            self._wakeup.clear()
+            job = min(self.jobs, key=lambda j: j.next_run)
+            delay = job.next_run - time.monotonic()
+            if delay > 0:
+                try:
+                    # новая задача может оказаться раньше текущей ближайшей
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                    continue
+                except asyncio.TimeoutError:
+                    pass
+            started = time.monotonic()
+            try:
+                await job.fn()
+            except Exception as e:
+                job.failures += 1
+                print(f"Ошибка фоновой задачи {job.name}: {e}")
+            finished = time.monotonic()
+            job.runs += 1
+            job.seconds += finished - started
+            # без догоняющих запусков: следующий — не раньше чем через интервал от плана
+            job.next_run = max(job.next_run + job.interval, finished)
+
+    def start(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> list:
+        """[(имя, запусков, ошибок, секунд всего)]"""
+        return [(j.name, j.runs, j.failures, j.seconds) for j in self.jobs]
@@ -0,0 +1,690 @@
+"""
+Хранилище бота: долгоживущие SQLite-соединения на выделенных потоках.
+Все обращения к диску уходят в executor, event loop не блокируется.
+"""
+
+import asyncio
+import functools
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+
+class StaleWrite(Exception):
+    """Строку успел изменить кто-то другой (версия не совпала); keys — такие ключи."""
+
+    def __init__(self, table: str, keys):
+        self.table = table
+        self.keys = list(keys)
+        super().__init__(f"{table}: устаревшая версия для {self.keys}")
+
+
+class Database:
+    """
+    Пул соединений с SQLite в режиме WAL.
+
+    Запись идёт через один поток-писатель (SQLite всё равно допускает
+    только одного писателя), чтение — через несколько потоков-читателей,
+    у каждого из которых своё соединение. Соединения открываются один раз
+    и живут до close(); скомпилированные запросы кешируются sqlite3
+    (cached_statements), поэтому SQL лучше держать в константах.
+    """
+
+    def __init__(self, path: str, readers: int = 2, cached_statements: int = 256):
+        self.path = path
+        self.readers = max(1, readers)
+        self.cached_statements = cached_statements
+        self._local = threading.local()
+        self._conns: list[sqlite3.Connection] = []
+        self._conns_lock = threading.Lock()
+        self._writer: ThreadPoolExecutor | None = None
+        self._reader: ThreadPoolExecutor | None = None
+        self.connections_opened = 0
+        # observer(секунды, запись ли, соединение) — вызывается после каждого
+        # обращения (метрики); соединение — id того, на котором шёл запрос
+        self.observer = None
+
+    # ------------ Жизненный цикл ------------
+    def start(self):
+        if self._writer is not None:
+            return
+        self._writer = ThreadPoolExecutor(
+            max_workers=1,
+            thread_name_prefix="sqlite-writer",
+            initializer=self._init_thread,
+            initargs=(False,),
+        )
+        self._reader = ThreadPoolExecutor(
+            max_workers=self.readers,
+            thread_name_prefix="sqlite-reader",
+            initializer=self._init_thread,
+            initargs=(True,),
+        )
+
+    async def close(self):
+        if self._writer is None:
+            return
+        writer, reader = self._writer, self._reader
+        self._writer = self._reader = None
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, writer.shutdown, True)
+        await loop.run_in_executor(None, reader.shutdown, True)
+        with self._conns_lock:
+            conns, self._conns = self._conns, []
+        for conn in conns:
+            conn.close()
+
+    def _connect(self, readonly: bool) -> sqlite3.Connection:
+        # isolation_level=None — autocommit, транзакции открываем сами через BEGIN
+        conn = sqlite3.connect(
+            self.path,
+            timeout=30,
+            isolation_level=None,
+            check_same_thread=False,  # соединение всё равно живёт в одном потоке
+            cached_statements=self.cached_statements,
+        )
+        if not readonly:
+            # действует только на новую базу, поэтому раньше перехода в WAL,
+            # который уже создаёт файл; старой базе нужен разовый VACUUM
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        if readonly:
+            conn.execute("PRAGMA query_only=ON")
+        return conn
+
+    def _init_thread(self, readonly: bool):
+        conn = self._connect(readonly)
+        self._local.conn = conn
+        with self._conns_lock:
+            self._conns.append(conn)
+            self.connections_opened += 1
+
+    async def _submit(self, write: bool, fn, *args):
+        if self._writer is None:
+            self.start()
+        executor = self._writer if write else self._reader
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        used = None
+        try:
+            used, result = await loop.run_in_executor(executor, functools.partial(self._call, fn, *args))
+            return result
+        finally:
+            if self.observer is not None:
+                self.observer(time.perf_counter() - started, write, used)
+
+    def _call(self, fn, *args):
+        conn = self._local.conn
+        return id(conn), fn(conn, *args)
+
+    # ------------ Чтение ------------
+    async def fetchone(self, sql: str, params=()):
+        return await self._submit(False, _fetchone, sql, params)
+
+    async def fetchall(self, sql: str, params=()):
+        return await self._submit(False, _fetchall, sql, params)
+
+    async def read(self, fn, *args):
+        """Выполняет fn(conn, *args) на соединении-читателе."""
+        return await self._submit(False, fn, *args)
+
+    # ------------ Запись ------------
+    async def execute(self, sql: str, params=()) -> int:
+        """Одиночный запрос на запись, возвращает rowcount."""
+        return await self._submit(True, _execute, sql, params)
+
+    async def insert(self, sql: str, params=()) -> int:
+        """INSERT, возвращает lastrowid."""
+        return await self._submit(True, _insert, sql, params)
+
+    async def executemany(self, sql: str, seq_of_params) -> int:
+        return await self.transaction(_executemany, sql, list(seq_of_params))
+
+    async def executescript(self, script: str):
+        return await self._submit(True, _executescript, script)
+
+    async def transaction(self, fn, *args):
+        """
+        Выполняет fn(conn, *args) в одной транзакции на потоке-писателе.
+        Любое исключение откатывает транзакцию целиком.
+        """
+        return await self._submit(True, _in_transaction, fn, *args)
+
+    async def migrate(self, migrations) -> int:
+        """
+        Применяет миграции, которых ещё не было в этой базе.
+        Номер последней применённой хранится в PRAGMA user_version;
+        каждая миграция — SQL-скрипт или функция fn(conn) — идёт
+        в своей транзакции. Возвращает новую версию схемы.
+        """
+        return await self._submit(True, _migrate, list(migrations))
+
+    # ------------ Обслуживание ------------
+    # Каждый шаг ограничен по объёму работы и идёт через поток-писатель
+    # между обычными записями, поэтому их можно вызывать по таймеру.
+    async def checkpoint(self) -> tuple:
+        """
+        Переносит WAL в основной файл, не дожидаясь читателей (PASSIVE).
+        Возвращает (страниц в WAL, перенесено).
+        """
+        return tuple((await self._submit(True, _fetchone, "PRAGMA wal_checkpoint(PASSIVE)", ()))[1:])
+
+    async def optimize(self, analysis_limit: int = 400):
+        """ANALYZE по выборке для таблиц, где статистика устарела."""
+        await self._submit(True, _optimize, analysis_limit)
+
+    async def incremental_vacuum(self, pages: int) -> int:
+        """Возвращает файлу до pages свободных страниц; только при auto_vacuum=INCREMENTAL."""
+        return await self._submit(True, _incremental_vacuum, pages)
+
+
+def _fetchone(conn, sql, params):
+    return conn.execute(sql, params).fetchone()
+
+
+def _fetchall(conn, sql, params):
+    return conn.execute(sql, params).fetchall()
+
+
+def _execute(conn, sql, params):
+    return conn.execute(sql, params).rowcount
+
+
+def _insert(conn, sql, params):
+    return conn.execute(sql, params).lastrowid
+
+
+def _executemany(conn, sql, seq):
+    return conn.executemany(sql, seq).rowcount
+
+
+def _executescript(conn, script):
+    conn.executescript(script)
+
+
+def _optimize(conn, analysis_limit):
+    conn.execute(f"PRAGMA analysis_limit = {int(analysis_limit)}")
+    conn.execute("PRAGMA optimize")
+
+
+def _incremental_vacuum(conn, pages):
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        return 0
+    free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    if free:
+        conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+    return free - conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+
+def _migrate(conn, migrations):
+    # версию перечитываем под блокировкой записи: несколько процессов-воркеров
+    # стартуют одновременно, и шаг должен выполнить ровно один из них
+    while True:
+        conn.execute("BEGIN IMMEDIATE")
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version >= len(migrations):
+            conn.execute("COMMIT")
+            return version
+        i, step = version + 1, migrations[version]
+        try:
+            if callable(step):
+                step(conn)
+            else:
+                for stmt in step.split(";"):
+                    if stmt.strip():
+                        conn.execute(stmt)
+            conn.execute(f"PRAGMA user_version = {i}")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+
+def _in_transaction(conn, fn, *args):
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        result = fn(conn, *args)
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+    return result
+
+
+# ------------ Снимок базы для тяжёлого чтения ------------
+class ReadOnlyDatabase(Database):
+    """
+    Читатели неизменяемого файла (снимка): immutable=1 отключает блокировки
+    и журнал, поэтому чтение никак не задевает рабочую базу. Писать нельзя.
+    """
+
+    def _connect(self, readonly: bool) -> sqlite3.Connection:
+        return sqlite3.connect(
+            f"file:{quote(os.path.abspath(self.path))}?mode=ro&immutable=1",
+            uri=True,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=self.cached_statements,
+        )
+
+
+class _BackupStalled(Exception):
+    pass
+
+
+class Snapshot:
+    """
+    Периодически обновляемая копия базы только для чтения — для аналитики
+    и других тяжёлых запросов, которые не должны делить файл с записью.
+
+    refresh() копирует базу через online backup API порциями по pages
+    страниц на отдельном потоке и отдельном соединении: поток-писатель
+    не занят, а в WAL-режиме чтение копии не мешает писать. Если база
+    меняется быстрее, чем идёт копирование (backup начинает заново после
+    каждой чужой записи), после max_stalls шагов без продвижения копия
+    снимается одним шагом — одной транзакцией чтения.
+
+    Копия собирается во временном файле процесса и публикуется под path
+    атомарным os.replace: открытые соединения (в том числе других
+    воркеров) дочитывают прежний файл — он живёт, пока его держат, — а
+    новые открывают уже свежий. Процесс, который сам не обновляет снимок,
+    подхватывает опубликованный через reopen(). Методы чтения те же, что
+    у Database, поэтому поверх снимка работают репозитории.
+    """
+
+    def __init__(self, source: str, path: str, pages: int = 1024, sleep: float = 0.005,
+                 max_stalls: int = 8, readers: int = 1):
+        self.source = source
+        self.path = path
+        self.pages = pages
+        self.sleep = sleep
+        self.max_stalls = max_stalls
+        self.readers = readers
+        self.db: ReadOnlyDatabase | None = None
+        self.observer = None
+        self._inode = None  # какой файл открыт в self.db
+        self._lock = asyncio.Lock()
+        self.refreshes = 0
+        self.stalled = 0  # обновлений, снятых одним шагом
+        self.refreshed_at = 0.0  # unix-время последнего снимка
+        self.seconds = 0.0  # длительность последнего обновления
+
+    async def refresh(self) -> float:
+        async with self._lock:
+            tmp = f"{self.path}.{os.getpid()}.tmp"
+            started = time.perf_counter()
+            stalled = await asyncio.get_running_loop().run_in_executor(
+                None, _backup, self.source, tmp, self.pages, self.sleep, self.max_stalls,
+            )
+            os.replace(tmp, self.path)
+            self.refreshes += 1
+            self.stalled += stalled
+            self.seconds = time.perf_counter() - started
+            await self._open()
+        return self.seconds
+
+    async def reopen(self) -> bool:
+        """Переключается на снимок, опубликованный другим процессом; True, если он новый."""
+        async with self._lock:
+            try:
+                inode = os.stat(self.path).st_ino
+            except FileNotFoundError:
+                return False
+            if inode == self._inode:
+                return False
+            await self._open()
+            return True
+
+    async def _open(self):
+        st = os.stat(self.path)
+        old, self.db = self.db, ReadOnlyDatabase(self.path, readers=self.readers)
+        self.db.observer = self.observer
+        self._inode = st.st_ino
+        self.refreshed_at = st.st_mtime
+        # соединения со старым файлом закроются, когда допишут начатые запросы
+        if old is not None:
+            await old.close()
+
+    async def close(self):
+        if self.db is not None:
+            db, self.db = self.db, None
+            await db.close()
+
+    async def _current(self) -> ReadOnlyDatabase:
+        if self.db is None and not await self.reopen():
+            await self.refresh()
+        return self.db
+
+    async def fetchone(self, sql: str, params=()):
+        return await (await self._current()).fetchone(sql, params)
+
+    async def fetchall(self, sql: str, params=()):
+        return await (await self._current()).fetchall(sql, params)
+
+    async def read(self, fn, *args):
+        return await (await self._current()).read(fn, *args)
+
+
+def _backup(source, target, pages, sleep, max_stalls) -> bool:
+    for suffix in ("", "-journal"):
+        if os.path.exists(target + suffix):
+            os.remove(target + suffix)
+    src = sqlite3.connect(source, timeout=30)
+    dst = sqlite3.connect(target)
+    try:
+        src.execute("PRAGMA query_only=ON")
+        state = {"remaining": None, "stalls": 0}
+
+        def progress(status, remaining, total):
+            if state["remaining"] is not None and remaining >= state["remaining"]:
+                state["stalls"] += 1
+                if state["stalls"] > max_stalls:
+                    raise _BackupStalled
+            state["remaining"] = remaining
+
+        try:
+            src.backup(dst, pages=pages, progress=progress, sleep=sleep)
+            return False
+        except _BackupStalled:
+            src.backup(dst, pages=-1)
+            return True
+    finally:
+        dst.close()
+        src.close()
+
+
+# ------------ Кеш с отложенной записью ------------
+class WriteBehindCache:
+    """
+    LRU/TTL-кеш объектов с отложенной записью.
+
+    Объекты должны вести множество изменённых полей в атрибуте _dirty.
+    Грязные объекты не вытесняются, пока не будут сброшены на диск.
+    Сам кеш SQL не знает: изменения пишет store (например, TableWriter
+    или репозиторий игроков) в два шага — store.prepare(changes)
+    синхронно снимает значения, await store.apply(batch) пишет их одной
+    транзакцией. changes — [(obj, fields, expected)], где expected —
+    версия, с которой объект был прочитан (None без версий).
+
+    version — имя атрибута-версии для оптимистичной блокировки (несколько
+    процессов пишут в одну базу): 0 — строки в базе ещё нет, иначе store
+    пишет с условием на версию. Если версия не совпала, store откатывает
+    транзакцию с StaleWrite, а устаревшие объекты выбрасываются из кеша.
+
+    rebase — необязательная корутина rebase(objs): перечитывает строки
+    устаревших объектов и переносит в них всё, кроме несохранённых полей,
+    вместе с новой версией. Если она задана, запись после StaleWrite
+    повторяется один раз, и изменения не теряются.
+    """
+
+    def __init__(self, store, key: str, maxsize: int = 10000, ttl: float = 600.0,
+                 version: str | None = None, rebase=None):
+        self.store = store
+        self.version = version
+        self.rebase = rebase
+        self.table = store.table
+        self.key = key
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items: OrderedDict = OrderedDict()  # key -> [obj, expires_at]
+        self._dirty: dict = {}  # key -> obj
+        self.hits = 0
+        self.misses = 0
+        self.conflicts = 0
+        self.rebased = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def keys(self) -> list:
+        """Снимок ключей закешированных объектов."""
+        return list(self._items)
+
+    def get(self, key):
+        entry = self._items.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        obj, expires = entry
+        now = time.monotonic()
+        if expires < now and key not in self._dirty:
+            del self._items[key]
+            self.misses += 1
+            return None
+        entry[1] = now + self.ttl
+        self._items.move_to_end(key)
+        self.hits += 1
+        return obj
+
+    def put(self, obj):
+        key = getattr(obj, self.key)
+        self._items[key] = [obj, time.monotonic() + self.ttl]
+        self._items.move_to_end(key)
+        if obj._dirty:
+            self._dirty[key] = obj
+        self._evict()
+
+    def add(self, obj):
+        """
+        Кладёт только что прочитанный obj, если живого объекта с тем же
+        ключом ещё нет, и возвращает тот, что оказался в кеше. Пока шло
+        чтение, объект мог загрузить и изменить другой обработчик — его
+        нельзя подменять устаревшей копией.
+        """
+        key = getattr(obj, self.key)
+        entry = self._items.get(key)
+        if entry is not None and (key in self._dirty or entry[1] >= time.monotonic()):
+            return entry[0]
+        self.put(obj)
+        return obj
+
+    def mark_dirty(self, obj):
+        key = getattr(obj, self.key)
+        if self._items.get(key, (None,))[0] is not obj:
+            self.put(obj)
+        elif obj._dirty:
+            self._dirty[key] = obj
+
+    def invalidate(self, key):
+        if key not in self._dirty:
+            self._items.pop(key, None)
+
+    def _evict(self):
+        if len(self._items) <= self.maxsize:
+            return
+        for key in list(self._items):
+            if len(self._items) <= self.maxsize:
+                break
+            if key not in self._dirty:
+                del self._items[key]
+
+    # ------------ Сброс на диск ------------
+    def _collect(self, objs):
+        """
+        Снимает значения объектов синхронно, до ухода в executor.
+        Версия увеличивается здесь же, чтобы следующий снимок того же
+        объекта, отправленный до завершения этой записи, ждал уже новую.
+        """
+        taken = []
+        v = self.version
+        for obj in objs:
+            key = getattr(obj, self.key)
+            self._dirty.pop(key, None)
+            fields = obj._dirty
+            if not fields:
+                continue
+            expected = getattr(obj, v) if v else None
+            taken.append((obj, set(fields), expected))
+            fields.clear()
+        batch = self.store.prepare(taken)
+        if v:
+            for obj, _, expected in taken:
+                object.__setattr__(obj, v, (expected or 0) + 1)
+        return batch, taken
+
+    async def _write(self, objs, restore_dirty: bool, retry: bool = True) -> int:
+        # Отдельная блокировка не нужна: значения снимаются синхронно и сразу
+        # уходят store, который выполняет транзакции строго в порядке отправки
+        # (у SQLite — единственный поток-писатель), — более свежий снимок
+        # не обгонит старый.
+        batch, taken = self._collect(objs)
+        if not taken:
+            return 0
+        try:
+            await self.store.apply(batch)
+        except BaseException as e:
+            stale = set(e.keys) if isinstance(e, StaleWrite) else ()
+            self.conflicts += len(stale)
+            rebase = bool(stale) and retry and self.rebase is not None
+            for obj, fields, expected in taken:
+                key = getattr(obj, self.key)
+                if self.version:
+                    object.__setattr__(obj, self.version, expected)
+                if rebase:
+                    # транзакция откатилась целиком: пачка пишется заново
+                    obj._dirty |= fields
+                elif key in stale:
+                    # в памяти устаревшие данные: следующий get перечитает строку
+                    self._items.pop(key, None)
+                    self._dirty.pop(key, None)
+                elif restore_dirty:
+                    # вернуть пометки, чтобы не потерять изменения при следующем сбросе
+                    obj._dirty |= fields
+                    self._dirty[key] = obj
+            if not rebase:
+                raise
+        else:
+            self._evict()
+            return len(taken)
+        objs = [obj for obj, _, _ in taken]
+        try:
+            await self.rebase([obj for obj in objs if getattr(obj, self.key) in stale])
+        except BaseException:
+            if restore_dirty:
+                for obj in objs:
+                    self._dirty[getattr(obj, self.key)] = obj
+            raise
+        self.rebased += len(stale)
+        return await self._write(objs, restore_dirty, retry=False)
+
+    async def flush(self) -> int:
+        """Пишет все грязные объекты одной транзакцией, возвращает их число."""
+        return await self._write(list(self._dirty.values()), restore_dirty=True)
+
+    async def write_through(self, objs) -> int:
+        """
+        Немедленно пишет переданные объекты одной транзакцией (всё или ничего).
+        При ошибке пометки не восстанавливаются: вызывающий сам откатывает
+        изменения в памяти. При StaleWrite устаревшие объекты уже удалены из кеша.
+        """
+        objs = list(objs)
+        for obj in objs:
+            self.mark_dirty(obj)
+        return await self._write(objs, restore_dirty=False)
+
+    async def stop(self):
+        """Последний сброс при остановке; периодический вызывает планировщик бота."""
+        await self.flush()
+
+
+# ------------ Запись строк таблицы ------------
+class TableWriter:
+    """
+    Store для WriteBehindCache: пишет объекты в одну таблицу SQLite.
+
+    Если изменены все колонки и версии ещё нет — строка новая и пишется
+    через INSERT OR REPLACE (с версией — INSERT OR IGNORE с проверкой, что
+    строка вставилась), иначе UPDATE только изменённых колонок; с версией
+    UPDATE идёт с условием на неё и увеличивает её.
+
+    extra(obj, fields) — необязательный хук для связанных таблиц: получает
+    изменённые поля (в т.ч. не являющиеся колонками) и возвращает
+    [(sql, params)], которые выполняются в той же транзакции.
+
+    Диалект SQL вынесен в _insert_stmt/_update_stmt, чтобы другие базы
+    переопределяли только текст запросов и apply().
+    """
+
+    def __init__(self, db, table: str, key: str, columns, extra=None, version: str | None = None):
+        self.db = db
+        self.table = table
+        self.key = key
+        self.columns = tuple(columns)
+        self.extra = extra
+        self.version = version
+        self._insert_sql = self._insert_stmt()
+        self._update_sql: dict = {}
+
+    def _insert_stmt(self) -> str:
+        cols = self.columns + ((self.version,) if self.version else ())
+        verb = "INSERT OR IGNORE" if self.version else "INSERT OR REPLACE"
+        return f"{verb} INTO {self.table} ({', '.join(cols)}) VALUES ({','.join('?' * len(cols))})"
+
+    def _build_update(self, fields: tuple) -> str:
+        sets = [f"{f} = ?" for f in fields]
+        if self.version:
+            v = self.version
+            sets.append(f"{v} = {v} + 1")
+            return f"UPDATE {self.table} SET {', '.join(sets)} WHERE {self.key} = ? AND {v} = ?"
+        return f"UPDATE {self.table} SET {', '.join(sets)} WHERE {self.key} = ?"
+
+    def _update_stmt(self, fields: tuple) -> str:
+        sql = self._update_sql.get(fields)
+        if sql is None:
+            sql = self._update_sql[fields] = self._build_update(fields)
+        return sql
+
+    def prepare(self, changes):
+        """[(sql, rows, keys)]; keys — для проверки версий, None — executemany без проверки."""
+        inserts, updates, extra = [], {}, {}
+        insert_keys, update_keys = [], {}
+        v = self.version
+        for obj, fields, expected in changes:
+            key = getattr(obj, self.key)
+            if fields.issuperset(self.columns) and not expected:
+                row = tuple(getattr(obj, c) for c in self.columns)
+                inserts.append(row + (1,) if v else row)
+                insert_keys.append(key)
+            else:
+                ordered = tuple(c for c in self.columns if c in fields)
+                # с версией UPDATE нужен и без колонок: он проверяет и двигает версию
+                if ordered or v:
+                    row = tuple(getattr(obj, c) for c in ordered) + (key,)
+                    updates.setdefault(ordered, []).append(row + (expected,) if v else row)
+                    update_keys.setdefault(ordered, []).append(key)
+            if self.extra is not None:
+                for sql, params in self.extra(obj, fields):
+                    extra.setdefault(sql, []).append(params)
+        batches = [(self._insert_sql, inserts, insert_keys if v else None)] if inserts else []
+        batches += [
+            (self._update_stmt(f), rows, update_keys[f] if v else None) for f, rows in updates.items()
+        ]
+        batches += [(sql, rows, None) for sql, rows in extra.items()]
+        return batches
+
+    async def apply(self, batches):
+        if batches:
+            await self.db.transaction(_write_batches, self.table, batches)
+
+
+def _write_batches(conn, table, batches):
+    stale = []
+    for sql, rows, keys in batches:
+        if keys is None:
+            conn.executemany(sql, rows)
+            continue
+        for row, key in zip(rows, keys):
+            if conn.execute(sql, row).rowcount != 1:
+                stale.append(key)
+    if stale:
+        raise StaleWrite(table, stale)
@@ -0,0 +1,17 @@
+import os
+import sys
+
+import pytest
+
+# модули бота лежат в корне репозитория, пакета нет
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="session")
+def bot(tmp_path_factory):
+    # sailor_bot читает окружение при импорте; сеть и /data не нужны
+    os.environ["DB_PATH"] = str(tmp_path_factory.mktemp("bot") / "bot.db")
+    os.environ.pop("DATABASE_URL", None)
+    import sailor_bot
+
+    return sailor_bot
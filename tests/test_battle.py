@@ -0,0 +1,20 @@
+import random
+
+import battle
+
+BOSS = {"reward_xp": 100, "reward_gold": 33}
+
+
+def test_raid_pool_is_one_boss_reward_split_by_damage():
+    damage = {uid: uid % 7 + 1 for uid in range(1, 51)}
+    rewards = battle.raid_rewards(BOSS, damage, random.Random(1))
+    # сколько бы ни пришло участников, на всех — одна награда босса
+    assert sum(xp for xp, _, _ in rewards.values()) == BOSS["reward_xp"]
+    assert sum(gold for _, gold, _ in rewards.values()) == BOSS["reward_gold"]
+    assert sum(drop for _, _, drop in rewards.values()) <= 1
+    assert rewards[6][0] > rewards[7][0]
+
+
+def test_raid_reward_follows_damage_share():
+    rewards = battle.raid_rewards(BOSS, {1: 3, 2: 1}, random.Random(1))
+    assert [rewards[uid][:2] for uid in (1, 2)] == [(75, 25), (25, 8)]
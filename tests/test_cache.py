@@ -0,0 +1,104 @@
+import asyncio
+
+import pytest
+
+from storage import Database, TableWriter, WriteBehindCache
+
+COLUMNS = ("user_id", "name", "gold")
+
+
+class Row:
+    """Как Player в боте: помнит, какие поля менялись."""
+
+    def __init__(self, user_id, name, gold):
+        self.__dict__["_dirty"] = set(COLUMNS)
+        self.user_id, self.name, self.gold = user_id, name, gold
+
+    def __setattr__(self, name, value):
+        if self.__dict__.get(name) != value:
+            self._dirty.add(name)
+        object.__setattr__(self, name, value)
+
+
+async def _open(tmp_path, **kwargs):
+    db = Database(str(tmp_path / "cache.db"))
+    db.start()
+    await db.execute("CREATE TABLE players (user_id INTEGER PRIMARY KEY, name TEXT, gold INTEGER)")
+    return db, WriteBehindCache(TableWriter(db, "players", "user_id", COLUMNS), "user_id", **kwargs)
+
+
+def test_flush_writes_only_changed_columns(tmp_path):
+    async def scenario():
+        db, cache = await _open(tmp_path)
+        p = Row(1, "Usagi", 50)
+        cache.mark_dirty(p)
+        assert await cache.flush() == 1
+        assert p._dirty == set()
+        # строку поменяли мимо кеша: UPDATE одного gold не должен её затереть
+        await db.execute("UPDATE players SET name = 'Serena' WHERE user_id = 1")
+        p.gold += 10
+        assert p._dirty == {"gold"}
+        cache.mark_dirty(p)
+        assert await cache.flush() == 1
+        assert await cache.flush() == 0
+        row = await db.fetchone("SELECT name, gold FROM players WHERE user_id = 1")
+        await db.close()
+        return row
+
+    assert asyncio.run(scenario()) == ("Serena", 60)
+
+
+def test_failed_flush_keeps_dirty_fields(tmp_path):
+    async def scenario():
+        db, cache = await _open(tmp_path)
+        p = Row(1, "Usagi", 50)
+        cache.mark_dirty(p)
+        await db.execute("DROP TABLE players")
+        with pytest.raises(Exception):
+            await cache.flush()
+        assert p._dirty == set(COLUMNS)
+        await db.execute("CREATE TABLE players (user_id INTEGER PRIMARY KEY, name TEXT, gold INTEGER)")
+        assert await cache.flush() == 1
+        row = await db.fetchone("SELECT name, gold FROM players WHERE user_id = 1")
+        await db.close()
+        return row
+
+    assert asyncio.run(scenario()) == ("Usagi", 50)
+
+
+def test_dirty_objects_are_not_evicted(tmp_path):
+    async def scenario():
+        db, cache = await _open(tmp_path, maxsize=2)
+        rows = [Row(uid, f"p{uid}", 0) for uid in range(1, 5)]
+        for p in rows:
+            cache.mark_dirty(p)
+        # все грязные — вытеснять нельзя, даже сверх maxsize
+        assert len(cache) == 4
+        await cache.flush()
+        cache.put(Row(9, "new", 0))
+        assert len(cache) <= 2
+        assert cache.get(9) is not None
+        await db.close()
+
+    asyncio.run(scenario())
+
+
+def test_write_through_is_all_or_nothing(tmp_path):
+    async def scenario():
+        db, cache = await _open(tmp_path)
+        squad = [Row(1, "Usagi", 50), Row(2, "Rei", 50)]
+        await cache.write_through(squad)
+        await db.execute("CREATE TRIGGER no_null BEFORE UPDATE ON players "
+                         "WHEN NEW.name IS NULL BEGIN SELECT RAISE(ABORT, 'name'); END")
+        for p in squad:
+            p.gold += 10
+        squad[1].name = None  # триггер отклонит только вторую строку
+        with pytest.raises(Exception):
+            await cache.write_through(squad)
+        # пометки не восстанавливаются: откат в памяти — забота вызывающего
+        assert await cache.flush() == 0
+        rows = await db.fetchall("SELECT user_id, gold FROM players ORDER BY user_id")
+        await db.close()
+        return rows
+
+    assert asyncio.run(scenario()) == [(1, 50), (2, 50)]
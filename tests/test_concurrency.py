@@ -0,0 +1,129 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+from telegram.ext import ApplicationHandlerStop
+
+from concurrency import Coalescer, KeyedLocks, Throttle
+
+
+def test_cancelled_reacquire_drops_key():
+    # задача отпускает ключ и сразу берёт снова, а замок уже отдан ожидающему:
+    # отмена в этот момент не должна оставлять запись о ключе
+    async def scenario():
+        locks = KeyedLocks()
+
+        async def twice():
+            async with locks.hold(1):
+                await asyncio.sleep(0.01)
+            async with locks.hold(1):
+                pass
+
+        async def waiter():
+            async with locks.hold(1):
+                await asyncio.sleep(0.01)
+
+        a = asyncio.create_task(twice())
+        await asyncio.sleep(0)
+        w = asyncio.create_task(waiter())
+        await asyncio.sleep(0.015)
+        a.cancel()
+        await asyncio.gather(a, w, return_exceptions=True)
+        return len(locks)
+
+    assert asyncio.run(scenario()) == 0
+
+
+def test_cancelled_waiter_drops_key():
+    async def scenario():
+        locks = KeyedLocks()
+        release = asyncio.Event()
+
+        async def holder():
+            async with locks.hold(1):
+                await release.wait()
+
+        async def waiter():
+            async with locks.hold(1):
+                pass
+
+        h = asyncio.create_task(holder())
+        await asyncio.sleep(0)
+        w = asyncio.create_task(waiter())
+        await asyncio.sleep(0)
+        w.cancel()
+        release.set()
+        await asyncio.gather(h, w, return_exceptions=True)
+        return len(locks)
+
+    assert asyncio.run(scenario()) == 0
+
+
+def test_throttle_allows_burst_then_rejects_per_key():
+    t = Throttle(rate=1000.0, burst=3)
+    assert [t.hit(1) for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert t.hit(1) > 0
+    assert t.hit(2) == 0.0  # у другого игрока своё ведро
+    # предупреждение — один раз за серию отказов
+    assert t.should_warn(1) and not t.should_warn(1)
+    time.sleep(0.005)
+    assert t.hit(1) == 0.0
+    assert t.should_warn(1)
+    assert (t.allowed, t.rejected) == (5, 1)
+
+
+def test_throttle_evicts_least_recent_key():
+    t = Throttle(rate=1.0, burst=1, max_keys=2)
+    t.hit(1)
+    t.hit(2)
+    t.hit(1)
+    t.hit(3)
+    assert len(t) == 2
+    assert t.hit(2) == 0.0  # ведро 2 вытеснено и создано заново полным
+
+
+def test_coalescer_drops_duplicates_until_leave_or_ttl():
+    c = Coalescer(ttl=0.01)
+    assert c.enter((1, "/fight"))
+    assert not c.enter((1, "/fight"))
+    assert c.enter((1, "/shop"))
+    c.leave((1, "/fight"))
+    assert c.enter((1, "/fight"))
+    time.sleep(0.02)
+    # ключ не сняли (например, задачу отменили) — через ttl он снова свободен
+    assert c.enter((1, "/shop"))
+    assert c.coalesced == 1
+
+
+def _command(user_id, text):
+    return SimpleNamespace(
+        effective_user=SimpleNamespace(id=user_id), effective_chat=SimpleNamespace(id=user_id),
+        callback_query=None, message=SimpleNamespace(text=text),
+    )
+
+
+def test_gate_coalesces_then_throttles(bot):
+    async def scenario():
+        first = _command(9001, "/fight")
+        await bot.gate_update(first, None)
+        # тот же /fight, пока первый не обработан, — склеивается
+        with pytest.raises(ApplicationHandlerStop):
+            await bot.gate_update(_command(9001, "/fight"), None)
+        await bot.release_update(first, None)
+        results = []
+        for _ in range(int(bot.THROTTLE_BURST) + 2):
+            update = _command(9001, "/fight")
+            try:
+                await bot.gate_update(update, None)
+                results.append(True)
+            except ApplicationHandlerStop:
+                results.append(False)
+            await bot.release_update(update, None)
+        return results
+
+    results = asyncio.run(scenario())
+    # первый /fight уже потратил токен из всплеска
+    assert results.count(True) == int(bot.THROTTLE_BURST) - 1
+    assert results[-1] is False
+
@@ -0,0 +1,55 @@
+import asyncio
+
+import pytest
+
+from battle import Duel
+from duels import MIGRATE_BATTLES, DuelRegistry
+from storage import Database, StaleWrite
+
+
+def test_checkpoints_survive_restart(tmp_path):
+    async def scenario():
+        db = Database(str(tmp_path / "duels.db"))
+        db.start()
+        await db.executescript(MIGRATE_BATTLES)
+        duels = DuelRegistry(db)
+        one, two = Duel(1, 0, 30, 100), Duel(2, 1, 40, 90)
+        await duels.start(one)
+        await duels.start(two)
+        assert await duels.flush() == 2
+
+        # ход сделан, но в базе — только контрольная точка после flush
+        one.turn, one.monster_hp = 1, 18
+        await duels.save(one)
+        two.turn = 1
+        await duels.finish(two, "won")
+        assert await duels.flush() == 2
+
+        restarted = DuelRegistry(db)
+        await restarted.load()
+        d = await restarted.get(1)
+        assert (d.turn, d.monster_hp, d.hp) == (1, 18, 100)
+        assert await restarted.get(2) is None
+        await db.close()
+
+    asyncio.run(scenario())
+
+
+def test_shared_turn_is_applied_once(tmp_path):
+    async def scenario():
+        db = Database(str(tmp_path / "duels.db"))
+        db.start()
+        await db.executescript(MIGRATE_BATTLES)
+        duels = DuelRegistry(db, shared=True)
+        await duels.start(Duel(1, 0, 30, 100))
+        # два воркера прочитали один и тот же ход
+        first, second = await duels.get(1), await duels.get(1)
+        first.turn += 1
+        await duels.save(first)
+        second.turn += 1
+        with pytest.raises(StaleWrite):
+            await duels.save(second)
+        assert (await duels.get(1)).turn == 1
+        await db.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,42 @@
+from datetime import datetime, timedelta, timezone
+
+NOW = datetime(2026, 1, 1, 12, 0, tzinfo=timezone.utc)
+
+
+def _player(bot, energy, ago=None):
+    p = bot.create_player_obj(1, "usagi", "Usagi", "luna")
+    p.energy = energy
+    p.last_energy_tick = (NOW - ago).isoformat() if ago is not None else ""
+    p._dirty.clear()
+    return p
+
+
+def test_current_energy_is_derived_without_writes(bot):
+    hour = bot.ENERGY_REGEN_SECONDS
+    p = _player(bot, 1, timedelta(seconds=2 * hour + 600))
+    assert bot.current_energy(p, NOW) == (3, hour - 600)
+    assert p.energy == 1
+    assert p._dirty == set()
+    # регенерация упирается в максимум
+    assert bot.current_energy(p, NOW + timedelta(days=1)) == (bot.MAX_ENERGY, 0)
+    # старые записи без отметки считаются полностью восстановленными
+    assert bot.current_energy(_player(bot, 0), NOW) == (bot.MAX_ENERGY, 0)
+
+
+def test_spend_keeps_partial_regeneration(bot):
+    hour = bot.ENERGY_REGEN_SECONDS
+    p = _player(bot, 1, timedelta(seconds=2 * hour + 600))
+    assert bot.spend_energy(p, now=NOW)
+    assert p.energy == 2
+    # начатые 10 минут следующей единицы не сгорают
+    assert bot.current_energy(p, NOW) == (2, hour - 600)
+    assert not bot.spend_energy(_player(bot, 0, timedelta(seconds=600)), now=NOW)
+
+
+def test_spend_from_full_starts_regeneration_now(bot):
+    p = _player(bot, bot.MAX_ENERGY, timedelta(days=3))
+    assert bot.spend_energy(p, now=NOW)
+    assert p.last_energy_tick == NOW.isoformat()
+    assert bot.current_energy(p, NOW) == (bot.MAX_ENERGY - 1, bot.ENERGY_REGEN_SECONDS)
+    bot.grant_energy(p, 3, now=NOW)
+    assert p.energy == bot.MAX_ENERGY
@@ -0,0 +1,49 @@
+import asyncio
+import sqlite3
+
+import gamelog
+
+UID = 77
+
+
+async def _play(bot):
+    """Старт и бой через save_player; журнал и игроки сброшены на диск."""
+    await bot.init_db()
+    p = bot.create_player_obj(UID, "minako", "Minako", "venus")
+    await bot.save_player(p, "start")
+    p.gold += 30
+    p.xp += 7
+    await bot.save_player(p, "fight", monster="slime", won=True, dg=30)
+    await bot.game_log.flush()
+    await bot.player_cache.flush()
+    return p.gold, p.xp
+
+
+def test_replay_restores_players_from_log(bot):
+    gold, xp = asyncio.run(_play(bot))
+    conn = sqlite3.connect(bot.DB_PATH, isolation_level=None)
+    try:
+        # строка игрока потеряла бой — журнал его помнит
+        conn.execute("UPDATE players SET gold = 0, xp = 0 WHERE user_id = ?", (UID,))
+        assert gamelog.replay(conn, dry_run=True)["differ"] >= 1
+        assert gamelog.replay(conn)["updated"] >= 1
+        assert conn.execute("SELECT gold, xp FROM players WHERE user_id = ?", (UID,)).fetchone() == (gold, xp)
+        # снимки и свёртка с нуля дают одно и то же
+        assert gamelog.fold_log(conn)[UID] == gamelog.load_snapshots(conn, [UID])[UID]
+        assert gamelog.audit(conn, UID) == []
+    finally:
+        conn.close()
+
+
+def test_audit_reports_gold_mismatch(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / "log.db"), isolation_level=None)
+    conn.executescript(gamelog.MIGRATE_GAME_LOG)
+    conn.executemany(gamelog.SQL_APPEND, [
+        (1.0, 1, "start", '{"set":{"gold":50}}'),
+        (2.0, 1, "buy", '{"set":{"gold":30},"dg":-20}'),
+        # вторая покупка записала то же золото: обновление потеряно
+        (3.0, 1, "buy", '{"set":{"gold":30},"dg":-20}'),
+    ])
+    assert gamelog.audit(conn) == [(3, 1, "buy", 30, -20, 30)]
+    assert gamelog.fold_log(conn, upto=1) == {1: {"gold": 50}}
+    conn.close()
@@ -0,0 +1,39 @@
+import sqlite3
+
+import repos
+
+
+def _legacy_db():
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE players (user_id INTEGER PRIMARY KEY, inventory TEXT)")
+    conn.executemany(
+        "INSERT INTO players VALUES (?, ?)",
+        [(1, "moon_crystal,potion,moon_crystal"), (2, ""), (3, None), (4, "potion,,")],
+    )
+    return conn
+
+
+def test_migration_counts_legacy_items():
+    conn = _legacy_db()
+    repos.migrate_inventory(conn)
+    rows = conn.execute("SELECT user_id, item_key, qty FROM inventory ORDER BY user_id, item_key").fetchall()
+    assert rows == [(1, "moon_crystal", 2), (1, "potion", 1), (4, "potion", 1)]
+    assert conn.execute("SELECT count(*) FROM players WHERE inventory != ''").fetchone() == (0,)
+    # повторный запуск ничего не удваивает
+    repos.migrate_inventory(conn)
+    assert conn.execute("SELECT sum(qty) FROM inventory").fetchone() == (4,)
+
+
+def test_items_are_counted_in_memory(bot):
+    p = bot.create_player_obj(1, "usagi", "Usagi", "luna")
+    p.inventory = bot.parse_inventory("potion:2,moon_crystal:1")
+    p._dirty.clear()
+    bot.add_item_to_player(p, "moon_crystal")
+    assert bot.consume_item_from_player(p, "potion")
+    assert bot.consume_item_from_player(p, "potion")
+    assert not bot.consume_item_from_player(p, "potion")
+    assert bot.get_inventory_list(p) == [("moon_crystal", 2)]
+    assert p._dirty == {"inventory"}
+    rows = repos.sqlite_inventory_rows(p, p._dirty)
+    assert rows[0] == ("DELETE FROM inventory WHERE user_id = ?", (1,))
+    assert [args for _, args in rows[1:]] == [(1, "moon_crystal", 2)]
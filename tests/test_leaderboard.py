@@ -0,0 +1,39 @@
+from leaderboard import Leaderboard
+
+
+def _board(size=2):
+    lb = Leaderboard(size=size)
+    # как SQL_RANKING: по убыванию lvl, xp
+    lb.load([(1, "Usagi", 5, 10), (2, "Rei", 3, 0), (3, "Ami", 1, 5)])
+    return lb
+
+
+def test_update_moves_player_and_keeps_ranks():
+    lb = _board()
+    assert lb.rank(3, 0) == 2
+    lb.update(3, "Ami", 1, 5, 6, 0)
+    assert lb.top() == [("Ami", 6, 0), ("Usagi", 5, 10)]
+    assert [lb.rank(6, 0), lb.rank(5, 10), lb.rank(3, 0)] == [1, 2, 3]
+    assert len(lb) == 3
+    assert not lb.stale
+
+
+def test_update_back_restores_previous_state():
+    # так restore_players откатывает очки, если запись не удалась
+    lb = _board()
+    lb.update(3, "Ami", 1, 5, 6, 0)
+    lb.update(3, "Ami", 6, 0, 1, 5)
+    assert lb.rank(1, 5) == 3
+    assert len(lb) == 3
+    # Ами вышла из топа, место занял Рей — это знает только индекс
+    assert lb.stale
+    lb.refill([(1, "Usagi", 5, 10), (2, "Rei", 3, 0)])
+    assert lb.top() == [("Usagi", 5, 10), ("Rei", 3, 0)]
+
+
+def test_add_and_equal_scores_share_rank():
+    lb = _board()
+    lb.add(4, "Mako", 3, 0)
+    assert lb.rank(3, 0) == 2
+    assert lb.rank(1, 5) == 4
+    assert len(lb) == 4
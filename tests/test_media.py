@@ -0,0 +1,56 @@
+import asyncio
+from types import SimpleNamespace
+
+from telegram.error import BadRequest
+
+from media import MIGRATE_MEDIA_CACHE, MediaCache
+from outbox import Outbox
+from storage import Database
+
+URL = "https://example.com/luna.png"
+
+
+class FakeBot:
+    """send_photo: старый file_id отвергается, ссылка отправляется и даёт новый id."""
+
+    def __init__(self):
+        self.sent = []
+
+    async def send_photo(self, chat_id, photo, **kwargs):
+        self.sent.append(photo)
+        if photo == "revoked-id":
+            raise BadRequest("Wrong file identifier/http url specified")
+        return SimpleNamespace(photo=[SimpleNamespace(file_id="fresh-id")])
+
+
+def test_revoked_file_id_is_forgotten_and_resent_by_url(tmp_path):
+    async def scenario():
+        db = Database(str(tmp_path / "media.db"))
+        db.start()
+        await db.executescript(MIGRATE_MEDIA_CACHE)
+        await db.execute("INSERT INTO media_cache (bot_id, url, file_id) VALUES (1, ?, 'revoked-id')", (URL,))
+        media = MediaCache(db)
+        await media.load(1)
+        bot = FakeBot()
+        outbox = Outbox(workers=1)
+        outbox.start(bot)
+
+        photo = media.photo(URL)
+
+        def resend():
+            outbox.send_photo(7, photo=URL, on_sent=media.on_sent(URL))
+
+        outbox.send_photo(7, photo=photo, on_sent=media.on_sent(URL), on_failed=media.on_failed(URL, photo, resend))
+        for _ in range(100):
+            if media.photo(URL) == "fresh-id":
+                break
+            await asyncio.sleep(0.01)
+        await outbox.stop()
+        rows = await db.fetchall("SELECT file_id FROM media_cache WHERE bot_id = 1 AND url = ?", (URL,))
+        await db.close()
+        return bot.sent, media.invalidated, rows
+
+    sent, invalidated, rows = asyncio.run(scenario())
+    assert sent == ["revoked-id", URL]
+    assert invalidated == 1
+    assert rows == [("fresh-id",)]
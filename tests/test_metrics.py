@@ -0,0 +1,37 @@
+import asyncio
+
+import pytest
+
+from metrics import Registry
+from storage import Database
+
+
+def test_handler_metrics_count_queries_connections_and_errors(tmp_path):
+    reg = Registry()
+    db = Database(str(tmp_path / "m.db"))
+    db.observer = reg.observe_query
+
+    async def cmd_ok(update, context):
+        await db.execute("CREATE TABLE IF NOT EXISTS t (x INTEGER)")
+        await db.execute("INSERT INTO t VALUES (1)")
+        await db.fetchone("SELECT count(*) FROM t")
+
+    async def cmd_fail(update, context):
+        raise ValueError("boom")
+
+    async def scenario():
+        db.start()
+        await reg.instrument(cmd_ok)(None, None)
+        with pytest.raises(ValueError) as exc:
+            await reg.instrument(cmd_fail)(None, None)
+        await db.close()
+        return exc.value
+
+    err = asyncio.run(scenario())
+    # error_handler по этой метке пишет в лог, какой обработчик упал
+    assert err.sailor_handler == "cmd_fail"
+    ok = reg.handlers["cmd_ok"]
+    assert (ok.count, ok.queries, ok.connections, ok.errors) == (1, 3, 2, 0)
+    assert reg.handlers["cmd_fail"].errors == 1
+    text = reg.render()
+    assert 'sailor_handler_connections_total{handler="cmd_ok"} 2' in text
@@ -0,0 +1,80 @@
+import asyncio
+import time
+from datetime import timedelta
+
+from telegram.error import BadRequest, NetworkError, RetryAfter
+
+import outbox
+from outbox import Outbox
+
+
+class FakeBot:
+    """Записывает отправки; errors — исключения, которые бросить по очереди."""
+
+    def __init__(self, errors=()):
+        self.sent = []
+        self.errors = list(errors)
+
+    async def send_message(self, chat_id, text):
+        if self.errors:
+            raise self.errors.pop(0)
+        self.sent.append((time.monotonic(), chat_id, text))
+        return text
+
+
+async def _drain(box, timeout=5.0):
+    await asyncio.sleep(0)
+    await box.stop(timeout)
+
+
+def test_private_chat_is_rate_limited_and_ordered(monkeypatch):
+    monkeypatch.setattr(outbox, "PRIVATE_RATE", 20.0)
+    monkeypatch.setattr(outbox, "PRIVATE_BURST", 2)
+
+    async def scenario():
+        bot = FakeBot()
+        box = Outbox(workers=4)
+        box.start(bot)
+        for i in range(6):
+            box.send_message(1, f"m{i}")
+        box.send_message(2, "other")
+        await _drain(box)
+        return bot.sent, box.stats()
+
+    sent, stats = asyncio.run(scenario())
+    mine = [(t, text) for t, chat, text in sent if chat == 1]
+    assert [text for _, text in mine] == [f"m{i}" for i in range(6)]
+    # два сообщения сразу, остальные четыре — не чаще 20 в секунду
+    assert mine[-1][0] - mine[0][0] >= 4 / 20 * 0.9
+    # другой чат не ждёт очереди первого
+    assert [chat for _, chat, _ in sent].index(2) < 3
+    assert stats["sent"] == 7 and stats["queued"] == 0
+
+
+def test_retry_after_and_network_errors_are_retried():
+    async def scenario():
+        bot = FakeBot([RetryAfter(timedelta(seconds=0.05)), NetworkError("reset")])
+        box = Outbox(workers=2, backoff=0.01)
+        box.start(bot)
+        box.send_message(1, "hello")
+        await _drain(box)
+        return bot.sent, box.stats()
+
+    sent, stats = asyncio.run(scenario())
+    assert [text for _, _, text in sent] == ["hello"]
+    assert (stats["retries"], stats["failed"]) == (2, 0)
+
+
+def test_rejected_message_is_dropped_and_queue_moves_on():
+    async def scenario():
+        bot = FakeBot([BadRequest("chat not found")])
+        box = Outbox(workers=1)
+        box.start(bot)
+        box.send_message(1, "lost")
+        box.send_message(1, "next")
+        await _drain(box)
+        return bot.sent, box.stats()
+
+    sent, stats = asyncio.run(scenario())
+    assert [text for _, _, text in sent] == ["next"]
+    assert (stats["retries"], stats["failed"]) == (0, 1)
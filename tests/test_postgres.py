@@ -0,0 +1,165 @@
+"""
+Репозитории PostgreSQL на настоящем сервере: pgserver поднимает его во
+временном каталоге. Без pgserver или asyncpg модуль пропускается.
+"""
+
+import asyncio
+import sqlite3
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("asyncpg")
+pgserver = pytest.importorskip("pgserver")
+
+from gamedata import ENERGY_REGEN_SECONDS, MAX_ENERGY  # noqa: E402
+from postgres import PgDatabase, PgPlayerRepo, PgTeamRepo, init_postgres  # noqa: E402
+from repos import PLAYER_COLUMNS  # noqa: E402
+import copy_to_postgres  # noqa: E402
+
+NOW = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+
+@pytest.fixture(scope="module")
+def dsn(tmp_path_factory):
+    server = pgserver.get_server(tmp_path_factory.mktemp("pg"), cleanup_mode="stop")
+    yield server.get_uri()
+    server.cleanup()
+
+
+def player(user_id, username, lvl=1, xp=0, energy=MAX_ENERGY, tick="", inventory=None):
+    return SimpleNamespace(
+        user_id=user_id, username=username, name=username.title(), style="luna", lvl=lvl, xp=xp,
+        gold=50, hp=100, max_hp=100, atk=10, energy=energy, last_daily="", last_energy_tick=tick,
+        inventory=inventory or {}, version=0,
+    )
+
+
+def run(dsn, scenario):
+    async def wrapper():
+        db = PgDatabase(dsn, max_size=2)
+        await init_postgres(db)
+        await db.execute("TRUNCATE players, inventory, teams, team_members RESTART IDENTITY")
+        try:
+            return await scenario(db)
+        finally:
+            await db.close()
+
+    return asyncio.run(wrapper())
+
+
+async def insert(repo, *players):
+    fields = set(PLAYER_COLUMNS) | {"inventory"}
+    await repo.apply(repo.prepare([(p, fields, 0) for p in players]))
+
+
+def test_get_and_find_by_username(dsn):
+    async def scenario(db):
+        repo = PgPlayerRepo(db)
+        await insert(repo, player(1, "Usagi", inventory={"potion": 2}), player(2, "ami"))
+        row = await repo.get(1)
+        assert row[0] == 1 and row[1] == "Usagi"
+        assert row[13] == "potion:2" and row[14] == 1
+        assert await repo.get(3) is None
+        assert sorted(r[0] for r in await repo.get_many([1, 2, 3])) == [1, 2]
+        assert await repo.find_by_username("usagi") == 1
+        assert await repo.find_by_username("rei") is None
+
+    run(dsn, scenario)
+
+
+def test_ranking(dsn):
+    async def scenario(db):
+        repo = PgPlayerRepo(db)
+        await insert(repo, player(1, "a", lvl=2, xp=10), player(2, "b", lvl=3), player(3, "c", lvl=2, xp=30))
+        assert [r[0] for r in await repo.ranking()] == [2, 3, 1]
+        assert [r[0] for r in await repo.ranking(2)] == [2, 3]
+
+    run(dsn, scenario)
+
+
+def test_regen_energy(dsn):
+    async def scenario(db):
+        repo = PgPlayerRepo(db)
+        ago = (NOW - timedelta(seconds=2 * ENERGY_REGEN_SECONDS + 1)).isoformat()
+        await insert(
+            repo,
+            player(1, "a", energy=0, tick=ago),
+            player(2, "b", energy=0, tick=ago),  # в кеше бота — не трогаем
+            player(3, "c", energy=MAX_ENERGY - 1, tick=ago),
+            player(4, "d", energy=0, tick=NOW.isoformat()),  # ещё не накопил
+        )
+        hi, updated = await repo.regen_energy(0, 10, [2], NOW.isoformat())
+        assert hi == 4 and sorted(updated) == [1, 3]
+        one, two, three = [await repo.get(uid) for uid in (1, 2, 3)]
+        assert (one[10], one[14]) == (2, 2)
+        tick = datetime.fromisoformat(one[12])
+        assert tick == NOW - timedelta(seconds=1)
+        assert (two[10], two[14]) == (0, 1)
+        # энергия полная — отметка становится текущим временем
+        assert (three[10], three[12]) == (MAX_ENERGY, NOW.isoformat())
+        assert await repo.regen_energy(4, 10, [], NOW.isoformat()) == (None, [])
+
+    run(dsn, scenario)
+
+
+def test_teams(dsn):
+    async def scenario(db):
+        teams = PgTeamRepo(db)
+        await insert(PgPlayerRepo(db), player(1, "a"), player(2, "b"), player(3, "c"))
+        team_id = await teams.create(1, [1, 2, 2])
+        rows = await teams.user_teams(2)
+        assert sorted(r[2] for r in rows) == [1, 2]
+        assert {(r[0], r[1]) for r in rows} == {(team_id, 1)}
+        assert [r[4] for r in rows if r[2] == 1] == ["A"]
+        assert await teams.user_teams(3) == []
+
+    run(dsn, scenario)
+
+
+def test_join(dsn):
+    async def scenario(db):
+        teams = PgTeamRepo(db)
+        await insert(PgPlayerRepo(db), player(1, "a"), player(2, "b"), player(3, "c"))
+        team_id, created = await teams.join(1, 2)
+        assert created
+        assert await teams.join(1, 3) == (team_id, False)
+        assert await teams.join(1, 3) == (team_id, False)
+        rows = await teams.user_teams(3)
+        assert sorted(r[2] for r in rows) == [1, 2, 3]
+        assert {(r[0], r[1]) for r in rows} == {(team_id, 1)}
+        # одновременные принятия у одного лидера — одна команда
+        results = await asyncio.gather(*(teams.join(9, uid) for uid in (1, 2, 3)))
+        assert sum(created for _, created in results) == 1
+        assert len({tid for tid, _ in results}) == 1
+
+    run(dsn, scenario)
+
+
+def test_copy_from_sqlite(dsn, tmp_path):
+    path = str(tmp_path / "bot.db")
+    conn = sqlite3.connect(path)
+    conn.executescript(f"""
+        CREATE TABLE players ({', '.join(PLAYER_COLUMNS)}, version INTEGER);
+        CREATE TABLE inventory (user_id, item_key, qty);
+        CREATE TABLE teams (team_id INTEGER PRIMARY KEY, leader_id, member_ids, active);
+        CREATE TABLE team_members (team_id, user_id);
+        INSERT INTO players VALUES (1, 'usagi', 'Usagi', 'luna', 3, 120, 70, 100, 100, 12, 4, '', '', 5);
+        INSERT INTO inventory VALUES (1, 'potion', 2);
+        INSERT INTO teams VALUES (7, 1, '1', 1);
+        INSERT INTO team_members VALUES (7, 1);
+    """)
+    conn.commit()
+    conn.close()
+
+    async def scenario(db):
+        assert await copy_to_postgres.copy(path, dsn) == {"players": 1, "inventory": 1, "teams": 1, "team_members": 1}
+        row = await PgPlayerRepo(db).get(1)
+        assert (row[6], row[13], row[14]) == (70, "potion:2", 5)
+        # новая команда не сталкивается с перенесённым номером
+        assert await PgTeamRepo(db).create(1, [1]) == 8
+        # в непустую базу повторно не пишем
+        assert await copy_to_postgres.copy(path, dsn) is None
+
+    run(dsn, scenario)
@@ -0,0 +1,33 @@
+import gamedata
+from router import pack
+
+
+def test_monster_pools_match_naive_filter():
+    for lvl in range(0, gamedata.MAX_MONSTER_LVL + 3):
+        naive = [m for m in gamedata.MONSTERS if m["lvl"] <= max(1, lvl + 1)]
+        assert list(gamedata.monster_pool_for(lvl)) == naive
+    assert all(m["id"].startswith("boss") for m in gamedata.BOSSES)
+    assert all(m["id"].startswith("superboss") for m in gamedata.SUPER_BOSSES)
+
+
+def test_level_lookup_matches_linear_scan(bot):
+    def naive(xp):
+        lvl = 1
+        for i, (req, _) in enumerate(bot.LEVELS):
+            if xp >= req:
+                lvl = i + 1
+        return lvl, bot.LEVELS[lvl - 1][1]
+
+    points = {0, 1, bot.LEVELS[-1][0] + 1000}
+    for req, _ in bot.LEVELS:
+        points |= {req - 1, req, req + 1}
+    for xp in sorted(points):
+        assert bot.level_name_for_xp(xp) == naive(xp)
+
+
+def test_keyboards_are_built_once(bot):
+    assert bot.make_user_buttons(7) is bot.make_user_buttons(7)
+    assert bot.make_user_buttons(7) is not bot.make_user_buttons(8)
+    data = [row[0].callback_data for row in bot.SHOP_KEYBOARD.inline_keyboard]
+    assert data == [pack(bot.CB_BUY, k) for k, it in bot.ITEMS.items() if it.get("price", 0) > 0]
+    assert len(bot.STYLE_KEYBOARD.inline_keyboard) == len(bot.STYLES)
@@ -0,0 +1,77 @@
+import asyncio
+
+import pytest
+
+from raids import MIGRATE_RAIDS, RaidRegistry
+from storage import Database
+
+BOSS = {"id": "boss1"}
+
+
+async def _registry(tmp_path):
+    db = Database(str(tmp_path / "raids.db"))
+    db.start()
+    await db.executescript(MIGRATE_RAIDS)
+    return db, RaidRegistry(db)
+
+
+def test_won_raid_keeps_damage_until_settled(tmp_path):
+    async def scenario():
+        db, raids = await _registry(tmp_path)
+        raid = await raids.start(-100, BOSS, 10, 600)
+        raids.hit(raid, 1, 7, 0)
+        raids.hit(raid, 2, 5, 0)
+        assert await raids.merge() == [raid]
+
+        assert await raids.claim(raid, "won") == {1: 7, 2: 5}
+        # второй воркер рейд уже не заберёт
+        assert await raids.claim(raid, "won") is None
+        # выплата не дошла до settle: после аренды её можно повторить
+        assert await raids.unpaid(lease=3600) == []
+        (again, damage), = await raids.unpaid(lease=0)
+        assert (again.raid_id, damage) == (raid.raid_id, {1: 7, 2: 5})
+
+        await raids.settle(again)
+        assert await raids.unpaid(lease=0) == []
+        assert await db.fetchall("SELECT * FROM raid_damage") == []
+        await db.close()
+
+    asyncio.run(scenario())
+
+
+def test_failed_raid_drops_damage_on_claim(tmp_path):
+    async def scenario():
+        db, raids = await _registry(tmp_path)
+        raid = await raids.start(-100, BOSS, 100, 600)
+        raids.hit(raid, 1, 7, 0)
+        assert await raids.claim(raid, "failed") == {1: 7}
+        assert await db.fetchall("SELECT * FROM raid_damage") == []
+        assert await raids.unpaid(lease=0) == []
+        await db.close()
+
+    asyncio.run(scenario())
+
+
+def test_failed_payout_is_retried(bot, monkeypatch):
+    async def scenario():
+        await bot.init_db()
+        p = bot.create_player_obj(91, "rei", "Rei", "mars")
+        await bot.save_player(p, "start")
+        gold = p.gold
+        raid = await bot.raids.start(-91, bot.battle.pick_boss(bot.battle_rng)[0], 1, 600)
+        bot.raids.hit(raid, 91, 5, 0)
+
+        async def broken(raid, rewards):
+            raise OSError("база недоступна")
+
+        monkeypatch.setattr(bot, "pay_raid", broken)
+        with pytest.raises(OSError):
+            await bot.merge_raids_job()
+        monkeypatch.undo()
+
+        monkeypatch.setattr(bot, "RAID_PAY_LEASE", 0)
+        await bot.retry_raids_job()
+        assert (await bot.load_player(91)).gold > gold
+        assert await bot.raids.unpaid(lease=0) == []
+
+    asyncio.run(scenario())
@@ -0,0 +1,53 @@
+import asyncio
+from datetime import timedelta
+
+UID = 42
+
+
+async def _stale_copy(bot, spent: bool):
+    """
+    Копия игрока прочитана до UPDATE регенерации, а в кеш попала после:
+    её версия уже устарела, но invalidate не трогает грязную запись.
+    """
+    await bot.init_db()
+    ago = bot.utcnow() - timedelta(seconds=3 * bot.ENERGY_REGEN_SECONDS + 1)
+    p = bot.create_player_obj(UID, "usagi", "Usagi", "luna")
+    p.energy = 0
+    p.last_energy_tick = ago.isoformat()
+    bot.player_cache.mark_dirty(p)
+    await bot.player_cache.flush()
+    bot.player_cache.invalidate(UID)
+
+    row = await bot.player_repo.get(UID)
+    bot.regen_state["after"] = 0
+    await bot.regen_energy_job()
+    assert bot.regen_state["players"] >= 1
+
+    p = bot.player_from_row(row)
+    bot.player_cache.put(p)
+    p.gold += 10
+    if spent:
+        assert bot.spend_energy(p)
+    bot.player_cache.mark_dirty(p)
+    await bot.player_cache.flush()
+
+    saved = bot.player_from_row(await bot.player_repo.get(UID))
+    await bot.player_repo.db.execute("DELETE FROM players WHERE user_id = ?", (UID,))
+    bot.player_cache.invalidate(UID)
+    await bot.close_db()
+    return p, saved
+
+
+def test_stale_copy_keeps_progress_and_regen(bot):
+    p, saved = asyncio.run(_stale_copy(bot, spent=False))
+    assert saved.gold == 60
+    # энергия, начисленная фоном, не перезаписана старой копией
+    assert saved.energy == 3
+    assert saved.version == p.version
+
+
+def test_stale_copy_spending_energy(bot):
+    p, saved = asyncio.run(_stale_copy(bot, spent=True))
+    assert saved.gold == 60
+    assert saved.energy == 2
+    assert saved.last_energy_tick == p.last_energy_tick
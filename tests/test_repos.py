@@ -0,0 +1,21 @@
+import pytest
+
+import duels  # noqa: F401 — модули регистрируют свои миграции при импорте
+import gamelog  # noqa: F401
+import invites  # noqa: F401
+import media
+import raids
+import repos
+
+
+def test_feature_migrations_keep_their_steps():
+    steps = repos.migrations()
+    assert len(steps) == 12
+    assert steps[4] is media.MIGRATE_MEDIA_CACHE
+    assert steps[-1] is raids.MIGRATE_RAIDS
+
+
+def test_taken_step_is_rejected():
+    repos.register_migration(5, media.MIGRATE_MEDIA_CACHE)  # повторный импорт — не ошибка
+    with pytest.raises(ValueError):
+        repos.register_migration(5, "CREATE TABLE x (y)")
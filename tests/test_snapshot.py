@@ -0,0 +1,35 @@
+import asyncio
+
+from storage import Database, Snapshot
+
+
+def test_published_snapshot_is_replaced_under_open_readers(tmp_path):
+    async def scenario():
+        source = str(tmp_path / "bot.db")
+        path = str(tmp_path / "bot.db.snapshot")
+        db = Database(source)
+        db.start()
+        await db.execute("CREATE TABLE t (x INTEGER)")
+        await db.execute("INSERT INTO t VALUES (1)")
+
+        # два воркера: один обновляет снимок, другой только читает
+        primary, other = Snapshot(source, path), Snapshot(source, path)
+        await primary.refresh()
+        assert await other.reopen()
+        assert await other.fetchone("SELECT count(*) FROM t") == (1,)
+        assert not await other.reopen()
+
+        await db.execute("INSERT INTO t VALUES (2)")
+        await primary.refresh()
+        # открытый файл не переписан на месте: читатель видит свою копию целиком
+        assert await other.fetchone("SELECT count(*) FROM t") == (1,)
+        assert await other.reopen()
+        assert await other.fetchone("SELECT count(*) FROM t") == (2,)
+        assert await primary.fetchone("SELECT count(*) FROM t") == (2,)
+
+        await other.close()
+        await primary.close()
+        await db.close()
+        return sorted(p.name for p in tmp_path.iterdir() if p.name.startswith("bot.db.snapshot"))
+
+    assert asyncio.run(scenario()) == ["bot.db.snapshot"]
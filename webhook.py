@@ -0,0 +1,171 @@
+"""
+Вебхук-сервер бота на tornado (ставится вместе с python-telegram-bot[webhooks]).
+Принимает апдейты Telegram и на том же порту отдаёт /metrics.
+serve_workers() запускает несколько процессов на одном сокете.
+"""
+
+import asyncio
+import hmac
+import json
+import os
+import re
+import signal
+import sys
+import time
+
+import tornado.httpserver
+import tornado.netutil
+import tornado.web
+from telegram import Update
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookHandler(tornado.web.RequestHandler):
+    def initialize(self, bot_app, secret):
+        self.bot_app = bot_app
+        self.secret = secret
+
+    async def post(self):
+        if self.secret:
+            got = self.request.headers.get(SECRET_HEADER, "")
+            if not hmac.compare_digest(got, self.secret):
+                raise tornado.web.HTTPError(403)
+        try:
+            data = json.loads(self.request.body)
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+        update = Update.de_json(data, self.bot_app.bot)
+        await self.bot_app.update_queue.put(update)
+        self.set_status(200)
+
+    def log_exception(self, typ, value, tb):
+        if not isinstance(value, tornado.web.HTTPError):
+            super().log_exception(typ, value, tb)
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def initialize(self, registry):
+        self.registry = registry
+
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(self.registry.render())
+
+
+def make_web_app(application, url_path: str, registry, secret: str | None = None):
+    return tornado.web.Application([
+        (rf"/{re.escape(url_path.strip('/'))}/?", WebhookHandler, {"bot_app": application, "secret": secret}),
+        (r"/metrics", MetricsHandler, {"registry": registry}),
+    ])
+
+
+async def _wait_for_signal():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+    await stop.wait()
+
+
+async def serve(application, listen: str, port: int, url_path: str, webhook_url: str,
+                registry, secret: str | None = None, sockets=None, set_webhook: bool = True):
+    """
+    Жизненный цикл как у Application.run_webhook: initialize → post_init →
+    start → (работа до SIGINT/SIGTERM) → stop → post_stop → shutdown → post_shutdown.
+    sockets — заранее открытые сокеты (воркеры serve_workers), иначе слушаем port.
+    """
+    web_app = make_web_app(application, url_path, registry, secret)
+    server = tornado.httpserver.HTTPServer(web_app)
+    try:
+        await application.initialize()
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        if sockets is not None:
+            server.add_sockets(sockets)
+        else:
+            server.listen(port, address=listen)
+        if set_webhook:
+            await application.bot.set_webhook(
+                url=webhook_url, secret_token=secret, allowed_updates=Update.ALL_TYPES
+            )
+        await _wait_for_signal()
+    finally:
+        server.stop()
+        await server.close_all_connections()
+        if application.running:
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+def _fork_workers(workers: int) -> int:
+    """
+    Запускает воркеры и возвращает номер текущего воркера (в дочернем процессе).
+    Родитель отсюда не возвращается: перезапускает упавших воркеров,
+    пересылает им SIGINT/SIGTERM и выходит, когда все завершились.
+    """
+    children = {}  # pid -> номер воркера
+    stopping = False
+
+    def spawn(i) -> bool:
+        pid = os.fork()
+        if pid == 0:
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                signal.signal(sig, signal.SIG_DFL)
+            return True
+        children[pid] = i
+        return False
+
+    def forward(sig, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                pass
+
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, forward)
+    for i in range(workers):
+        if spawn(i):
+            return i
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        i = children.pop(pid, None)
+        if i is None or stopping or os.waitstatus_to_exitcode(status) == 0:
+            continue
+        print(f"Воркер {i} (pid {pid}) завершился с кодом {os.waitstatus_to_exitcode(status)}, перезапускаем")
+        time.sleep(1)  # не крутить перезапуски, если воркер падает сразу
+        if spawn(i):
+            return i
+    sys.exit(0)
+
+
+def serve_workers(build_application, workers: int, listen: str, port: int, **options):
+    """
+    Несколько процессов за одним вебхуком: сокет открывается до fork,
+    и ядро раздаёт входящие соединения между воркерами. Каждый воркер
+    строит свой Application через build_application(номер воркера) уже
+    после fork. Вебхук регистрирует только воркер 0; упавший воркер
+    перезапускается с тем же номером. /metrics отдаёт тот воркер,
+    которому достался запрос.
+    """
+    sockets = tornado.netutil.bind_sockets(port, address=listen)
+    worker = _fork_workers(workers)
+    asyncio.run(serve(
+        build_application(worker), listen=listen, port=port,
+        sockets=sockets, set_webhook=worker == 0, **options,
+    ))